@@ -0,0 +1,169 @@
+import os
+
+from loguru import logger
+
+# whether the chat variant of the chains is used with a backend type, unless set explicitly
+BACKEND_CHAT_DEFAULTS = {
+    "openai": True,
+    "azure_openai": True,
+    "transformers": False,
+    "llamacpp": False,
+    "mock": False,
+}
+
+# llama.cpp settings for quantized GGUF models on CPU nodes, overridden by the keys of a backend spec:
+# threads for generation on the physical cores (approximated as half the logical CPUs) and for prompt
+# processing on all of them, a prompt batch covering a paragraph with the instructions of a chain step, a
+# context for the longest prompt with its answer, and no layers offloaded to a GPU
+LLAMACPP_CPU_DEFAULTS = {
+    "n_threads": max(1, (os.cpu_count() or 2) // 2),
+    "n_threads_batch": os.cpu_count() or 1,
+    "n_batch": 512,
+    "n_ctx": 4096,
+    "n_gpu_layers": 0,
+    "use_mmap": True,
+    "caching": True,
+}
+
+# seconds an OpenAI request may take before the client gives up, unless the spec sets "timeout". The client
+# default of 10 minutes would block a pipeline worker far beyond the deadlines of a run (see stance_llm.deadline)
+OPENAI_REQUEST_TIMEOUT = 60.0
+
+# guidance chat classes of llama.cpp models by the prompt format of the model
+LLAMACPP_CHAT_FORMATS = {
+    "llama2": "LlamaCppChat",
+    "mistral": "MistralChat",
+}
+
+
+def parse_backend_spec(spec) -> dict:
+    """normalizes a backend spec given as a string "<type>:<model>" (e.g. "openai:gpt-3.5-turbo") or as a dictionary
+
+    Args:
+        spec: string "<type>:<model>", or dictionary with a "type" key, a "model" key and further arguments to the guidance model class
+
+    Returns:
+        dict: the spec as a dictionary with at least a "type" key
+    """
+    if isinstance(spec, str):
+        backend_type, _, model = spec.partition(":")
+        spec = {"type": backend_type}
+        if model != "":
+            spec["model"] = model
+    spec = dict(spec)
+    if spec.get("type") not in BACKEND_CHAT_DEFAULTS:
+        raise ValueError(
+            f"Unsupported backend type {spec.get('type')}. Use one of {list(BACKEND_CHAT_DEFAULTS)}"
+        )
+    if spec["type"] != "mock" and "model" not in spec:
+        raise ValueError(f"Backend spec of type {spec['type']} needs a model")
+    return spec
+
+
+def get_backend_label(spec) -> str:
+    """returns the label of a backend spec used as model_used, e.g. "openai-gpt-3.5-turbo"
+
+    Args:
+        spec: backend spec (see parse_backend_spec())
+    """
+    spec = parse_backend_spec(spec)
+    if "label" in spec:
+        return spec["label"]
+    if "model" not in spec:
+        return spec["type"]
+    model_name = os.path.basename(str(spec["model"]).rstrip("/"))
+    return f"{spec['type']}-{model_name}"
+
+
+def get_backend_chat(spec) -> bool:
+    """returns whether the chat variant of the chains is used with a backend spec
+
+    Args:
+        spec: backend spec (see parse_backend_spec()), with an optional "chat" key overriding the default of its type
+    """
+    spec = parse_backend_spec(spec)
+    return spec.get("chat", BACKEND_CHAT_DEFAULTS[spec["type"]])
+
+
+def load_backend(spec):
+    """loads a guidance model backend from a spec, as used in run configs of the stance-llm command (see stance_llm.cli)
+
+    The "type" of the spec selects the guidance model class: "openai", "azure_openai", "transformers", "llamacpp"
+    or "mock". "llamacpp" loads a GGUF model file with the CPU profile of load_llamacpp_backend(). API keys are read from the environment variable named by "api_key_env" (OPENAI_API_KEY by default for OpenAI
+    backends), so that they are not kept in config files. OpenAI requests time out after "timeout" seconds (OPENAI_REQUEST_TIMEOUT by default). Other keys of the spec except "label", "chat" and "memory_gb" (see stance_llm.pool.ModelPool) are passed
+    to the model class, e.g. {"type": "transformers", "model": "gpt2", "device_map": "auto"}.
+
+    Args:
+        spec: string "<type>:<model>" or dictionary (see parse_backend_spec())
+
+    Returns:
+        a guidance model backend from guidance.models
+    """
+    from guidance import models
+
+    chat = get_backend_chat(spec)
+    spec = parse_backend_spec(spec)
+    backend_type = spec.pop("type")
+    model = spec.pop("model", None)
+    for key in ["label", "chat", "memory_gb"]:
+        spec.pop(key, None)
+    if backend_type in ["openai", "azure_openai"]:
+        api_key_env = spec.pop("api_key_env", "OPENAI_API_KEY")
+        if "api_key" not in spec:
+            if api_key_env not in os.environ:
+                raise ValueError(
+                    f"No API key for the {backend_type} backend. Set the environment variable {api_key_env}"
+                )
+            spec["api_key"] = os.environ[api_key_env]
+        spec.setdefault("timeout", OPENAI_REQUEST_TIMEOUT)
+    logger.info(f"Loading {backend_type} backend {model if model is not None else ''}")
+    if backend_type == "openai":
+        return models.OpenAI(model, **spec)
+    if backend_type == "azure_openai":
+        return models.AzureOpenAI(model, **spec)
+    if backend_type == "transformers":
+        return models.Transformers(model, **spec)
+    if backend_type == "llamacpp":
+        return load_llamacpp_backend(model, chat=chat, **spec)
+    return models.Mock(**spec)
+
+
+def get_llamacpp_settings(**settings) -> dict:
+    """returns the llama.cpp settings of the CPU profile (LLAMACPP_CPU_DEFAULTS) updated with the given settings"""
+    return LLAMACPP_CPU_DEFAULTS | settings
+
+
+def load_llamacpp_backend(model: str, chat=False, chat_format="llama2", **settings):
+    """loads a quantized GGUF model with guidance's llama.cpp integration, tuned for CPU inference
+
+    Settings not given are taken from LLAMACPP_CPU_DEFAULTS:
+    - n_threads and n_threads_batch: threads generating tokens and processing prompts
+    - n_batch: number of prompt tokens processed at once
+    - n_ctx: context size in tokens, which must fit the longest prompt of a chain step and its answer
+    - caching: the prompt cache of guidance, which keeps the model state of the last prompt, so that the
+      next prompt only processes the tokens after their common prefix (see stance_llm.schedule for ordering
+      examples to share prefixes)
+    Further settings (e.g. use_mlock or n_gpu_layers) are passed on to llama_cpp.Llama.
+    Requires the llama-cpp-python package.
+
+    Args:
+        model (str): path of the GGUF model file
+        chat (bool, optional): load a chat model, to run the chat variant of the chains. Defaults to False.
+        chat_format (str, optional): prompt format of the chat model, "llama2" or "mistral" (see LLAMACPP_CHAT_FORMATS). Defaults to "llama2".
+        **settings: llama.cpp settings overriding LLAMACPP_CPU_DEFAULTS
+
+    Returns:
+        guidance.models.LlamaCpp, or the chat class of chat_format
+    """
+    from guidance import models
+
+    if chat_format not in LLAMACPP_CHAT_FORMATS:
+        raise ValueError(
+            f"Unsupported chat format {chat_format}. Use one of {list(LLAMACPP_CHAT_FORMATS)}"
+        )
+    settings = get_llamacpp_settings(**settings)
+    model_class = getattr(models, LLAMACPP_CHAT_FORMATS[chat_format]) if chat else models.LlamaCpp
+    logger.info(
+        f"Loading {model} with llama.cpp: {settings['n_threads']} threads, batch of {settings['n_batch']}, context of {settings['n_ctx']}"
+    )
+    return model_class(model, **settings)
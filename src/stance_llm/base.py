@@ -1,8 +1,19 @@
 from loguru import logger
 from typing_extensions import Self
+import math
 import re
+import time
+from contextlib import nullcontext
 
-from guidance import gen, select, user, assistant
+from stance_llm.cache import CachedStep
+from stance_llm.pool import get_backend_lock
+from stance_llm.ratelimit import count_limited_tokens
+from stance_llm.programs import (
+    StepProgram,
+    build_multi_entity_program,
+    get_role_tags,
+    get_step_program,
+)
 
 REGISTERED_LLM_CHAINS = {
     "sis": "summarize_irrelevant_stance",
@@ -12,11 +23,23 @@ REGISTERED_LLM_CHAINS = {
     "is2": "irrelevant_summarize_v2",
     "nise": "nested_irrelevant_summary_explicit",
     "nis2e": "nested_irrelevant_summary_v2_explicit",
+    "me": "multi_entity",
+}
+
+# methods of StanceClassification running the chains that classify one entity at a time
+SINGLE_ENTITY_CHAIN_METHODS = {
+    "sis": "summarize_irrelevant_stance_chain",
+    "s2is": "summarize_v2_irrelevant_stance_chain",
+    "s2": "summarize_v2_chain",
+    "is": "irrelevant_stance_chain",
+    "is2": "irrelevant_summarize_v2_chain",
+    "nise": "nested_irrelevant_summary_explicit",
+    "nis2e": "nested_irrelevant_summary_v2_explicit",
 }
 
 ALLOWED_DUAL_LLM_CHAINS = ["is2"]
 
-CONSTRAINED_GRAMMAR_CHAINS = ["s2", "is2"]
+CONSTRAINED_GRAMMAR_CHAINS = ["s2", "is2", "me"]
 
 IRRELEVANCE_ANSWERS = {
     "irrelevant": "Bezieht keine Stellung",
@@ -27,37 +50,144 @@ IRRELEVANCE_ANSWERS2 = {
     "stance": "Bezieht eine Haltung",
 }
 
+SUMMARY_V2_STANCE_ANSWERS = {
+    "irrelevant": "drückt keine Haltung aus dazu, dass",
+    "support": "unterstützt, dass",
+    "opposition": "lehnt ab, dass",
+}
+
+MULTI_ENTITY_STANCE_ANSWERS = {
+    "support": "unterstützt die Aussage",
+    "opposition": "lehnt die Aussage ab",
+    "irrelevant": "bezieht keine Stellung",
+}
+
+# single-entity chain classifying the entities whose stance the multi-entity chain cannot parse
+MULTI_ENTITY_FALLBACK_CHAIN = "is"
+
+# max_tokens of free-text summaries in the chat and non-chat chain variants
+SUMMARY_MAX_TOKENS = {True: 120, False: 80}
+SUMMARY_V2_MAX_TOKENS = 80
+
+# summaries feeding into later steps of a chain are capped and stopped at the first line break in classification-only runs
+CLASSIFICATION_ONLY_SUMMARY_MAX_TOKENS = 40
+CLASSIFICATION_ONLY_SUMMARY_STOP = "\n"
+
 ALLOWED_STANCE_CATEGORIES = ["support", "opposition", "irrelevant", "error"]
 
 
+class Prompt(str):
+    """Prompt text that remembers the template and parameters it was constructed from.
+
+    Behaves like the rendered prompt string. The template id and parameters allow storing a prompt history without
+    repeating the input text (see stance_llm.history).
+
+    Attributes:
+        template (str): id of the prompt template in PROMPT_TEMPLATES
+        params (dict): parameters the template was rendered with
+    """
+
+    def __new__(cls, text, template=None, params=None):
+        prompt = super().__new__(cls, text)
+        prompt.template = template
+        prompt.params = params if params is not None else {}
+        return prompt
+
+
 def construct_irrelevance_prompt(input_text, entity, statement):
     prompt = f"Analysiere den folgenden Text: {input_text}. Bezieht die Organisation {entity} Stellung zur folgenden Aussage: {statement}? Beziehe dich nur auf den Text. Antworte mit {IRRELEVANCE_ANSWERS['irrelevant']} oder {IRRELEVANCE_ANSWERS['stance']}"
-    return prompt
+    return Prompt(
+        prompt,
+        template="irrelevance",
+        params={"input_text": input_text, "entity": entity, "statement": statement},
+    )
 
 
 def construct_summary_prompt(input_text, entity):
     prompt = f"Fasse die Position der Organisation {entity} im folgenden Text zusammen: \n {input_text}. Fasse dich kurz und starte deine Zusammenfassung mit: Die Organisation {entity}..."
-    return prompt
+    return Prompt(
+        prompt,
+        template="summary",
+        params={"input_text": input_text, "entity": entity},
+    )
 
 
 def construct_summary_statementspecific_prompt(input_text, entity, statement):
     prompt = f'Fasse die Position der Organisation {entity} im folgenden Text in Bezug auf die Aussage "{statement}" zusammen: \n {input_text}. \n Fasse dich kurz und starte deine Zusammenfassung mit: Die Organisation {entity}...'
-    return prompt
+    return Prompt(
+        prompt,
+        template="summary_statementspecific",
+        params={"input_text": input_text, "entity": entity, "statement": statement},
+    )
 
 
 def construct_general_stance_prompt(input_text, entity):
     prompt = f"Analysiere den folgenden Text: {input_text}. Äussert die Organisation {entity} eine implizite oder explizite Haltung? Beziehe dich nur auf den Text. Antworte mit {IRRELEVANCE_ANSWERS2['irrelevant']} oder {IRRELEVANCE_ANSWERS2['stance']}"
-    return prompt
+    return Prompt(
+        prompt,
+        template="general_stance",
+        params={"input_text": input_text, "entity": entity},
+    )
 
 
 def construct_support_stance_prompt(input_text, entity, statement):
     prompt = f"Analysiere den folgenden Text: {input_text}. Befürwortet die Organisation {entity} die Aussage: {statement}? Beziehe dich nur auf den Text. Antworte mit Ja oder Nein"
-    return prompt
+    return Prompt(
+        prompt,
+        template="support_stance",
+        params={"input_text": input_text, "entity": entity, "statement": statement},
+    )
 
 
 def construct_opposition_stance_prompt(input_text, entity, statement):
     prompt = f"Analysiere den folgenden Text: {input_text}. Lehnt die Organisation {entity} folgende die Aussage ab: {statement}? Beziehe dich nur auf den Text. Antworte mit Ja oder Nein"
-    return prompt
+    return Prompt(
+        prompt,
+        template="opposition_stance",
+        params={"input_text": input_text, "entity": entity, "statement": statement},
+    )
+
+
+def construct_multi_entity_prompt(input_text, entities, statement):
+    answers = f"{MULTI_ENTITY_STANCE_ANSWERS['support']}, {MULTI_ENTITY_STANCE_ANSWERS['opposition']} oder {MULTI_ENTITY_STANCE_ANSWERS['irrelevant']}"
+    prompt = f"Analysiere den folgenden Text: {input_text}. Welche Haltung beziehen die folgenden Organisationen zur Aussage: {statement}? Organisationen: {'; '.join(entities)}. Beziehe dich nur auf den Text. Antworte für jede Organisation auf einer eigenen Zeile mit {answers}"
+    return Prompt(
+        prompt,
+        template="multi_entity",
+        params={"input_text": input_text, "entities": list(entities), "statement": statement},
+    )
+
+
+PROMPT_TEMPLATES = {
+    "irrelevance": construct_irrelevance_prompt,
+    "summary": construct_summary_prompt,
+    "summary_statementspecific": construct_summary_statementspecific_prompt,
+    "general_stance": construct_general_stance_prompt,
+    "support_stance": construct_support_stance_prompt,
+    "opposition_stance": construct_opposition_stance_prompt,
+    "multi_entity": construct_multi_entity_prompt,
+}
+
+# names under which the guidance programs of the chain steps capture the llm answers
+STEP_OUTPUT_NAMES = ["summary", "stance", "answer", "answer_general", "stances"]
+
+# outputs captured by select(), whose log probabilities are recorded as the confidence of a decision
+DECISION_OUTPUT_NAMES = ["stance", "answer", "answer_general"]
+
+
+def get_log_probs(lm, names) -> dict:
+    """returns the log probabilities of the captured decisions of a model state, leaving out those the backend does not report"""
+    log_probs = {}
+    for name in names:
+        if name not in DECISION_OUTPUT_NAMES:
+            continue
+        try:
+            log_prob = float(lm.log_prob(name))
+        except Exception:
+            continue
+        if math.isfinite(log_prob):
+            log_probs[name] = log_prob
+    return log_probs
 
 
 def get_registered_chains():
@@ -88,6 +218,10 @@ class StanceClassification:
         self.meta = None
         self.masked_entity = entity
         self.masked_input_text = input_text
+        self.deadline = None
+        self.step_cache = None
+        self.rate_limiter = None
+        self.steps = {}
 
     def __str__(self):
         return "The stance of entity {} towards the statement {} given text {} is {}".format(
@@ -105,8 +239,106 @@ class StanceClassification:
         self.masked_entity = entity_mask
         return self
 
+    def _run_step(self, llm, chat: bool, prompt: str, program, step: str):
+        """sends a prompt to the llm and appends a guidance program generating the answer
+
+        For chat llms, the prompt is sent in the user role and the program is run in the assistant role. Role tags are
+        added explicitly instead of through guidance's `with user():` blocks, which are shared by all threads.
+        If a deadline is set on the classification (see stance_llm.deadline.Deadline), the step registers with it.
+        If a step cache is set (see stance_llm.cache.StepCache), a step already answered for the same prompt and
+        program is taken from the cache instead of calling the llm, and a step running in another thread is waited for.
+        If a rate limiter is set (see stance_llm.ratelimit.RateLimiter), calls to the llm wait for it, with prompt
+        tokens approximated as 4 characters per token (see stance_llm.ratelimit.count_limited_tokens()).
+        The llm call holds the lock of the backend (see stance_llm.pool.get_backend_lock()), as guidance models are not
+        safe to use from several threads at once. With a deadline, the lock is waited for until the deadline expires.
+        The template, parameters, captured answers, log probabilities of the decisions (where the backend reports
+        them) and duration of the step are recorded in the "steps" attribute.
+
+        Args:
+            llm: A guidance model backend from guidance.models
+            chat (bool): whether llm is a chat llm or not
+            prompt (str): prompt text constructed for the step
+            program: precompiled step program (see stance_llm.programs.get_step_program()) or guidance grammar capturing the answer
+            step (str): name of the step in the chain, e.g. "irrelevance"
+
+        Returns:
+            the guidance model state after the step, with the captured answer, or a stance_llm.cache.CachedStep
+        """
+        if self.deadline is not None:
+            self.deadline.start_step(step)
+        grammar = program.grammar if isinstance(program, StepProgram) else program
+        cache_key = None
+        claim = nullcontext()
+        if self.step_cache is not None:
+            cache_key = self.step_cache.make_key(llm, chat, prompt, program)
+        if cache_key is not None:
+            claim = self.step_cache.claim(cache_key)
+        with claim:
+            cached = self.step_cache.get(cache_key) if cache_key is not None else None
+            if cached is not None:
+                lm = CachedStep(cached["outputs"], cached["text"], log_probs=cached.get("log_probs"))
+                seconds = cached["seconds"]
+            else:
+                if self.rate_limiter is not None:
+                    self.rate_limiter.acquire(tokens=count_limited_tokens(prompt))
+                lock = get_backend_lock(llm)
+                with self.deadline.hold(lock) if self.deadline is not None else lock:
+                    start = time.perf_counter()
+                    if chat:
+                        user_opener, user_closer = get_role_tags("user")
+                        assistant_opener, assistant_closer = get_role_tags("assistant")
+                        lm = llm + user_opener
+                        lm += prompt
+                        lm += user_closer
+                        lm += assistant_opener
+                        lm += grammar
+                        lm += assistant_closer
+                    if not chat:
+                        lm = llm + prompt + grammar
+                    seconds = time.perf_counter() - start
+            if self.deadline is not None:
+                self.deadline.check()
+            outputs = {
+                name: lm[name] for name in STEP_OUTPUT_NAMES if lm.get(name) is not None
+            }
+            log_probs = get_log_probs(lm, outputs)
+            if cache_key is not None and cached is None:
+                self.step_cache.put(
+                    cache_key,
+                    {"outputs": outputs, "log_probs": log_probs, "text": str(lm), "seconds": seconds},
+                )
+        self.steps[step] = {
+            "template": getattr(prompt, "template", None),
+            "params": getattr(prompt, "params", {"prompt": str(prompt)}),
+            "chat": chat,
+            "outputs": outputs,
+            "log_probs": log_probs,
+            "seconds": seconds,
+            "cached": cached is not None,
+        }
+        return lm
+
+    def _is_rationale_skipped(self, classification_only: bool) -> bool:
+        """whether a free-text summary step of the chain ran capped or without its summary, as in classification-only runs"""
+        return classification_only and "summary" in self.steps
+
+    def _summary_program(self, chat: bool, classification_only=False) -> StepProgram:
+        """free-text summary generation, capped and stopped early in classification-only runs"""
+        if classification_only:
+            return get_step_program(
+                "summary",
+                max_tokens=CLASSIFICATION_ONLY_SUMMARY_MAX_TOKENS,
+                stop=CLASSIFICATION_ONLY_SUMMARY_STOP,
+            )
+        return get_step_program("summary", max_tokens=SUMMARY_MAX_TOKENS[chat])
+
+    def _summary_v2_stance_program(self, classification_only=False) -> StepProgram:
+        """stance selection completing the summary start, followed by the free-text summary unless in classification-only runs"""
+        name = "summary_v2_stance" if classification_only else "summary_v2_stance_summary"
+        return get_step_program(name).with_prefix(f"Die Organisation {self.masked_entity} ")
+
     def summarize_irrelevant_stance_chain(
-        self, llm, chat: bool, llm2=None, log=True
+        self, llm, chat: bool, llm2=None, log=True, classification_only=False
     ) -> Self:
         """prompt chain that:
            1. summarises text (stored in the "meta" attribute of the StanceClassification class object in a dictionary value at the key ["llms"]["summary"])
@@ -119,6 +351,7 @@ class StanceClassification:
             chat (bool): whether llm is a chat llm or not
             llm2 (optional): A second guidance model backend from guidance.models. Defaults to None.
             log (bool, optional): To log or not. Defaults to True.
+            classification_only (bool, optional): Skip free-text summaries that do not feed into the stance and cap the others. Defaults to False.
 
         Returns:
             StanceClassification class object with new class object attributes: meta and stance. The irrelevance, summary, and stance prompt texts are stored in a dictionary value at the key ["llms"] in a dictionary stored in the "meta" attribute of the StanceClassification object returned: e.g. meta["llms"]["irrelevance"].
@@ -128,13 +361,15 @@ class StanceClassification:
         summary_prompt = construct_summary_prompt(
             input_text=self.masked_input_text, entity=self.masked_entity
         )
-        if chat:
-            with user():
-                summary = llm + summary_prompt
-            with assistant():
-                summary += gen(name="summary", max_tokens=120)
-        if not chat:
-            summary = llm + summary_prompt + gen(name="summary", max_tokens=80)
+        summary = self._run_step(
+            llm,
+            chat=chat,
+            prompt=summary_prompt,
+            step="summary",
+            program=self._summary_program(
+                chat=chat, classification_only=classification_only
+            ),
+        )
         if log:
             logger.info(
                 f"Basing classification on position summary: {summary['summary']}"
@@ -145,19 +380,13 @@ class StanceClassification:
             entity=self.masked_entity,
             statement=self.statement,
         )
-        if chat:
-            with user():
-                irrelevance = llm + irrelevance_prompt
-            with assistant():
-                irrelevance = irrelevance + select(
-                    list(IRRELEVANCE_ANSWERS.values()), name="answer"
-                )
-        if not chat:
-            irrelevance = (
-                llm
-                + irrelevance_prompt
-                + select(list(IRRELEVANCE_ANSWERS.values()), name="answer")
-            )
+        irrelevance = self._run_step(
+            llm,
+            chat=chat,
+            prompt=irrelevance_prompt,
+            step="irrelevance",
+            program=get_step_program("irrelevance"),
+        )
         if irrelevance["answer"] == IRRELEVANCE_ANSWERS["irrelevant"]:
             self.stance = "irrelevant"
             stance = None
@@ -167,13 +396,13 @@ class StanceClassification:
                 entity=self.masked_entity,
                 statement=self.statement,
             )
-            if chat:
-                with user():
-                    stance = llm + stance_prompt
-                with assistant():
-                    stance = stance + select(["Ja", "Nein"], name="answer")
-            if not chat:
-                stance = llm + stance_prompt + select(["Ja", "Nein"], name="answer")
+            stance = self._run_step(
+                llm,
+                chat=chat,
+                prompt=stance_prompt,
+                step="stance",
+                program=get_step_program("yes_no"),
+            )
             if stance["answer"] == "Ja":
                 self.stance = "support"
             if stance["answer"] == "Nein":
@@ -181,12 +410,13 @@ class StanceClassification:
         if log:
             logger.info(f"classified as {self.stance}")
         self.meta = {
-            "llms": {"summary": summary, "irrelevance": irrelevance, "stance": stance}
+            "llms": {"summary": summary, "irrelevance": irrelevance, "stance": stance},
+            "rationale_skipped": self._is_rationale_skipped(classification_only),
         }
         return self
 
     def summarize_v2_irrelevant_stance_chain(
-        self, llm, chat: bool, llm2=None, log=True
+        self, llm, chat: bool, llm2=None, log=True, classification_only=False
     ) -> Self:
         """prompt chain that:
            1. summarises text in relation to the statement (stored in the "meta" attribute of the StanceClassification class object in a dictionary value at the key ["llms"]["summary"])
@@ -199,11 +429,11 @@ class StanceClassification:
             chat (bool): whether llm it is a chat llm or not
             llm2 (optional): A second guidance model backend from guidance.models. Defaults to None.
             log (bool, optional): To log or not. Defaults to True.
+            classification_only (bool, optional): Skip free-text summaries that do not feed into the stance and cap the others. Defaults to False.
 
         Returns:
             StanceClassification class object with new class object attributes: meta and stance. The irrelevance, summary, and stance prompt texts are stored in a dictionary value at the key ["llms"] in a dictionary stored in the "meta" attribute of the StanceClassification object returned: e.g. meta["llms"]["irrelevance"].
         """
-
         if log:
             logger.info(f"Summarizing position of {self.entity}")
         summary_prompt = construct_summary_statementspecific_prompt(
@@ -211,13 +441,15 @@ class StanceClassification:
             entity=self.masked_entity,
             statement=self.statement,
         )
-        if chat:
-            with user():
-                summary = llm + summary_prompt
-            with assistant():
-                summary += gen(name="summary", max_tokens=120)
-        if not chat:
-            summary = llm + summary_prompt + gen(name="summary", max_tokens=80)
+        summary = self._run_step(
+            llm,
+            chat=chat,
+            prompt=summary_prompt,
+            step="summary",
+            program=self._summary_program(
+                chat=chat, classification_only=classification_only
+            ),
+        )
         if log:
             logger.info(
                 f"Basing classification on position summary: {summary['summary']}"
@@ -228,19 +460,13 @@ class StanceClassification:
             entity=self.masked_entity,
             statement=self.statement,
         )
-        if chat:
-            with user():
-                irrelevance = llm + irrelevance_prompt
-            with assistant():
-                irrelevance = irrelevance + select(
-                    list(IRRELEVANCE_ANSWERS.values()), name="answer"
-                )
-        if not chat:
-            irrelevance = (
-                llm
-                + irrelevance_prompt
-                + select(list(IRRELEVANCE_ANSWERS.values()), name="answer")
-            )
+        irrelevance = self._run_step(
+            llm,
+            chat=chat,
+            prompt=irrelevance_prompt,
+            step="irrelevance",
+            program=get_step_program("irrelevance"),
+        )
         if irrelevance["answer"] == IRRELEVANCE_ANSWERS["irrelevant"]:
             self.stance = "irrelevant"
             stance = None
@@ -250,13 +476,13 @@ class StanceClassification:
                 entity=self.masked_entity,
                 statement=self.statement,
             )
-            if chat:
-                with user():
-                    stance = llm + stance_prompt
-                with assistant():
-                    stance = stance + select(["Ja", "Nein"], name="answer")
-            if not chat:
-                stance = llm + stance_prompt + select(["Ja", "Nein"], name="answer")
+            stance = self._run_step(
+                llm,
+                chat=chat,
+                prompt=stance_prompt,
+                step="stance",
+                program=get_step_program("yes_no"),
+            )
             if stance["answer"] == "Ja":
                 self.stance = "support"
             if stance["answer"] == "Nein":
@@ -264,11 +490,14 @@ class StanceClassification:
         if log:
             logger.info(f"classified as {self.stance}")
         self.meta = {
-            "llms": {"summary": summary, "irrelevance": irrelevance, "stance": stance}
+            "llms": {"summary": summary, "irrelevance": irrelevance, "stance": stance},
+            "rationale_skipped": self._is_rationale_skipped(classification_only),
         }
         return self
 
-    def summarize_v2_chain(self, llm, chat: bool, llm2=None, log=True) -> Self:
+    def summarize_v2_chain(
+        self, llm, chat: bool, llm2=None, log=True, classification_only=False
+    ) -> Self:
         """prompt chain that:
            1. summarises text in relation to the statement (stored in the "meta" attribute of the StanceClassification class object in a dictionary value at the key ["llms"]["summary"])
            2. prompts llm directly to classify the detected actor's stance based on the summary, stance class labels to select from: irrelevant, opposition, support
@@ -279,11 +508,11 @@ class StanceClassification:
             chat (bool): whether llm it is a chat llm or not
             llm2 (optional): A second guidance model backend from guidance.models. Defaults to None.
             log (bool, optional): To log or not. Defaults to True.
+            classification_only (bool, optional): Skip free-text summaries that do not feed into the stance and cap the others. Defaults to False.
 
         Returns:
             StanceClassification class object with new class object attributes: meta and stance. The summary prompt text is stored in a dictionary value at the key ["llms"]["summary"] in a dictionary stored in the "meta" attribute of the StanceClassification object returned.
         """
-
         if log:
             logger.info(f"Summarizing position of {self.entity}")
         summary_prompt = construct_summary_statementspecific_prompt(
@@ -291,57 +520,38 @@ class StanceClassification:
             entity=self.masked_entity,
             statement=self.statement,
         )
-        if chat:
-            with user():
-                summary = llm + summary_prompt
-            with assistant():
-                summary += (
-                    f"Die Organisation {self.masked_entity} "
-                    + select(
-                        [
-                            "drückt keine Haltung aus dazu, dass",
-                            "unterstützt, dass",
-                            "lehnt ab, dass",
-                        ],
-                        name="stance",
-                    )
-                    + gen(name="summary", max_tokens=80)
-                )
-        if not chat:
-            summary = (
-                llm
-                + summary_prompt
-                + f"Die Organisation {self.masked_entity} "
-                + select(
-                    [
-                        "drückt keine Haltung aus dazu, dass",
-                        "unterstützt, dass",
-                        "lehnt ab, dass",
-                    ],
-                    name="stance",
-                )
-                + gen(name="summary", max_tokens=80)
-            )
+        summary = self._run_step(
+            llm,
+            chat=chat,
+            prompt=summary_prompt,
+            step="summary",
+            program=self._summary_v2_stance_program(
+                classification_only=classification_only
+            ),
+        )
         if log:
             logger.info(
-                f"Basing classification on position summary: {self.entity} {summary['stance']} {summary['summary']}"
+                f"Basing classification on position summary: {self.entity} {summary['stance']} {summary.get('summary', '')}"
             )
-        if summary["stance"] == "drückt keine Haltung aus dazu, dass":
+        if summary["stance"] == SUMMARY_V2_STANCE_ANSWERS["irrelevant"]:
             self.stance = "irrelevant"
-        if summary["stance"] == "unterstützt, dass":
+        if summary["stance"] == SUMMARY_V2_STANCE_ANSWERS["support"]:
             self.stance = "support"
-        if summary["stance"] == "lehnt ab, dass":
+        if summary["stance"] == SUMMARY_V2_STANCE_ANSWERS["opposition"]:
             self.stance = "opposition"
         if log:
             logger.info(f"classified as {self.stance}")
         self.meta = {
             "llms": {
                 "summary": summary,
-            }
+            },
+            "rationale_skipped": self._is_rationale_skipped(classification_only),
         }
         return self
 
-    def irrelevant_summarize_v2_chain(self, llm, chat, llm2=None, log=True) -> Self:
+    def irrelevant_summarize_v2_chain(
+        self, llm, chat, llm2=None, log=True, classification_only=False
+    ) -> Self:
         """prompt chain that:
            1. classifies whether the detected actor has a stance in the text related to the statement, or not (stored in the "meta" attribute of the StanceClassification class object in a dictionary value at the key ["llms"]["irrelevance"])
            2. if actor has a related stance: continue with 3., if not: stance=irrelevance (saved as a new class attribute called stance)
@@ -353,6 +563,7 @@ class StanceClassification:
             chat (bool): whether llm it is a chat llm or not
             llm2 (optional): A second guidance model backend from guidance.models. Generates the summary and classifies the stance. Defaults to None.
             log (bool, optional): To log or not. Defaults to True.
+            classification_only (bool, optional): Skip free-text summaries that do not feed into the stance and cap the others. Defaults to False.
 
         Returns:
             StanceClassification class object with new class object attributes: meta and stance. The irrelevance and summary prompt texts are stored in a dictionary value at the key ["llms"] in a dictionary stored in the "meta" attribute of the StanceClassification object returned: e.g. meta["llms"]["irrelevance"].
@@ -367,19 +578,13 @@ class StanceClassification:
             entity=self.masked_entity,
             statement=self.statement,
         )
-        if chat:
-            with user():
-                irrelevance = llm + irrelevance_prompt
-            with assistant():
-                irrelevance = irrelevance + select(
-                    list(IRRELEVANCE_ANSWERS.values()), name="answer"
-                )
-        if not chat:
-            irrelevance = (
-                llm
-                + irrelevance_prompt
-                + select(list(IRRELEVANCE_ANSWERS.values()), name="answer")
-            )
+        irrelevance = self._run_step(
+            llm,
+            chat=chat,
+            prompt=irrelevance_prompt,
+            step="irrelevance",
+            program=get_step_program("irrelevance"),
+        )
         if irrelevance["answer"] == IRRELEVANCE_ANSWERS["irrelevant"]:
             self.stance = "irrelevant"
             summary = None
@@ -389,46 +594,24 @@ class StanceClassification:
                 entity=self.masked_entity,
                 statement=self.statement,
             )
-            if chat:
-                with user():
-                    summary = llm2 + summary_prompt
-                with assistant():
-                    summary += (
-                        f"Die Organisation {self.masked_entity} "
-                        + select(
-                            [
-                                "drückt keine Haltung aus dazu, dass",
-                                "unterstützt, dass",
-                                "lehnt ab, dass",
-                            ],
-                            name="stance",
-                        )
-                        + gen(name="summary", max_tokens=80)
-                    )
-            if not chat:
-                summary = (
-                    llm2
-                    + summary_prompt
-                    + f"Die Organisation {self.masked_entity} "
-                    + select(
-                        [
-                            "drückt keine Haltung aus dazu, dass",
-                            "unterstützt, dass",
-                            "lehnt ab, dass",
-                        ],
-                        name="stance",
-                    )
-                    + gen(name="summary", max_tokens=80)
-                )
+            summary = self._run_step(
+                llm2,
+                chat=chat,
+                prompt=summary_prompt,
+                step="summary",
+                program=self._summary_v2_stance_program(
+                    classification_only=classification_only
+                ),
+            )
             if log:
                 logger.info(
-                    f"Basing classification on position summary: {self.entity} {summary['stance']} {summary['summary']}"
+                    f"Basing classification on position summary: {self.entity} {summary['stance']} {summary.get('summary', '')}"
                 )
-            if summary["stance"] == "drückt keine Haltung aus dazu, dass":
+            if summary["stance"] == SUMMARY_V2_STANCE_ANSWERS["irrelevant"]:
                 self.stance = "irrelevant"
-            if summary["stance"] == "unterstützt, dass":
+            if summary["stance"] == SUMMARY_V2_STANCE_ANSWERS["support"]:
                 self.stance = "support"
-            if summary["stance"] == "lehnt ab, dass":
+            if summary["stance"] == SUMMARY_V2_STANCE_ANSWERS["opposition"]:
                 self.stance = "opposition"
         if log:
             logger.info(f"classified as {self.stance}")
@@ -436,11 +619,14 @@ class StanceClassification:
             "llms": {
                 "summary": summary,
                 "irrelevance": irrelevance,
-            }
+            },
+            "rationale_skipped": self._is_rationale_skipped(classification_only),
         }
         return self
 
-    def irrelevant_stance_chain(self, llm, chat: bool, llm2=None, log=True) -> Self:
+    def irrelevant_stance_chain(
+        self, llm, chat: bool, llm2=None, log=True, classification_only=False
+    ) -> Self:
         """prompt chain that:
            1. classifies whether the detected actor has a stance in the text related to the statement, or not (the irrelevance prompt text is stored in a dictionary value at the key ["llms"]["irrelevance"] in the "meta" attribute)
            2. if actor has a related stance: classify stance as support or not support, if no related stance: stance=irrelevant (saves stance prompt in the "meta" attribute at the dictionary key ["llms"]["stance"] and the predicted stance separately in the class attribute "stance")
@@ -452,11 +638,11 @@ class StanceClassification:
             chat (bool): whether llm it is a chat llm or not
             llm2 (optional): A second guidance model backend from guidance.models. Defaults to None.
             log (bool, optional): To log or not. Defaults to True.
+            classification_only (bool, optional): Skip free-text summaries that do not feed into the stance and cap the others. Defaults to False.
 
         Returns:
             StanceClassification class object with new class object attributes: meta and stance. The irrelevance and stance prompt texts are stored in a dictionary value at the key ["llms"] in a dictionary stored in the "meta" attribute of the StanceClassification object returned, e.g. meta["llms"]["stance"]
         """
-
         if log:
             logger.info(
                 f"Analyzing position of {self.entity} regarding statement {self.statement}"
@@ -467,19 +653,13 @@ class StanceClassification:
             entity=self.masked_entity,
             statement=self.statement,
         )
-        if chat:
-            with user():
-                irrelevance = llm + irrelevance_prompt
-            with assistant():
-                irrelevance = irrelevance + select(
-                    list(IRRELEVANCE_ANSWERS.values()), name="answer"
-                )
-        if not chat:
-            irrelevance = (
-                llm
-                + irrelevance_prompt
-                + select(list(IRRELEVANCE_ANSWERS.values()), name="answer")
-            )
+        irrelevance = self._run_step(
+            llm,
+            chat=chat,
+            prompt=irrelevance_prompt,
+            step="irrelevance",
+            program=get_step_program("irrelevance"),
+        )
         if irrelevance["answer"] == IRRELEVANCE_ANSWERS["irrelevant"]:
             self.stance = "irrelevant"
             stance = None
@@ -489,24 +669,27 @@ class StanceClassification:
                 entity=self.masked_entity,
                 statement=self.statement,
             )
-            if chat:
-                with user():
-                    stance = llm + stance_prompt
-                with assistant():
-                    stance = stance + select(["Ja", "Nein"], name="answer")
-            if not chat:
-                stance = llm + stance_prompt + select(["Ja", "Nein"], name="answer")
+            stance = self._run_step(
+                llm,
+                chat=chat,
+                prompt=stance_prompt,
+                step="stance",
+                program=get_step_program("yes_no"),
+            )
             if stance["answer"] == "Ja":
                 self.stance = "support"
             if stance["answer"] == "Nein":
                 self.stance = "opposition"
         if log:
             logger.info(f"classified as {self.stance}")
-        self.meta = {"llms": {"irrelevance": irrelevance, "stance": stance}}
+        self.meta = {
+            "llms": {"irrelevance": irrelevance, "stance": stance},
+            "rationale_skipped": self._is_rationale_skipped(classification_only),
+        }
         return self
 
     def nested_irrelevant_summary_explicit(
-        self, llm, chat: bool, llm2=None, log=True
+        self, llm, chat: bool, llm2=None, log=True, classification_only=False
     ) -> Self:
         """prompt chain that:
            1. checks if there is a (general) stance of the detected actor in the text, if not: stance=irrelevant (stored in the "meta" attribute of the StanceClassification class object in a dictionary value at the key ["llms"]["irrelevance_general"])
@@ -521,6 +704,7 @@ class StanceClassification:
             chat (bool): whether llm it is a chat llm or not
             llm2 (optional): A second guidance model backend from guidance.models. Defaults to None.
             log (bool, optional): To log or not. Defaults to True.
+            classification_only (bool, optional): Skip free-text summaries that do not feed into the stance and cap the others. Defaults to False.
 
         Returns:
             StanceClassification class object with new class object attributes: meta and stance. The irrelevance, summary, and stance prompt texts are stored in a dictionary value at the key ["llms"] in a dictionary stored in the "meta" attribute of the StanceClassification object returned: e.g. meta["llms"]["irrelevance"].
@@ -531,19 +715,13 @@ class StanceClassification:
         general_prompt = construct_general_stance_prompt(
             input_text=self.masked_input_text, entity=self.masked_entity
         )
-        if chat:
-            with user():
-                irrelevance_general = llm + general_prompt
-            with assistant():
-                irrelevance_general = irrelevance_general + select(
-                    list(IRRELEVANCE_ANSWERS2.values()), name="answer_general"
-                )
-        if not chat:
-            irrelevance_general = (
-                llm
-                + general_prompt
-                + select(list(IRRELEVANCE_ANSWERS2.values()), name="answer_general")
-            )
+        irrelevance_general = self._run_step(
+            llm,
+            chat=chat,
+            prompt=general_prompt,
+            step="irrelevance_general",
+            program=get_step_program("general_stance"),
+        )
         if irrelevance_general["answer_general"] == IRRELEVANCE_ANSWERS2["irrelevant"]:
             self.stance = "irrelevant"
             irrelevance = None
@@ -560,19 +738,13 @@ class StanceClassification:
                 entity=self.masked_entity,
                 statement=self.statement,
             )
-            if chat:
-                with user():
-                    irrelevance = llm + irrelevance_prompt
-                with assistant():
-                    irrelevance = irrelevance + select(
-                        list(IRRELEVANCE_ANSWERS.values()), name="answer"
-                    )
-            if not chat:
-                irrelevance = (
-                    llm
-                    + irrelevance_prompt
-                    + select(list(IRRELEVANCE_ANSWERS.values()), name="answer")
-                )
+            irrelevance = self._run_step(
+                llm,
+                chat=chat,
+                prompt=irrelevance_prompt,
+                step="irrelevance",
+                program=get_step_program("irrelevance"),
+            )
             if irrelevance["answer"] == IRRELEVANCE_ANSWERS["irrelevant"]:
                 self.stance = "irrelevant"
                 stance = None
@@ -583,31 +755,32 @@ class StanceClassification:
                 summary_prompt = construct_summary_prompt(
                     input_text=self.masked_input_text, entity=self.masked_entity
                 )
-                if chat:
-                    with user():
-                        summary = llm + summary_prompt
-                    with assistant():
-                        summary += gen(name="summary", max_tokens=120)
-                if not chat:
-                    summary = llm + summary_prompt + gen(name="summary", max_tokens=80)
+                summary = self._run_step(
+                    llm,
+                    chat=chat,
+                    prompt=summary_prompt,
+                    step="summary",
+                    program=self._summary_program(
+                        chat=chat, classification_only=classification_only
+                    ),
+                )
                 if log:
                     logger.info(
                         f"Basing classification on position summary: {summary['summary']}"
                     )
                     logger.info("Checking irrelevance...")
-
                 stance_prompt = construct_support_stance_prompt(
                     input_text=summary["summary"],
                     entity=self.masked_entity,
                     statement=self.statement,
                 )
-                if chat:
-                    with user():
-                        stance = llm + stance_prompt
-                    with assistant():
-                        stance = stance + select(["Ja", "Nein"], name="answer")
-                if not chat:
-                    stance = llm + stance_prompt + select(["Ja", "Nein"], name="answer")
+                stance = self._run_step(
+                    llm,
+                    chat=chat,
+                    prompt=stance_prompt,
+                    step="stance",
+                    program=get_step_program("yes_no"),
+                )
                 if stance["answer"] == "Ja":
                     self.stance = "support"
                 if stance["answer"] == "Nein":
@@ -616,15 +789,13 @@ class StanceClassification:
                         entity=self.masked_entity,
                         statement=self.statement,
                     )
-                    if chat:
-                        with user():
-                            stance = llm + stance_prompt
-                        with assistant():
-                            stance = stance + select(["Ja", "Nein"], name="answer")
-                    if not chat:
-                        stance = (
-                            llm + stance_prompt + select(["Ja", "Nein"], name="answer")
-                        )
+                    stance = self._run_step(
+                        llm,
+                        chat=chat,
+                        prompt=stance_prompt,
+                        step="stance_opposition",
+                        program=get_step_program("yes_no"),
+                    )
                     if stance["answer"] == "Ja":
                         self.stance = "opposition"
                     if stance["answer"] == "Nein":
@@ -637,12 +808,13 @@ class StanceClassification:
                 "irrelevance": irrelevance,
                 "summary": summary,
                 "stance": stance,
-            }
+            },
+            "rationale_skipped": self._is_rationale_skipped(classification_only),
         }
         return self
 
     def nested_irrelevant_summary_v2_explicit(
-        self, llm, chat: bool, llm2=None, log=True
+        self, llm, chat: bool, llm2=None, log=True, classification_only=False
     ) -> Self:
         """prompt chain that:
            1. checks if there is a (general) stance of the detected actor in the text, if not: stance=irrelevant (stored in the "meta" attribute of the StanceClassification class object in a dictionary value at the key ["llms"]["irrelevance_general"])
@@ -657,6 +829,7 @@ class StanceClassification:
             chat (bool): whether llm it is a chat llm or not
             llm2 (optional): A second guidance model backend from guidance.models. Defaults to None.
             log (bool, optional): To log or not. Defaults to True.
+            classification_only (bool, optional): Skip free-text summaries that do not feed into the stance and cap the others. Defaults to False.
 
         Returns:
             StanceClassification class object with new class object attributes: meta and stance. The irrelevance, summary, and stance prompt texts are stored in a dictionary value at the key ["llms"] in the "meta" attribute of the returned StanceClassification object: e.g. meta["llms"]["irrelevance"].
@@ -667,19 +840,13 @@ class StanceClassification:
         general_prompt = construct_general_stance_prompt(
             input_text=self.masked_input_text, entity=self.masked_entity
         )
-        if chat:
-            with user():
-                irrelevance_general = llm + general_prompt
-            with assistant():
-                irrelevance_general = irrelevance_general + select(
-                    list(IRRELEVANCE_ANSWERS2.values()), name="answer_general"
-                )
-        if not chat:
-            irrelevance_general = (
-                llm
-                + general_prompt
-                + select(list(IRRELEVANCE_ANSWERS2.values()), name="answer_general")
-            )
+        irrelevance_general = self._run_step(
+            llm,
+            chat=chat,
+            prompt=general_prompt,
+            step="irrelevance_general",
+            program=get_step_program("general_stance"),
+        )
         if irrelevance_general["answer_general"] == IRRELEVANCE_ANSWERS2["irrelevant"]:
             self.stance = "irrelevant"
             irrelevance = None
@@ -696,19 +863,13 @@ class StanceClassification:
                 entity=self.masked_entity,
                 statement=self.statement,
             )
-            if chat:
-                with user():
-                    irrelevance = llm + irrelevance_prompt
-                with assistant():
-                    irrelevance = irrelevance + select(
-                        list(IRRELEVANCE_ANSWERS.values()), name="answer"
-                    )
-            if not chat:
-                irrelevance = (
-                    llm
-                    + irrelevance_prompt
-                    + select(list(IRRELEVANCE_ANSWERS.values()), name="answer")
-                )
+            irrelevance = self._run_step(
+                llm,
+                chat=chat,
+                prompt=irrelevance_prompt,
+                step="irrelevance",
+                program=get_step_program("irrelevance"),
+            )
             if irrelevance["answer"] == IRRELEVANCE_ANSWERS["irrelevant"]:
                 self.stance = "irrelevant"
                 stance = None
@@ -721,13 +882,15 @@ class StanceClassification:
                     entity=self.masked_entity,
                     statement=self.statement,
                 )
-                if chat:
-                    with user():
-                        summary = llm + summary_prompt
-                    with assistant():
-                        summary += gen(name="summary", max_tokens=120)
-                if not chat:
-                    summary = llm + summary_prompt + gen(name="summary", max_tokens=80)
+                summary = self._run_step(
+                    llm,
+                    chat=chat,
+                    prompt=summary_prompt,
+                    step="summary",
+                    program=self._summary_program(
+                        chat=chat, classification_only=classification_only
+                    ),
+                )
                 if log:
                     logger.info(
                         f"Basing classification on position summary: {summary['summary']}"
@@ -738,13 +901,13 @@ class StanceClassification:
                     entity=self.masked_entity,
                     statement=self.statement,
                 )
-                if chat:
-                    with user():
-                        stance = llm + stance_prompt
-                    with assistant():
-                        stance = stance + select(["Ja", "Nein"], name="answer")
-                if not chat:
-                    stance = llm + stance_prompt + select(["Ja", "Nein"], name="answer")
+                stance = self._run_step(
+                    llm,
+                    chat=chat,
+                    prompt=stance_prompt,
+                    step="stance",
+                    program=get_step_program("yes_no"),
+                )
                 if stance["answer"] == "Ja":
                     self.stance = "support"
                 if stance["answer"] == "Nein":
@@ -753,15 +916,13 @@ class StanceClassification:
                         entity=self.masked_entity,
                         statement=self.statement,
                     )
-                    if chat:
-                        with user():
-                            stance = llm + stance_prompt
-                        with assistant():
-                            stance = stance + select(["Ja", "Nein"], name="answer")
-                    if not chat:
-                        stance = (
-                            llm + stance_prompt + select(["Ja", "Nein"], name="answer")
-                        )
+                    stance = self._run_step(
+                        llm,
+                        chat=chat,
+                        prompt=stance_prompt,
+                        step="stance_opposition",
+                        program=get_step_program("yes_no"),
+                    )
                     if stance["answer"] == "Ja":
                         self.stance = "opposition"
                     if stance["answer"] == "Nein":
@@ -774,6 +935,93 @@ class StanceClassification:
                 "irrelevance": irrelevance,
                 "summary": summary,
                 "stance": stance,
-            }
+            },
+            "rationale_skipped": self._is_rationale_skipped(classification_only),
+        }
+        return self
+
+    def multi_entity_chain(
+        self,
+        llm,
+        chat: bool,
+        entities=None,
+        fallback_chain=MULTI_ENTITY_FALLBACK_CHAIN,
+        llm2=None,
+        log=True,
+        classification_only=False,
+    ) -> Self:
+        """prompt chain that:
+           1. classifies the stances of all entities of the text towards the statement in one grammar-constrained generation, with one line per entity starting with its name and ending with its stance (stored in the "meta" attribute of the StanceClassification class object in a dictionary value at the key ["llms"]["multi_entity"])
+           2. if the stance of the entity cannot be parsed from the generation: classifies the entity with the single-entity chain fallback_chain (its steps are stored at their own keys in ["llms"], e.g. ["llms"]["irrelevance"])
+
+        All entities of a text share the prompt and program of the first step, so with a step cache (see
+        stance_llm.cache.StepCache) the text is sent to the llm once per text and statement instead of once per entity.
+        A masked entity is classified on its own, as the names of the other entities would give it away.
+
+        Args:
+            self: StanceClassification class object, contains: entity, statement, input_text, stance
+            llm: A guidance model backend from guidance.models
+            chat (bool): whether llm is a chat llm or not
+            entities (list, optional): all entities of the text to classify together, including the entity of the classification. Defaults to None (the entity alone).
+            fallback_chain (str, optional): label of the single-entity chain (see SINGLE_ENTITY_CHAIN_METHODS) classifying an entity whose stance cannot be parsed. Defaults to MULTI_ENTITY_FALLBACK_CHAIN.
+            llm2 (optional): A second guidance model backend from guidance.models. Defaults to None.
+            log (bool, optional): To log or not. Defaults to True.
+            classification_only (bool, optional): Skip free-text summaries of the fallback chain that do not feed into the stance and cap the others. Defaults to False.
+
+        Returns:
+            StanceClassification class object with new class object attributes: meta and stance. The number of entities classified together and the fallback chain used, if any, are stored at the key ["multi_entity"] of the "meta" attribute.
+        """
+        if fallback_chain not in SINGLE_ENTITY_CHAIN_METHODS:
+            raise NameError(
+                f"Fallback chain {fallback_chain} is not a single-entity chain. Allowed are {list(SINGLE_ENTITY_CHAIN_METHODS)}"
+            )
+        if self.masked_entity != self.entity or entities is None:
+            entities = [self.masked_entity]
+        # line breaks in names would end the line of an entity early
+        entities = list(dict.fromkeys(" ".join(entity.split()) for entity in entities))
+        entity = " ".join(self.masked_entity.split())
+        if entity not in entities:
+            entities.append(entity)
+        if log:
+            logger.info(
+                f"Analyzing positions of {len(entities)} entities regarding statement {self.statement}"
+            )
+        multi_entity_prompt = construct_multi_entity_prompt(
+            input_text=self.masked_input_text,
+            entities=entities,
+            statement=self.statement,
+        )
+        multi_entity = self._run_step(
+            llm,
+            chat=chat,
+            prompt=multi_entity_prompt,
+            step="multi_entity",
+            program=build_multi_entity_program(entities),
+        )
+        stances = multi_entity.get("stances") or []
+        if isinstance(stances, str):
+            stances = [stances]
+        answers = {answer: stance for stance, answer in MULTI_ENTITY_STANCE_ANSWERS.items()}
+        index = entities.index(entity)
+        self.stance = answers.get(stances[index]) if index < len(stances) else None
+        fallback_llms = {}
+        if self.stance is None:
+            if log:
+                logger.warning(
+                    f"Could not parse the stance of {self.entity} from the joint answer. Falling back to chain {fallback_chain}"
+                )
+            getattr(self, SINGLE_ENTITY_CHAIN_METHODS[fallback_chain])(
+                llm=llm, chat=chat, log=log, classification_only=classification_only
+            )
+            fallback_llms = self.meta["llms"]
+        if log:
+            logger.info(f"classified as {self.stance}")
+        self.meta = {
+            "llms": {"multi_entity": multi_entity} | fallback_llms,
+            "multi_entity": {
+                "entities": len(entities),
+                "fallback_chain": fallback_chain if len(fallback_llms) > 0 else None,
+            },
+            "rationale_skipped": self._is_rationale_skipped(classification_only),
         }
         return self
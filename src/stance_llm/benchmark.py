@@ -0,0 +1,463 @@
+import os
+import time
+
+import numpy as np
+import polars as pl
+from loguru import logger
+
+from stance_llm.base import PROMPT_TEMPLATES, SUMMARY_MAX_TOKENS, get_registered_chains
+from stance_llm.cache import StepCache, get_program_key
+from stance_llm.estimate import get_token_counter
+from stance_llm.metrics import (
+    EVALUATED_STANCES,
+    confusion_matrices,
+    encode_stances,
+    metrics_from_confusion,
+)
+from stance_llm.process import detect_stance
+from stance_llm.programs import build_step_program, get_step_program
+from stance_llm.writers import write_json_atomic
+
+
+def get_step_prompt(step_record: dict) -> str:
+    """returns the prompt text of a chain step recorded in the "steps" attribute of a StanceClassification"""
+    if step_record["template"] in PROMPT_TEMPLATES:
+        return str(PROMPT_TEMPLATES[step_record["template"]](**step_record["params"]))
+    return step_record["params"].get("prompt", "")
+
+
+def pareto_frontier(table: pl.DataFrame, cost_column="cost", metric="macro_f1") -> pl.DataFrame:
+    """marks the rows of a benchmark table that no other row beats in both cost and metric
+
+    Args:
+        table: benchmark table as returned by run_benchmark()
+        cost_column (str, optional): column to minimize. Defaults to "cost".
+        metric (str, optional): column to maximize. Defaults to "macro_f1".
+
+    Returns:
+        pl.DataFrame: the table sorted by cost_column with a boolean column "pareto"
+    """
+    table = table.sort([cost_column, metric], descending=[False, True])
+    pareto = []
+    best = -np.inf
+    for value in table[metric]:
+        # rows are sorted by cost, so a row is dominated unless it beats all cheaper rows
+        pareto.append(bool(value > best))
+        best = max(best, value)
+    return table.with_columns(pl.Series("pareto", pareto))
+
+
+def cheapest_meeting_target(table: pl.DataFrame, target: float, cost_column="cost", metric="macro_f1"):
+    """returns the cheapest row of a benchmark table reaching a target value of a metric, or None
+
+    Args:
+        table: benchmark table as returned by run_benchmark()
+        target (float): minimal value of metric
+        cost_column (str, optional): column to minimize. Defaults to "cost".
+        metric (str, optional): column of the target. Defaults to "macro_f1".
+    """
+    meeting = table.filter(pl.col(metric) >= target).sort([cost_column, metric], descending=[False, True])
+    if meeting.height == 0:
+        return None
+    return meeting.row(0, named=True)
+
+
+def run_benchmark(
+    egs: list,
+    llms,
+    chains=None,
+    chat=True,
+    export_folder=None,
+    costs=None,
+    tokenizer=None,
+    share_steps=True,
+    cache_folder=None,
+    entity_mask=None,
+    classification_only=False,
+    target=None,
+) -> pl.DataFrame:
+    """runs several chains and models over a labeled dataset and reports accuracy against cost
+
+    Every chain is run on every example with every model. Per chain and model, macro F1 and accuracy, the number of
+    llm calls, input and output tokens, the median and 95th percentile of the latency per example and the cost are
+    recorded. With share_steps, steps that several chains have in common (same model, prompt and program) are sent
+    to the llm only once (see stance_llm.cache.StepCache). Calls, tokens, latencies and costs are still reported as
+    if each chain had run on its own, so that they reflect the chain in production; "cached_calls" counts the calls
+    saved by the benchmark. Tokens are counted on the prompt and answer texts of the steps, without chat role tags.
+
+    Args:
+        egs (list): examples with "text", "ent_text", "statement" and "stance_true" keys
+        llms: A guidance model backend, or a dictionary mapping model labels to backends
+        chains (list, optional): chain labels to benchmark. Defaults to None (all of stance_llm.base.get_registered_chains()).
+        chat (bool, optional): whether the llms are chat llms. Defaults to True.
+        export_folder (optional): folder to write benchmark.csv, benchmark.json and the Pareto report pareto.md to. Defaults to None.
+        costs (dict, optional): dictionary mapping model labels to (input_cost_per_1k, output_cost_per_1k) token prices. Defaults to None (no costs; the Pareto frontier is computed over tokens).
+        tokenizer (optional): callable taking a string and returning a list of tokens, used instead of the tokenizer of the llms. Defaults to None.
+        share_steps (bool, optional): answer steps shared between chains from a cache. Defaults to True.
+        cache_folder (optional): folder to keep one SQLite step cache per model in, reused by later benchmarks. Defaults to None (in memory).
+        entity_mask (optional): string masking the entity in all prompts. Defaults to None.
+        classification_only (bool, optional): skip free-text summaries not needed for the stance (see stance_llm.process.detect_stance()). Defaults to False.
+        target (float, optional): macro F1 the chain should reach. The cheapest chain reaching it is named in the report. Defaults to None.
+
+    Returns:
+        pl.DataFrame: one row per model and chain, sorted by cost, with a "pareto" column marking the chains on the frontier of cost and macro F1
+    """
+    if not isinstance(llms, dict):
+        llms = {"model": llms}
+    if chains is None:
+        chains = get_registered_chains()
+    costs = costs or {}
+    cost_column = "cost" if len(costs) > 0 else "total_tokens"
+    y_true = encode_stances([eg["stance_true"] for eg in egs])
+    rows = []
+    for model_label, llm in llms.items():
+        step_cache = None
+        if share_steps:
+            cache_path = None
+            if cache_folder is not None:
+                os.makedirs(cache_folder, exist_ok=True)
+                cache_path = os.path.join(cache_folder, f"{model_label}.sqlite")
+            step_cache = StepCache(cache_path)
+        count_tokens = get_token_counter(llm, tokenizer=tokenizer)
+        input_cost_per_1k, output_cost_per_1k = costs.get(model_label, (0.0, 0.0))
+        for chain in chains:
+            logger.info(f"Benchmarking chain {chain} with model {model_label} on {len(egs)} examples")
+            preds = []
+            latencies = []
+            counts = {"llm_calls": 0, "cached_calls": 0, "input_tokens": 0, "output_tokens": 0}
+            for eg in egs:
+                try:
+                    classification = detect_stance(
+                        eg,
+                        llm=llm,
+                        chain_label=chain,
+                        chat=chat,
+                        entity_mask=entity_mask,
+                        classification_only=classification_only,
+                        step_cache=step_cache,
+                    )
+                except Exception as error:
+                    logger.error(f"Chain {chain} failed on an example with {type(error).__name__}: {error}")
+                    preds.append("error")
+                    continue
+                preds.append(classification.stance)
+                latencies.append(sum(step["seconds"] for step in classification.steps.values()))
+                for step in classification.steps.values():
+                    counts["llm_calls"] += 1
+                    counts["cached_calls"] += step["cached"]
+                    counts["input_tokens"] += count_tokens(get_step_prompt(step))
+                    counts["output_tokens"] += sum(
+                        count_tokens(str(output)) for output in step["outputs"].values()
+                    )
+            metrics = metrics_from_confusion(
+                confusion_matrices(y_true, encode_stances(preds), n_classes=len(EVALUATED_STANCES))
+            )
+            cost = (
+                counts["input_tokens"] / 1000 * input_cost_per_1k
+                + counts["output_tokens"] / 1000 * output_cost_per_1k
+            )
+            rows.append(
+                {
+                    "model": model_label,
+                    "chain": chain,
+                    "n": len(egs),
+                    "error_count": preds.count("error"),
+                    "macro_f1": float(metrics["macro_f1"][0]),
+                    "accuracy": float(metrics["accuracy"][0]),
+                }
+                | counts
+                | {
+                    "total_tokens": counts["input_tokens"] + counts["output_tokens"],
+                    "latency_p50": float(np.percentile(latencies, 50)) if latencies else None,
+                    "latency_p95": float(np.percentile(latencies, 95)) if latencies else None,
+                    "cost": cost,
+                    "cost_per_example": cost / len(egs) if len(egs) > 0 else 0.0,
+                }
+            )
+        if step_cache is not None:
+            logger.info(f"Step cache of model {model_label}: {step_cache.get_stats()}")
+            step_cache.close()
+    table = pareto_frontier(pl.DataFrame(rows), cost_column=cost_column)
+    if export_folder is not None:
+        write_benchmark(table, export_folder, cost_column=cost_column, target=target)
+    return table
+
+
+def format_pareto_report(table: pl.DataFrame, cost_column="cost", target=None) -> str:
+    """returns a Markdown report of a benchmark table with its Pareto frontier of cost and macro F1
+
+    Args:
+        table: benchmark table as returned by run_benchmark()
+        cost_column (str, optional): column the frontier was computed over. Defaults to "cost".
+        target (float, optional): macro F1 target. Defaults to None.
+    """
+    columns = ["model", "chain", "macro_f1", "accuracy", "llm_calls", "input_tokens", "output_tokens", "latency_p50", "latency_p95", "cost"]
+
+    def format_value(value):
+        if isinstance(value, float):
+            return f"{value:.4g}"
+        return str(value)
+
+    def format_table(rows: pl.DataFrame) -> list:
+        lines = ["| " + " | ".join(columns) + " |", "|" + "---|" * len(columns)]
+        for row in rows.iter_rows(named=True):
+            lines.append("| " + " | ".join(format_value(row[column]) for column in columns) + " |")
+        return lines
+
+    lines = ["# Chain benchmark", ""]
+    lines += [f"Pareto frontier of {cost_column} and macro F1 (no other chain is both cheaper and better):", ""]
+    lines += format_table(table.filter(pl.col("pareto")))
+    if target is not None:
+        best = cheapest_meeting_target(table, target, cost_column=cost_column)
+        lines.append("")
+        if best is None:
+            lines.append(f"No chain reaches a macro F1 of {target}.")
+        else:
+            lines.append(
+                f"Cheapest chain reaching a macro F1 of {target}: {best['chain']} with model {best['model']} (macro F1 {best['macro_f1']:.4g}, {cost_column} {format_value(best[cost_column])})."
+            )
+    lines += ["", "## All chains", ""]
+    lines += format_table(table)
+    return "\n".join(lines) + "\n"
+
+
+def write_benchmark(table: pl.DataFrame, export_folder: str, cost_column="cost", target=None) -> None:
+    """writes a benchmark table to benchmark.csv and benchmark.json and its Pareto report to pareto.md
+
+    Args:
+        table: benchmark table as returned by run_benchmark()
+        export_folder: folder to write to
+        cost_column (str, optional): column the frontier was computed over. Defaults to "cost".
+        target (float, optional): macro F1 target named in the report. Defaults to None.
+    """
+    os.makedirs(export_folder, exist_ok=True)
+    logger.info(f"Saving benchmark of {table.height} chains to {export_folder}")
+    table.write_csv(os.path.join(export_folder, "benchmark.csv"))
+    write_json_atomic(
+        os.path.join(export_folder, "benchmark.json"),
+        {"cost_column": cost_column, "target": target, "chains": table.to_dicts()},
+    )
+    with open(os.path.join(export_folder, "pareto.md"), "w", encoding="utf8") as f:
+        f.write(format_pareto_report(table, cost_column=cost_column, target=target))
+
+
+def measure_program_overhead(llm=None, egs=None, chain_label="is", chat=False, n_calls=1000) -> dict:
+    """micro-benchmark of the Python overhead per chain step saved by reusing precompiled step programs
+
+    Times preparing the guidance program of a step, cycling through the programs of the chains, when the program is
+    built for every call (as chains did before stance_llm.programs) and when the precompiled program is reused. With
+    a step cache, building also includes describing the grammar for the cache key. If an llm and examples are given,
+    the mean duration of a step of the chain is measured as well, to relate the overhead to a (fast, local) backend.
+
+    Args:
+        llm (optional): guidance model backend, e.g. guidance.models.Mock() or a small local model. Defaults to None.
+        egs (list, optional): examples to run chain_label on with llm. Defaults to None.
+        chain_label (str, optional): chain to time steps of. Defaults to "is".
+        chat (bool, optional): whether llm is a chat llm. Defaults to False.
+        n_calls (int, optional): number of programs prepared per variant. Defaults to 1000.
+
+    Returns:
+        dict: microseconds per step for "rebuild", "rebuild_keyed" (with step cache key), "reuse" and "reuse_keyed", the "saved" microseconds with a step cache and, with llm and egs, the mean "step" duration and the "saved_share" of it
+    """
+    programs = [
+        ("irrelevance", {}),
+        ("yes_no", {}),
+        ("general_stance", {}),
+        ("summary", {"max_tokens": SUMMARY_MAX_TOKENS[chat]}),
+        ("summary_v2_stance_summary", {}),
+    ]
+
+    def time_calls(prepare) -> float:
+        start = time.perf_counter()
+        for i in range(n_calls):
+            name, params = programs[i % len(programs)]
+            prepare(name, params)
+        return (time.perf_counter() - start) / n_calls * 1e6
+
+    result = {
+        "rebuild": time_calls(lambda name, params: build_step_program(name, **params)),
+        "rebuild_keyed": time_calls(
+            lambda name, params: get_program_key(build_step_program(name, **params))
+        ),
+        "reuse": time_calls(lambda name, params: get_step_program(name, **params)),
+        "reuse_keyed": time_calls(lambda name, params: get_step_program(name, **params).key),
+    }
+    result["saved"] = result["rebuild_keyed"] - result["reuse_keyed"]
+    if llm is not None and egs:
+        step_seconds = []
+        for eg in egs:
+            classification = detect_stance(eg, llm=llm, chain_label=chain_label, chat=chat)
+            step_seconds += [step["seconds"] for step in classification.steps.values()]
+        result["step"] = float(np.mean(step_seconds)) * 1e6
+        result["saved_share"] = result["saved"] / (result["step"] + result["saved"])
+    return result
+
+
+def measure_throughput(
+    egs: list,
+    llms: dict,
+    chains=None,
+    chat=False,
+    classification_only=False,
+    baseline=None,
+    export_folder=None,
+) -> pl.DataFrame:
+    """measures the throughput of chains with several model backends on the same hardware
+
+    Every chain is run on every example with every backend, one example after the other and without step cache,
+    timing the wall clock time of the whole chain. Used to compare backends for the same model, e.g. a quantized
+    GGUF model with llama.cpp against guidance.models.Transformers on CPU nodes (see stance_llm.backends).
+
+    Args:
+        egs (list): examples with "text", "ent_text" and "statement" keys
+        llms (dict): dictionary mapping backend labels to guidance model backends
+        chains (list, optional): chain labels to run. Defaults to None (all of stance_llm.base.get_registered_chains()).
+        chat (bool, optional): whether the backends are chat llms. Defaults to False.
+        classification_only (bool, optional): skip free-text summaries not needed for the stance (see stance_llm.process.detect_stance()). Defaults to False.
+        baseline (str, optional): label of the backend the "speedup" of the others is relative to. Defaults to None.
+        export_folder (optional): folder to write throughput.csv to. Defaults to None.
+
+    Returns:
+        pl.DataFrame: one row per backend and chain with examples and llm calls per second and the median latency per example
+    """
+    if chains is None:
+        chains = get_registered_chains()
+    rows = []
+    for model_label, llm in llms.items():
+        for chain in chains:
+            logger.info(f"Measuring throughput of chain {chain} with {model_label} on {len(egs)} examples")
+            latencies = []
+            counts = {"error_count": 0, "llm_calls": 0}
+            start = time.perf_counter()
+            for eg in egs:
+                eg_start = time.perf_counter()
+                try:
+                    classification = detect_stance(
+                        eg,
+                        llm=llm,
+                        chain_label=chain,
+                        chat=chat,
+                        classification_only=classification_only,
+                    )
+                except Exception as error:
+                    logger.error(f"Chain {chain} failed on an example with {type(error).__name__}: {error}")
+                    counts["error_count"] += 1
+                    continue
+                latencies.append(time.perf_counter() - eg_start)
+                counts["llm_calls"] += len(classification.steps)
+            seconds = time.perf_counter() - start
+            rows.append(
+                {"model": model_label, "chain": chain, "n": len(egs), "seconds": seconds}
+                | counts
+                | {
+                    "egs_per_second": len(egs) / seconds if seconds > 0 else None,
+                    "calls_per_second": counts["llm_calls"] / seconds if seconds > 0 else None,
+                    "latency_p50": float(np.percentile(latencies, 50)) if latencies else None,
+                }
+            )
+    table = pl.DataFrame(rows)
+    if baseline is not None:
+        baseline_rates = table.filter(pl.col("model") == baseline).select(
+            "chain", pl.col("egs_per_second").alias("baseline_egs_per_second")
+        )
+        table = table.join(baseline_rates, on="chain", how="left").with_columns(
+            (pl.col("egs_per_second") / pl.col("baseline_egs_per_second")).alias("speedup")
+        ).drop("baseline_egs_per_second")
+    if export_folder is not None:
+        os.makedirs(export_folder, exist_ok=True)
+        table.write_csv(os.path.join(export_folder, "throughput.csv"))
+    return table
+
+
+def compare_multi_entity(
+    egs: list,
+    llm,
+    chains=None,
+    chat=True,
+    tokenizer=None,
+    classification_only=False,
+    export_folder=None,
+) -> pl.DataFrame:
+    """compares the multi-entity chain "me" with single-entity chains in accuracy and tokens sent to the llm
+
+    Each chain runs on all examples with a step cache of its own, so that the entities of a text share the joint
+    step of "me" as in a run (see stance_llm.process.process()). Unlike run_benchmark(), only the steps actually
+    sent to the llm are counted. Macro F1 and accuracy are computed against "stance_true" if all examples have it,
+    and "agreement" is the share of examples with the same stance as the first single-entity chain.
+
+    Args:
+        egs (list): examples with "text", "ent_text" and "statement" keys, and optionally "stance_true"
+        llm: A guidance model backend from guidance.models
+        chains (list, optional): single-entity chain labels to compare with. Defaults to None (["is"]).
+        chat (bool, optional): whether llm is a chat llm. Defaults to True.
+        tokenizer (optional): callable taking a string and returning a list of tokens, used instead of the tokenizer of llm. Defaults to None.
+        classification_only (bool, optional): skip free-text summaries not needed for the stance (see stance_llm.process.detect_stance()). Defaults to False.
+        export_folder (optional): folder to write multi_entity.csv to. Defaults to None.
+
+    Returns:
+        pl.DataFrame: one row per chain with llm calls, tokens, the share of tokens saved relative to the first single-entity chain, the examples classified by the fallback chain of "me", and the metrics
+    """
+    from stance_llm.schedule import group_entities
+
+    if chains is None:
+        chains = ["is"]
+    count_tokens = get_token_counter(llm, tokenizer=tokenizer)
+    grouped_egs = list(group_entities([dict(eg) for eg in egs], window=None))
+    labeled = len(egs) > 0 and all("stance_true" in eg for eg in egs)
+    preds = {}
+    rows = []
+    for chain in list(chains) + ["me"]:
+        logger.info(f"Running chain {chain} on {len(egs)} examples")
+        step_cache = StepCache()
+        preds[chain] = []
+        counts = {"llm_calls": 0, "input_tokens": 0, "output_tokens": 0, "fallback_count": 0}
+        for eg in grouped_egs:
+            try:
+                classification = detect_stance(
+                    eg,
+                    llm=llm,
+                    chain_label=chain,
+                    chat=chat,
+                    classification_only=classification_only,
+                    step_cache=step_cache,
+                )
+            except Exception as error:
+                logger.error(f"Chain {chain} failed on an example with {type(error).__name__}: {error}")
+                preds[chain].append("error")
+                continue
+            preds[chain].append(classification.stance)
+            if chain == "me" and classification.meta["multi_entity"]["fallback_chain"] is not None:
+                counts["fallback_count"] += 1
+            for step in classification.steps.values():
+                if step["cached"]:
+                    continue
+                counts["llm_calls"] += 1
+                counts["input_tokens"] += count_tokens(get_step_prompt(step))
+                # the joint step of "me" captures a list of stances
+                counts["output_tokens"] += sum(
+                    count_tokens(" ".join(output) if isinstance(output, list) else str(output))
+                    for output in step["outputs"].values()
+                )
+        row = {"chain": chain, "n": len(egs), "error_count": preds[chain].count("error")} | counts
+        row["total_tokens"] = counts["input_tokens"] + counts["output_tokens"]
+        if labeled:
+            metrics = metrics_from_confusion(
+                confusion_matrices(
+                    encode_stances([eg["stance_true"] for eg in egs]),
+                    encode_stances(preds[chain]),
+                    n_classes=len(EVALUATED_STANCES),
+                )
+            )
+            row["macro_f1"] = float(metrics["macro_f1"][0])
+            row["accuracy"] = float(metrics["accuracy"][0])
+        agreement = [pred == baseline for pred, baseline in zip(preds[chain], preds[chains[0]])]
+        row["agreement"] = float(np.mean(agreement)) if len(agreement) > 0 else None
+        rows.append(row)
+    table = pl.DataFrame(rows)
+    baseline_tokens = table["total_tokens"][0]
+    if baseline_tokens > 0:
+        table = table.with_columns((1 - pl.col("total_tokens") / baseline_tokens).alias("tokens_saved"))
+    if export_folder is not None:
+        os.makedirs(export_folder, exist_ok=True)
+        table.write_csv(os.path.join(export_folder, "multi_entity.csv"))
+    return table
@@ -0,0 +1,186 @@
+import hashlib
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+from loguru import logger
+
+
+def get_program_key(program, _seen=None) -> str:
+    """returns a description of a guidance grammar that is equal for equal grammars
+
+    guidance grammars are compared by object identity, so the structure of the grammar (node types, literals,
+    capture names and token limits) is described recursively instead.
+
+    Args:
+        program: guidance grammar (e.g. select() or gen()) or literal string
+    """
+    if _seen is None:
+        _seen = {}
+    if program is None or isinstance(program, (str, bytes, int, float)):
+        return repr(program)
+    if id(program) in _seen:
+        # grammars may be recursive
+        return f"#{_seen[id(program)]}"
+    _seen[id(program)] = len(_seen)
+    parts = [type(program).__name__]
+    for attr in ["capture_name", "max_tokens", "byte", "byte_range", "hidden", "commit_point", "temperature"]:
+        if hasattr(program, attr):
+            parts.append(f"{attr}={getattr(program, attr)!r}")
+    values = getattr(program, "values", None)
+    if values is not None:
+        parts.append("[" + ",".join(get_program_key(value, _seen) for value in values) + "]")
+    return "(" + " ".join(parts) + ")"
+
+
+def get_model_id(llm):
+    """returns a string identifying the model of a guidance backend, or None if it cannot be identified
+
+    Remote models are identified by their model name, Transformers models by the Hugging Face id or path they were
+    loaded from and LlamaCpp models by the path of their model file. guidance mock models have no weights and are
+    identified by their class.
+
+    Args:
+        llm: A guidance model backend from guidance.models
+    """
+    model_id = getattr(llm, "model_name", None)
+    model_obj = getattr(llm, "model_obj", None)
+    if not model_id:
+        # Transformers models, loaded from a Hugging Face id or a local folder
+        model_id = getattr(model_obj, "name_or_path", None)
+    if not model_id:
+        # LlamaCpp models, loaded from a GGUF file
+        model_id = getattr(model_obj, "model_path", None)
+    if not model_id and type(llm).__name__ in ["Mock", "MockChat"]:
+        model_id = "mock"
+    if not model_id:
+        return None
+    return f"{type(llm).__name__}:{model_id}"
+
+
+class CachedStep(dict):
+    """Answers of a chain step restored from a StepCache, used in place of the guidance model state of the step.
+
+    Captured answers and their log probabilities are accessed like on a guidance model state (e.g. step["answer"],
+    step.log_prob("answer")), and str() returns the text of the original model state.
+    """
+
+    def __init__(self, outputs: dict, text: str, log_probs=None):
+        super().__init__(outputs)
+        self.text = text
+        self.log_probs = log_probs or {}
+
+    def __str__(self):
+        return self.text
+
+    def log_prob(self, name: str) -> float:
+        return self.log_probs[name]
+
+
+class StepCache:
+    """Cache of the answers of chain steps, keyed by model, chat variant, prompt text and guidance program.
+
+    Chains sharing a step with the same prompt and program (e.g. the irrelevance step of "is" and "nise") call the
+    llm only once. Each entry keeps the duration of the original call, so that latencies of cached steps can still be
+    reported. Entries live in memory and, if a path is given, in a SQLite file reused across runs. Models are told
+    apart by their class and model id (see get_model_id()). Steps of models that cannot be identified are not
+    cached, so that the answers of one model are never replayed for another. The cache can be shared
+    between threads, and threads running the same step at once can claim its key, so that only one calls the llm.
+
+    Attributes:
+        path (str): path of the SQLite file, or None for an in-memory cache
+        max_entries (int): number of entries kept in memory, dropping the oldest first, or None for no limit
+        hits (int): number of steps answered from the cache
+        misses (int): number of steps not found in the cache
+    """
+
+    filename = "step_cache.sqlite"
+
+    def __init__(self, path=None, max_entries=None):
+        self.path = path
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries = {}
+        self._claims = {}
+        self._unidentified = set()
+        self._lock = threading.Lock()
+        self._connection = None
+        if path is not None:
+            if os.path.isdir(path):
+                self.path = os.path.join(path, self.filename)
+            self._connection = sqlite3.connect(self.path, check_same_thread=False)
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS steps (key TEXT PRIMARY KEY, entry TEXT NOT NULL)"
+            )
+            self._connection.commit()
+
+    def make_key(self, llm, chat: bool, prompt: str, program):
+        """returns the cache key of a chain step, or None if the model of llm cannot be identified"""
+        from stance_llm.programs import StepProgram
+
+        model = get_model_id(llm)
+        if model is None:
+            if type(llm).__name__ not in self._unidentified:
+                self._unidentified.add(type(llm).__name__)
+                logger.warning(
+                    f"Cannot identify the model of the {type(llm).__name__} backend. Its steps are not cached"
+                )
+            return None
+        program_key = program.key if isinstance(program, StepProgram) else get_program_key(program)
+        key = "\x1f".join([model, str(chat), str(prompt), program_key])
+        return hashlib.sha256(key.encode("utf8")).hexdigest()
+
+    @contextmanager
+    def claim(self, key: str):
+        """holds the key of a step while it runs, so that other threads running the same step wait for its entry"""
+        with self._lock:
+            claim = self._claims.setdefault(key, threading.Lock())
+        with claim:
+            yield
+        with self._lock:
+            if self._claims.get(key) is claim:
+                del self._claims[key]
+
+    def get(self, key: str):
+        """returns the cached entry of a step ("outputs", "log_probs", "text", "seconds"), or None"""
+        import srsly
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None and self._connection is not None:
+                row = self._connection.execute(
+                    "SELECT entry FROM steps WHERE key = ?", (key,)
+                ).fetchone()
+                if row is not None:
+                    entry = srsly.json_loads(row[0])
+                    self._entries[key] = entry
+            if entry is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return entry
+
+    def put(self, key: str, entry: dict) -> None:
+        """stores the entry of a step"""
+        import srsly
+
+        with self._lock:
+            self._entries[key] = entry
+            if self.max_entries is not None and len(self._entries) > self.max_entries:
+                # dictionaries keep insertion order, so the first entry is the oldest
+                del self._entries[next(iter(self._entries))]
+            if self._connection is not None:
+                self._connection.execute(
+                    "INSERT OR REPLACE INTO steps (key, entry) VALUES (?, ?)",
+                    (key, srsly.json_dumps(entry)),
+                )
+                self._connection.commit()
+
+    def get_stats(self) -> dict:
+        return {"hits": self.hits, "misses": self.misses, "entries": len(self._entries)}
+
+    def close(self) -> None:
+        if self._connection is not None:
+            self._connection.close()
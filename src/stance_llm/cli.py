@@ -0,0 +1,324 @@
+import argparse
+import os
+import sys
+import time
+
+from loguru import logger
+
+from stance_llm.backends import (
+    get_backend_chat,
+    get_backend_label,
+    load_backend,
+    parse_backend_spec,
+)
+
+# keys of a run config and their defaults. input, chain and backend are required
+CONFIG_DEFAULTS = {
+    "input": None,
+    "chain": None,
+    "backend": None,
+    "export_folder": "./runs",
+    "model_used": None,
+    "chat": None,
+    "entity_mask": None,
+    "id_key": None,
+    "true_stance_key": None,
+    "classification_only": False,
+    "workers": 1,
+    "processes": 1,
+    "backend_copies": None,
+    "queue_size": 64,
+    "wait_time": 0.0,
+    "requests_per_minute": None,
+    "tokens_per_minute": None,
+    "timeout": None,
+    "step_timeout": None,
+    "cache_dir": None,
+    "output_format": "jsonl",
+    "compression": None,
+    "row_group_size": 10000,
+    "prompt_history": "full",
+    "run_alias": None,
+    "resume": False,
+    "evaluate": False,
+    "schedule": False,
+}
+
+REQUIRED_CONFIG_KEYS = ["input", "chain", "backend"]
+
+# backend types whose models run locally, loaded once instead of once per worker
+LOCAL_BACKEND_TYPES = ["transformers", "llamacpp", "mock"]
+
+
+def load_config(path: str) -> dict:
+    """reads a run config from a .json, .yaml, .yml or .toml file and fills in the defaults of CONFIG_DEFAULTS
+
+    Args:
+        path: path of the config file
+    """
+    import srsly
+
+    extension = os.path.splitext(path)[1]
+    if extension == ".json":
+        config = srsly.read_json(path)
+    elif extension in [".yaml", ".yml"]:
+        config = srsly.read_yaml(path)
+    elif extension == ".toml":
+        try:
+            import tomllib
+        except ImportError:
+            raise ValueError("Reading .toml configs requires Python 3.11 or later")
+        with open(path, "rb") as f:
+            config = tomllib.load(f)
+    else:
+        raise ValueError(f"Unsupported config format {extension}. Use .json, .yaml or .toml")
+    return validate_config(config)
+
+
+def validate_config(config: dict) -> dict:
+    """checks the keys of a run config and returns it with the defaults of CONFIG_DEFAULTS filled in
+
+    Args:
+        config: run config
+    """
+    from stance_llm.base import get_registered_chains
+
+    unknown = [key for key in config if key not in CONFIG_DEFAULTS]
+    if len(unknown) > 0:
+        raise ValueError(f"Unknown config keys {unknown}. Allowed are {list(CONFIG_DEFAULTS)}")
+    missing = [key for key in REQUIRED_CONFIG_KEYS if config.get(key) is None]
+    if len(missing) > 0:
+        raise ValueError(f"Missing config keys {missing}")
+    if config["chain"] not in get_registered_chains():
+        raise ValueError(
+            f"Chain {config['chain']} is not registered. Use one of {get_registered_chains()}"
+        )
+    config = CONFIG_DEFAULTS | config
+    parse_backend_spec(config["backend"])
+    if config["model_used"] is None:
+        config["model_used"] = get_backend_label(config["backend"])
+    if config["chat"] is None:
+        config["chat"] = get_backend_chat(config["backend"])
+    if config["evaluate"] and config["true_stance_key"] is None:
+        config["true_stance_key"] = "stance_true"
+    return config
+
+
+def get_config_run_alias(config: dict) -> str:
+    """returns the run alias of a config: its "run_alias", or for resumable runs an alias derived from the config,
+    so that running the same config again resumes the same run
+
+    Args:
+        config: run config (see validate_config())
+    """
+    import srsly
+    from stance_llm.process import make_new_run_alias, make_run_alias
+
+    if config["run_alias"] is not None:
+        return config["run_alias"]
+    if config["resume"]:
+        fixed = {key: value for key, value in config.items() if key not in ["resume", "workers"]}
+        return make_run_alias(seed=srsly.json_dumps(fixed, sort_keys=True))
+    return make_new_run_alias(config["export_folder"], config["model_used"], [config["chain"]])
+
+
+def run_shard(config: dict, run_alias: str, shard_index=0, n_shards=1, progress_queue=None) -> str:
+    """classifies the examples of a config, or every n_shards-th example starting at shard_index, as one run
+
+    Args:
+        config: run config (see validate_config())
+        run_alias: name of the run
+        shard_index (int, optional): index of the shard of examples. Defaults to 0.
+        n_shards (int, optional): number of shards the examples are split into, one per process. Defaults to 1.
+        progress_queue (optional): multiprocessing queue receiving a 1 for every classified example, instead of showing a progress bar. Defaults to None.
+
+    Returns:
+        str: the folder of the run
+    """
+    from stance_llm.cache import StepCache
+    from stance_llm.process import (
+        evaluate,
+        find_run_folder,
+        process,
+        save_evaluations_json,
+    )
+    from stance_llm.readers import read_classifications, read_egs
+    from stance_llm.schedule import ExampleScheduler
+    from stance_llm.writers import write_json_atomic
+
+    n_copies = config["backend_copies"]
+    if n_copies is None:
+        backend_type = parse_backend_spec(config["backend"])["type"]
+        n_copies = 1 if backend_type in LOCAL_BACKEND_TYPES else config["workers"]
+    llms = [load_backend(config["backend"]) for _ in range(n_copies)]
+    egs = config["input"]
+    if n_shards > 1:
+        egs = (eg for i, eg in enumerate(read_egs(config["input"])) if i % n_shards == shard_index)
+    step_cache = None
+    if config["cache_dir"] is not None:
+        os.makedirs(config["cache_dir"], exist_ok=True)
+        step_cache = StepCache(os.path.join(config["cache_dir"], f"{config['model_used']}.sqlite"))
+    rate_limits = {}
+    for key in ["requests_per_minute", "tokens_per_minute"]:
+        if config[key] is not None:
+            # processes do not share a rate limiter, so each gets its share of the limits
+            rate_limits[key] = config[key] / n_shards
+    process(
+        egs=egs,
+        llm=llms,
+        export_folder=config["export_folder"],
+        model_used=config["model_used"],
+        chain_used=config["chain"],
+        true_stance_key=config["true_stance_key"],
+        wait_time=config["wait_time"],
+        stream_out=True,
+        id_key=config["id_key"],
+        chat=config["chat"],
+        entity_mask=config["entity_mask"],
+        classification_only=config["classification_only"],
+        timeout=config["timeout"],
+        step_timeout=config["step_timeout"],
+        workers=config["workers"],
+        queue_size=config["queue_size"],
+        collect=False,
+        run_alias=run_alias,
+        output_format=config["output_format"],
+        row_group_size=config["row_group_size"],
+        prompt_history=config["prompt_history"],
+        compression=config["compression"],
+        on_classified=None if progress_queue is None else lambda eg: progress_queue.put(1),
+        step_cache=step_cache,
+        resume=config["resume"],
+        show_progress=progress_queue is None,
+        scheduler=ExampleScheduler() if config["schedule"] else None,
+        **rate_limits,
+    )
+    if step_cache is not None:
+        step_cache.close()
+    run_folder = find_run_folder(
+        export_folder=config["export_folder"],
+        model_used=config["model_used"],
+        chain_used=config["chain"],
+        run_alias=run_alias,
+    )
+    write_json_atomic(
+        os.path.join(run_folder, "config.json"),
+        config | {"run_alias": run_alias, "shard": [shard_index, n_shards]},
+    )
+    if config["evaluate"]:
+        save_evaluations_json(
+            export_folder=config["export_folder"],
+            eval_metrics=evaluate(read_classifications(run_folder)),
+            model_used=config["model_used"],
+            chain_used=config["chain"],
+            run_alias=run_alias,
+        )
+    return run_folder
+
+
+def _run_shard_in_process(config, run_alias, shard_index, n_shards, progress_queue, result_queue):
+    run_folder = run_shard(
+        config,
+        run_alias=run_alias,
+        shard_index=shard_index,
+        n_shards=n_shards,
+        progress_queue=progress_queue,
+    )
+    result_queue.put(run_folder)
+
+
+def run_config(config: dict) -> list:
+    """runs a config with worker threads, and with worker processes if "processes" is larger than 1
+
+    With several processes, the examples are split into one shard per process, each classified as a run named
+    <run alias>-<shard>of<processes>, and the progress of all shards is shown in one progress bar.
+
+    Args:
+        config: run config (see validate_config())
+
+    Returns:
+        list: the folders of the runs
+    """
+    import multiprocessing
+    from queue import Empty
+
+    from tqdm import tqdm
+
+    from stance_llm.readers import count_egs
+
+    config = validate_config(config)
+    run_alias = get_config_run_alias(config)
+    n_processes = config["processes"]
+    logger.info(
+        f"Running chain {config['chain']} with {config['model_used']} as {run_alias}: {n_processes} process(es) with {config['workers']} worker(s) each"
+    )
+    if n_processes == 1:
+        return [run_shard(config, run_alias=run_alias)]
+    # spawned processes do not inherit the threads and model state of the parent
+    context = multiprocessing.get_context("spawn")
+    progress_queue = context.Queue()
+    result_queue = context.Queue()
+    shard_processes = [
+        context.Process(
+            target=_run_shard_in_process,
+            args=(
+                config,
+                f"{run_alias}-{i + 1}of{n_processes}",
+                i,
+                n_processes,
+                progress_queue,
+                result_queue,
+            ),
+        )
+        for i in range(n_processes)
+    ]
+    for shard_process in shard_processes:
+        shard_process.start()
+    n_egs = count_egs(config["input"]) if isinstance(config["input"], str) else None
+    progress = tqdm(total=n_egs)
+    while any(shard_process.is_alive() for shard_process in shard_processes) or not progress_queue.empty():
+        try:
+            progress.update(progress_queue.get(timeout=0.2))
+        except Empty:
+            pass
+    progress.close()
+    failed = [i + 1 for i, shard_process in enumerate(shard_processes) if shard_process.exitcode != 0]
+    if len(failed) > 0:
+        raise RuntimeError(f"Shard(s) {failed} of run {run_alias} failed")
+    run_folders = []
+    while len(run_folders) < n_processes:
+        run_folders.append(result_queue.get(timeout=10))
+    return sorted(run_folders)
+
+
+def main(argv=None) -> int:
+    """entry point of the stance-llm command"""
+    parser = argparse.ArgumentParser(
+        prog="stance-llm",
+        description="Classify stances of entities in German text with LLM prompt chains",
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    run_parser = subparsers.add_parser("run", help="classify the examples of a run config")
+    run_parser.add_argument("config", help="path of a .json, .yaml or .toml run config")
+    run_parser.add_argument("--resume", action="store_true", help="resume the run of the config")
+    run_parser.add_argument("--workers", type=int, help="number of worker threads per process")
+    run_parser.add_argument("--processes", type=int, help="number of worker processes")
+    run_parser.add_argument("--run-alias", help="name of the run")
+    args = parser.parse_args(argv)
+    config = load_config(args.config)
+    for key, value in [
+        ("resume", args.resume or None),
+        ("workers", args.workers),
+        ("processes", args.processes),
+        ("run_alias", args.run_alias),
+    ]:
+        if value is not None:
+            config[key] = value
+    start = time.perf_counter()
+    run_folders = run_config(config)
+    logger.info(f"Finished in {time.perf_counter() - start:.1f} seconds. Runs: {run_folders}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,181 @@
+import os
+
+import numpy as np
+import polars as pl
+import srsly
+from loguru import logger
+
+from stance_llm.metrics import (
+    EVALUATED_STANCES,
+    bootstrap_intervals,
+    confusion_matrices,
+    encode_stances,
+    metrics_from_confusion,
+    pairwise_agreement,
+    pairwise_mcnemar,
+)
+from stance_llm.readers import read_classifications
+
+
+def get_run_label(run_meta: dict) -> str:
+    """returns a label for a run made of its chain, model, entity mask and alias, e.g. "is/gpt35/None/happy-parrot"
+
+    Args:
+        run_meta: run meta information as serialized to meta.json
+    """
+    return "/".join(
+        [
+            run_meta["chain_used"],
+            run_meta["model_used"],
+            str(run_meta.get("entity_masking", "None")),
+            run_meta["run_alias"],
+        ]
+    )
+
+
+def load_runs(run_folders: list, id_key=None) -> tuple:
+    """loads the predictions of several runs on the same gold set into one table, joined on the example id
+
+    Examples are joined on the "id" of the classifications if the runs were made with an id_key, and on their text,
+    entity and statement otherwise. Only examples classified in all runs are kept.
+
+    Args:
+        run_folders (list): folders of the runs as created by stance_llm.process.make_export_folder()
+        id_key (optional): column to join on. Defaults to None ("id" if all runs have it, text, entity and statement otherwise).
+
+    Returns:
+        tuple: a polars DataFrame with a "key" column, a "stance_true" column and one column of predicted stances per run, and the list of run labels (column names)
+    """
+    tables = []
+    labels = []
+    for run_folder in run_folders:
+        run_meta = srsly.read_json(os.path.join(run_folder, "meta.json"))
+        label = get_run_label(run_meta)
+        if label in labels:
+            raise ValueError(f"Run {label} is loaded twice")
+        labels.append(label)
+        rows = [
+            {
+                key: row.get(key)
+                for key in ["id", "text", "ent_text", "statement", "stance_true", "stance_pred"]
+            }
+            for row in read_classifications(run_folder)
+        ]
+        tables.append(pl.DataFrame(rows, infer_schema_length=None))
+    if id_key is None:
+        id_key = "id" if all(table["id"].null_count() == 0 for table in tables) else None
+    joined = None
+    for label, table in zip(labels, tables):
+        if id_key is not None:
+            table = table.with_columns(pl.col(id_key).cast(pl.Utf8).alias("key"))
+        else:
+            table = table.with_columns(
+                pl.concat_str(["text", "ent_text", "statement"], separator="\x1f").alias("key")
+            )
+        table = table.select(
+            "key", "stance_true", pl.col("stance_pred").alias(label)
+        ).unique(subset="key", keep="first")
+        if joined is None:
+            joined = table
+        else:
+            joined = joined.join(table.drop("stance_true"), on="key", how="inner")
+    logger.info(f"Loaded {len(labels)} runs with {joined.height} shared examples")
+    return joined, labels
+
+
+def compare_runs(
+    run_folders: list,
+    export_path=None,
+    id_key=None,
+    n_bootstrap=0,
+    confidence_level=0.95,
+    seed=None,
+) -> dict:
+    """evaluates several runs on the same gold set at once and compares them pairwise
+
+    Confusion matrices, per-class precision, recall and F1, macro averages and accuracy of all runs are computed
+    in one pass over NumPy arrays, as are the pairwise agreement of predictions and McNemar tests of the
+    differences in accuracy. Examples with classification errors are left out of the metrics of a run and of the
+    pairs it is part of.
+
+    Args:
+        run_folders (list): folders of the runs to compare
+        export_path (optional): path of a .csv or .parquet file to write the comparison table to. Pairwise comparisons are written next to it with the suffix "_pairs". Defaults to None.
+        id_key (optional): column to join the runs on (see load_runs()). Defaults to None.
+        n_bootstrap (int, optional): number of bootstrap samples for confidence intervals of accuracy and macro F1, added as columns with the suffixes "_lower" and "_upper" (see stance_llm.metrics.bootstrap_intervals()). Defaults to 0 (no confidence intervals).
+        confidence_level (float, optional): confidence level of the intervals. Defaults to 0.95.
+        seed (optional): seed of the bootstrap resampling. Defaults to None.
+
+    Returns:
+        dict: "runs", a polars DataFrame with one row of metrics per run, and "pairs", a polars DataFrame with agreement and McNemar test per pair of runs
+    """
+    joined, labels = load_runs(run_folders, id_key=id_key)
+    y_true = encode_stances(joined["stance_true"].to_list())
+    y_pred = np.stack([encode_stances(joined[label].to_list()) for label in labels])
+    n_classes = len(EVALUATED_STANCES)
+    metrics = metrics_from_confusion(confusion_matrices(y_true, y_pred, n_classes))
+    run_table = {
+        "run": labels,
+        "n": metrics["n"],
+        "error_count": (y_pred < 0).sum(axis=1),
+        "accuracy": metrics["accuracy"],
+        "macro_precision": metrics["macro_precision"],
+        "macro_recall": metrics["macro_recall"],
+        "macro_f1": metrics["macro_f1"],
+    }
+    for i, stance in enumerate(EVALUATED_STANCES):
+        for metric in ["precision", "recall", "f1"]:
+            run_table[f"{stance}_{metric}"] = metrics[metric][:, i]
+    if n_bootstrap > 0:
+        intervals = bootstrap_intervals(
+            y_true,
+            y_pred,
+            n_bootstrap=n_bootstrap,
+            confidence_level=confidence_level,
+            seed=seed,
+            n_classes=n_classes,
+        )
+        for metric in ["accuracy", "macro_f1"]:
+            run_table[f"{metric}_lower"] = intervals[metric][0]
+            run_table[f"{metric}_upper"] = intervals[metric][1]
+    runs = pl.DataFrame(run_table).sort("macro_f1", descending=True)
+    valid = (y_pred >= 0) & (y_true >= 0)
+    agreement = pairwise_agreement(y_pred, n_classes=n_classes)
+    mcnemar = pairwise_mcnemar(y_pred == y_true, valid=valid)
+    first, second = np.triu_indices(len(labels), k=1)
+    pairs = pl.DataFrame(
+        {
+            "run_1": [labels[i] for i in first],
+            "run_2": [labels[j] for j in second],
+            "agreement": agreement[first, second],
+            "only_run_1_correct": mcnemar["only_first_correct"][first, second],
+            "only_run_2_correct": mcnemar["only_second_correct"][first, second],
+            "mcnemar_statistic": mcnemar["statistic"][first, second],
+            "mcnemar_p_value": mcnemar["p_value"][first, second],
+        }
+    )
+    if export_path is not None:
+        write_comparison(runs, pairs, export_path)
+    return {"runs": runs, "pairs": pairs}
+
+
+def write_comparison(runs: pl.DataFrame, pairs: pl.DataFrame, export_path: str) -> None:
+    """writes a comparison table and its pairwise comparisons to CSV or Parquet
+
+    Args:
+        runs: table of metrics per run, as returned by compare_runs()
+        pairs: table of pairwise comparisons, as returned by compare_runs()
+        export_path: path of a .csv or .parquet file. Pairwise comparisons are written to <name>_pairs.<extension>
+    """
+    root, extension = os.path.splitext(export_path)
+    if extension not in [".csv", ".parquet"]:
+        raise ValueError(f"Unsupported comparison table format {extension}. Use .csv or .parquet")
+    folder = os.path.dirname(export_path)
+    if folder != "":
+        os.makedirs(folder, exist_ok=True)
+    logger.info(f"Saving comparison of {runs.height} runs to {export_path}")
+    for table, path in [(runs, export_path), (pairs, f"{root}_pairs{extension}")]:
+        if extension == ".csv":
+            table.write_csv(path)
+        else:
+            table.write_parquet(path)
@@ -0,0 +1,124 @@
+import threading
+import time
+from contextlib import contextmanager
+
+from loguru import logger
+
+
+class ClassificationTimeout(TimeoutError):
+    """Raised when the classification of an example or one of its chain steps exceeds its deadline.
+
+    Attributes:
+        step (str): name of the chain step that was running when the deadline expired
+    """
+
+    def __init__(self, message, step=None):
+        super().__init__(message)
+        self.step = step
+
+
+class Deadline:
+    """Per-example and per-step deadline for the classification of one example.
+
+    The steps of a prompt chain register with the deadline (see StanceClassification._run_step), so that the step
+    reached is known when it expires. Once cancelled, the chain raises ClassificationTimeout before its next step.
+
+    Attributes:
+        timeout (float): seconds allowed for the whole example, or None
+        step_timeout (float): seconds allowed for each chain step, or None
+        step (str): name of the chain step currently running
+    """
+
+    def __init__(self, timeout=None, step_timeout=None):
+        self.timeout = timeout
+        self.step_timeout = step_timeout
+        self.step = None
+        self.started = time.monotonic()
+        self.step_started = self.started
+        self._cancelled = threading.Event()
+
+    def start_step(self, step: str) -> None:
+        """registers the start of a chain step, raising ClassificationTimeout if the deadline was cancelled"""
+        self.check()
+        self.step = step
+        self.step_started = time.monotonic()
+
+    def check(self) -> None:
+        """raises ClassificationTimeout if the deadline was cancelled"""
+        if self._cancelled.is_set():
+            raise ClassificationTimeout(
+                f"Classification cancelled at step {self.step}", step=self.step
+            )
+
+    def cancel(self) -> None:
+        self._cancelled.set()
+
+    @contextmanager
+    def hold(self, lock):
+        """context manager holding a lock, waiting for it at most until the deadline expires
+
+        Raises:
+            ClassificationTimeout: if the lock is still held by another thread when the deadline expires, e.g. by an llm call that does not return
+        """
+        seconds_left = self.seconds_left()
+        if not lock.acquire(timeout=max(seconds_left, 0) if seconds_left != float("inf") else -1):
+            raise ClassificationTimeout(
+                f"Deadline expired waiting for the backend at step {self.step}", step=self.step
+            )
+        try:
+            yield
+        finally:
+            lock.release()
+
+    def seconds_left(self) -> float:
+        """seconds until the example or the current step expires, whichever comes first"""
+        now = time.monotonic()
+        left = float("inf")
+        if self.timeout is not None:
+            left = min(left, self.started + self.timeout - now)
+        if self.step_timeout is not None:
+            left = min(left, self.step_started + self.step_timeout - now)
+        return left
+
+
+def run_with_deadline(func, deadline: Deadline, /, *args, **kwargs):
+    """runs a function in a worker thread and waits for it until the deadline expires
+
+    On expiry, the deadline is cancelled and ClassificationTimeout is raised with the step reached, without waiting
+    for the worker thread. A blocking llm call cannot be interrupted, so the worker thread stops at its next chain
+    step. Until then, the call keeps holding the lock of its backend (see stance_llm.pool.get_backend_lock()), so the
+    next example or a retry never overlaps it, and waits for it at most until its own deadline expires.
+
+    Args:
+        func: function to run, e.g. stance_llm.process.detect_stance
+        deadline: Deadline the function registers its steps with
+        *args, **kwargs: arguments passed to func
+
+    Returns:
+        the return value of func
+    """
+    outcome = {}
+
+    def target():
+        try:
+            outcome["result"] = func(*args, **kwargs)
+        except BaseException as error:
+            outcome["error"] = error
+
+    worker = threading.Thread(target=target, daemon=True)
+    worker.start()
+    while worker.is_alive():
+        # the step may change while waiting, so the remaining time is checked again after every wait
+        seconds_left = deadline.seconds_left()
+        if seconds_left <= 0:
+            deadline.cancel()
+            logger.warning(
+                f"Deadline expired at step {deadline.step}. The running llm call is abandoned"
+            )
+            raise ClassificationTimeout(
+                f"Deadline expired at step {deadline.step}", step=deadline.step
+            )
+        worker.join(timeout=min(seconds_left, 1.0))
+    if "error" in outcome:
+        raise outcome["error"]
+    return outcome["result"]
@@ -0,0 +1,251 @@
+import math
+from concurrent.futures import ThreadPoolExecutor
+
+from loguru import logger
+
+from stance_llm.cache import StepCache
+
+VOTING_METHODS = ["majority", "probability"]
+
+
+class EnsembleMember:
+    """One configuration of an ensemble: a chain, run with a model and entity masking of its own or of the run.
+
+    Attributes:
+        chain_label (str): registered chain (see stance_llm.base.get_registered_chains())
+        llm: guidance model backend, or None to use the llm of the run
+        model_used (str): label of the llm, used to name the member
+        chat (bool): whether llm is a chat llm, or None to use the setting of the run
+        entity_mask (str): string masking the entity, or None to use the setting of the run
+        llm2: second guidance model backend for dual llm chains, or None
+        weight (float): weight of the votes of the member
+    """
+
+    def __init__(
+        self,
+        chain_label: str,
+        llm=None,
+        model_used=None,
+        chat=None,
+        entity_mask=None,
+        llm2=None,
+        weight=1.0,
+    ):
+        self.chain_label = chain_label
+        self.llm = llm
+        self.model_used = model_used
+        self.chat = chat
+        self.entity_mask = entity_mask
+        self.llm2 = llm2
+        self.weight = weight
+
+    def __repr__(self):
+        return f"EnsembleMember({self.get_name()!r}, weight={self.weight})"
+
+    def get_name(self) -> str:
+        """returns the name of the member, e.g. "is/gpt35/masked" """
+        parts = [self.chain_label, self.model_used or "run-llm"]
+        if self.entity_mask is not None:
+            parts.append("masked")
+        return "/".join(parts)
+
+    def describe(self) -> dict:
+        return {
+            "name": self.get_name(),
+            "chain": self.chain_label,
+            "model_used": self.model_used,
+            "entity_mask": self.entity_mask,
+            "weight": self.weight,
+        }
+
+
+def get_confidence(classification) -> float:
+    """returns the probability of the path of decisions a chain took, from the log probabilities of its steps
+
+    Decisions whose backend reports no log probability count as certain, so a chain without any reported
+    probabilities has confidence 1.0.
+
+    Args:
+        classification: StanceClassification class object after running a chain
+    """
+    log_prob = sum(
+        sum(step.get("log_probs", {}).values()) for step in classification.steps.values()
+    )
+    return math.exp(log_prob)
+
+
+def vote(stances: list, weights: list, classes=None) -> tuple:
+    """combines the stances of ensemble members by weighted vote
+
+    Ties are broken in favour of the stance of the earliest member among the tied stances.
+
+    Args:
+        stances (list): stance of each member, None for failed members
+        weights (list): weight of the vote of each member
+        classes (list, optional): stances to report in the distribution even without votes. Defaults to None.
+
+    Returns:
+        tuple: the winning stance and the distribution of the votes as shares of the total weight
+    """
+    totals = {stance: 0.0 for stance in classes or []}
+    for stance, weight in zip(stances, weights):
+        if stance is None:
+            continue
+        totals[stance] = totals.get(stance, 0.0) + weight
+    voted = [stance for stance in stances if stance is not None]
+    if len(voted) == 0:
+        return None, totals
+    best = max(totals[stance] for stance in voted)
+    winner = next(stance for stance in voted if totals[stance] == best)
+    total = sum(totals.values())
+    distribution = {
+        stance: (value / total if total > 0 else 0.0) for stance, value in totals.items()
+    }
+    return winner, distribution
+
+
+class EnsembleClassification:
+    """Result of an ensemble classification, used like a StanceClassification by stance_llm.process.
+
+    Attributes:
+        stance (str): stance voted for
+        steps (dict): steps of all members, keyed "<member index>:<member name>/<step>" (see stance_llm.history)
+        meta (dict): model states of the member steps at ["llms"], keyed like steps, and the vote at ["ensemble"]
+        members (list): StanceClassification of each member, None for failed members
+    """
+
+    def __init__(self, stance, steps: dict, meta: dict, members: list):
+        self.stance = stance
+        self.steps = steps
+        self.meta = meta
+        self.members = members
+
+
+class Ensemble:
+    """Self-consistency ensemble running several chain configurations on each example and voting on the stance.
+
+    Members run in parallel threads. Each llm call holds the lock of its backend (see
+    stance_llm.pool.get_backend_lock()), shared with the pipeline workers of a run, as guidance models are not safe to
+    use from several threads at once. All members share a step cache, so a step
+    common to several members (e.g. the irrelevance check of "is" and "is2" with the same model) is run once.
+
+    With the "majority" vote, each member votes for its stance with its weight. With the "probability" vote, the
+    weight is multiplied with the probability of the decisions the chain of the member took (see get_confidence()).
+    The vote distribution and the agreement (share of the winning stance) are stored at ["ensemble"] in the meta
+    data of the classification, as a signal for hard examples. Failed members are left out of the vote, unless all
+    members fail.
+
+    Attributes:
+        members (list): EnsembleMember objects
+        voting (str): "majority" or "probability"
+        step_cache (StepCache): cache shared by the members
+        parallel (bool): run the members in parallel threads
+    """
+
+    def __init__(self, members: list, voting="majority", step_cache=None, parallel=True):
+        if voting not in VOTING_METHODS:
+            raise ValueError(f"Unsupported voting {voting}. Use one of {VOTING_METHODS}")
+        if len(members) == 0:
+            raise ValueError("An ensemble needs at least one member")
+        self.members = members
+        self.voting = voting
+        self.step_cache = step_cache if step_cache is not None else StepCache()
+        self.parallel = parallel
+
+    def describe(self) -> dict:
+        """returns the configuration of the ensemble, e.g. for the meta information of a run"""
+        return {
+            "voting": self.voting,
+            "members": [member.describe() for member in self.members],
+        }
+
+    def _classify_member(self, member: EnsembleMember, eg: dict, llm, chat: bool, entity_mask, **kwargs):
+        from stance_llm.process import detect_stance
+
+        return detect_stance(
+            eg,
+            llm=member.llm if member.llm is not None else llm,
+            chain_label=member.chain_label,
+            llm2=member.llm2,
+            chat=member.chat if member.chat is not None else chat,
+            entity_mask=member.entity_mask if member.entity_mask is not None else entity_mask,
+            step_cache=self.step_cache,
+            **kwargs,
+        )
+
+    def classify(self, eg: dict, llm=None, chat=True, entity_mask=None, **kwargs) -> EnsembleClassification:
+        """classifies an example with all members and votes on the stance
+
+        Args:
+            eg: A dictionary item to classify (see stance_llm.process.detect_stance())
+            llm (optional): guidance model backend of members without a backend of their own. Defaults to None.
+            chat (bool, optional): chat setting of members without one of their own. Defaults to True.
+            entity_mask (optional): entity mask of members without one of their own. Defaults to None.
+            **kwargs: further arguments to stance_llm.process.detect_stance(), e.g. classification_only, deadline, rate_limiter, model_pool
+
+        Returns:
+            EnsembleClassification: the voted stance with the steps and meta data of all members
+        """
+        def run(member):
+            try:
+                return self._classify_member(member, eg, llm=llm, chat=chat, entity_mask=entity_mask, **kwargs), None
+            except Exception as error:
+                return None, error
+
+        if self.parallel and len(self.members) > 1:
+            with ThreadPoolExecutor(max_workers=len(self.members)) as executor:
+                results = list(executor.map(run, self.members))
+        else:
+            results = [run(member) for member in self.members]
+        errors = [error for _, error in results if error is not None]
+        if len(errors) == len(results):
+            raise errors[0]
+        for member, (_, error) in zip(self.members, results):
+            if error is not None:
+                logger.warning(f"Ensemble member {member.get_name()} failed with {type(error).__name__}: {error}")
+        return self._combine([classification for classification, _ in results])
+
+    def _combine(self, classifications: list) -> EnsembleClassification:
+        from stance_llm.metrics import EVALUATED_STANCES
+
+        stances = [None if c is None else c.stance for c in classifications]
+        confidences = [None if c is None else get_confidence(c) for c in classifications]
+        weights = [
+            member.weight * (confidence if self.voting == "probability" and confidence is not None else 1.0)
+            for member, confidence in zip(self.members, confidences)
+        ]
+        stance, distribution = vote(stances, weights, classes=EVALUATED_STANCES)
+        steps = {}
+        llms = {}
+        votes = []
+        for i, (member, classification) in enumerate(zip(self.members, classifications)):
+            name = f"{i}:{member.get_name()}"
+            votes.append(
+                {
+                    "member": name,
+                    "stance": stances[i] if classification is not None else "error",
+                    "confidence": confidences[i],
+                    "weight": weights[i],
+                }
+            )
+            if classification is None:
+                continue
+            for step, record in classification.steps.items():
+                steps[f"{name}/{step}"] = record
+            for step, state in classification.meta["llms"].items():
+                llms[f"{name}/{step}"] = state
+        meta = {
+            "llms": llms,
+            "rationale_skipped": any(
+                classification.meta.get("rationale_skipped", False)
+                for classification in classifications
+                if classification is not None
+            ),
+            "ensemble": {
+                "voting": self.voting,
+                "distribution": distribution,
+                "agreement": distribution.get(stance, 0.0),
+                "votes": votes,
+            },
+        }
+        return EnsembleClassification(stance=stance, steps=steps, meta=meta, members=classifications)
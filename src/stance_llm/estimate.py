@@ -0,0 +1,387 @@
+from loguru import logger
+
+from stance_llm.ratelimit import count_limited_tokens
+from stance_llm.base import (
+    StanceClassification,
+    IRRELEVANCE_ANSWERS,
+    IRRELEVANCE_ANSWERS2,
+    SUMMARY_V2_STANCE_ANSWERS,
+    SUMMARY_MAX_TOKENS,
+    SUMMARY_V2_MAX_TOKENS,
+    CLASSIFICATION_ONLY_SUMMARY_MAX_TOKENS,
+    MULTI_ENTITY_FALLBACK_CHAIN,
+    MULTI_ENTITY_STANCE_ANSWERS,
+    construct_irrelevance_prompt,
+    construct_summary_prompt,
+    construct_summary_statementspecific_prompt,
+    construct_general_stance_prompt,
+    construct_support_stance_prompt,
+    construct_opposition_stance_prompt,
+    construct_multi_entity_prompt,
+    get_registered_chains,
+)
+
+# placeholder rendered into prompts whose input text is a summary generated earlier in the chain
+SUMMARY_PLACEHOLDER = "<summary>"
+
+
+def _summary_max_tokens(chat, classification_only):
+    if classification_only:
+        return CLASSIFICATION_ONLY_SUMMARY_MAX_TOKENS
+    return SUMMARY_MAX_TOKENS[chat]
+
+
+def _summary_step(chat, classification_only=False):
+    return {
+        "step": "summary",
+        "construct_prompt": lambda text, entity, statement: construct_summary_prompt(
+            input_text=text, entity=entity
+        ),
+        "input": "text",
+        "gen_max_tokens": _summary_max_tokens(chat, classification_only),
+    }
+
+
+def _summary_v2_step(chat, classification_only=False):
+    return {
+        "step": "summary",
+        "construct_prompt": lambda text, entity, statement: construct_summary_statementspecific_prompt(
+            input_text=text, entity=entity, statement=statement
+        ),
+        "input": "text",
+        "gen_max_tokens": _summary_max_tokens(chat, classification_only),
+    }
+
+
+def _summary_v2_select_step(llm2=False, classification_only=False):
+    step = {
+        "step": "summary",
+        "construct_prompt": lambda text, entity, statement: construct_summary_statementspecific_prompt(
+            input_text=text, entity=entity, statement=statement
+        ),
+        "input": "text",
+        "prefix": "Die Organisation {entity} ",
+        "options": list(SUMMARY_V2_STANCE_ANSWERS.values()),
+        "llm2": llm2,
+    }
+    if not classification_only:
+        step["gen_max_tokens"] = SUMMARY_V2_MAX_TOKENS
+    return step
+
+
+def _irrelevance_step(input="text"):
+    return {
+        "step": "irrelevance",
+        "construct_prompt": lambda text, entity, statement: construct_irrelevance_prompt(
+            input_text=text, entity=entity, statement=statement
+        ),
+        "input": input,
+        "options": list(IRRELEVANCE_ANSWERS.values()),
+    }
+
+
+def _irrelevance_general_step():
+    return {
+        "step": "irrelevance_general",
+        "construct_prompt": lambda text, entity, statement: construct_general_stance_prompt(
+            input_text=text, entity=entity
+        ),
+        "input": "text",
+        "options": list(IRRELEVANCE_ANSWERS2.values()),
+    }
+
+
+def _stance_step(input="text", opposition=False):
+    construct = (
+        construct_opposition_stance_prompt
+        if opposition
+        else construct_support_stance_prompt
+    )
+    return {
+        "step": "stance_opposition" if opposition else "stance",
+        "construct_prompt": lambda text, entity, statement: construct(
+            input_text=text, entity=entity, statement=statement
+        ),
+        "input": input,
+        "options": ["Ja", "Nein"],
+    }
+
+
+def _multi_entity_step():
+    # rendered for the entity alone, as the other entities of its text are only known while running
+    return {
+        "step": "multi_entity",
+        "construct_prompt": lambda text, entity, statement: construct_multi_entity_prompt(
+            input_text=text, entities=[entity], statement=statement
+        ),
+        "input": "text",
+        "options": list(MULTI_ENTITY_STANCE_ANSWERS.values()),
+    }
+
+
+def get_chain_paths(chain_label: str, chat: bool, classification_only=False) -> list:
+    """Lists every sequence of llm calls a prompt chain can take for one example
+
+    Each chain branches on the answers of its select steps, so an example is classified by one of
+    several paths. The paths mirror the control flow of the chain methods of StanceClassification.
+
+    Args:
+        chain_label: A registered llm chain. See stance_llm.base.get_registered_chains for list
+        chat (bool): whether the chat variant of the chain is used
+        classification_only (bool, optional): whether summaries are skipped or capped as in classification-only runs. Defaults to False.
+
+    Returns:
+        list: paths, each a list of step dictionaries, ordered from fewest to most llm calls
+    """
+    if chain_label not in get_registered_chains():
+        raise NameError("Chain label is not registered")
+    if chain_label == "sis":
+        head = [
+            _summary_step(chat, classification_only),
+            _irrelevance_step(input="summary"),
+        ]
+        return [head, head + [_stance_step(input="summary")]]
+    if chain_label == "s2is":
+        head = [
+            _summary_v2_step(chat, classification_only),
+            _irrelevance_step(input="summary"),
+        ]
+        return [head, head + [_stance_step(input="summary")]]
+    if chain_label == "s2":
+        return [[_summary_v2_select_step(classification_only=classification_only)]]
+    if chain_label == "is":
+        head = [_irrelevance_step()]
+        return [head, head + [_stance_step()]]
+    if chain_label == "is2":
+        head = [_irrelevance_step()]
+        return [head, head + [_summary_v2_select_step(
+            llm2=True, classification_only=classification_only
+        )]]
+    if chain_label in ["nise", "nis2e"]:
+        if chain_label == "nise":
+            summary_step = _summary_step(chat, classification_only)
+        if chain_label == "nis2e":
+            summary_step = _summary_v2_step(chat, classification_only)
+        general = [_irrelevance_general_step()]
+        related = general + [_irrelevance_step()]
+        support = related + [summary_step, _stance_step(input="summary")]
+        opposition = support + [_stance_step(input="summary", opposition=True)]
+        return [general, related, support, opposition]
+    if chain_label == "me":
+        # the joint step is counted for every example, although the entities of a text share it in a run
+        head = [_multi_entity_step()]
+        fallback_paths = get_chain_paths(
+            MULTI_ENTITY_FALLBACK_CHAIN, chat=chat, classification_only=classification_only
+        )
+        return [head] + [head + path for path in fallback_paths]
+
+
+def get_token_counter(llm, tokenizer=None):
+    """Returns a function counting the tokens of a string for a guidance model backend
+
+    Uses, in order of preference, a tokenizer passed explicitly, the original Hugging Face tokenizer of
+    a guidance.models.Transformers backend, or the token vocabulary guidance builds for every backend.
+
+    Args:
+        llm: A guidance model backend from guidance.models
+        tokenizer (optional): callable taking a string and returning a list of tokens. Defaults to None.
+
+    Returns:
+        a function taking a string and returning its number of tokens
+    """
+    if tokenizer is not None:
+        return lambda text: len(tokenizer(text))
+    if hasattr(llm, "_orig_tokenizer"):
+        orig_tokenizer = llm._orig_tokenizer
+        return lambda text: len(
+            orig_tokenizer(text, add_special_tokens=False)["input_ids"]
+        )
+    if hasattr(llm, "_tokenize_prefix"):
+        return lambda text: len(llm._tokenize_prefix(text.encode("utf8"))[0])
+    logger.warning(
+        "Could not find a tokenizer for the llm backend. Approximating token counts with 4 characters per token"
+    )
+    return lambda text: max(1, len(text) // 4)
+
+
+def render_chain_prompts(
+    eg: dict, chain_label: str, chat=True, entity_mask=None
+) -> list:
+    """Renders every prompt a prompt chain could send to the llm for an example, without calling the llm
+
+    Prompts of steps that build on a summary generated earlier in the chain contain SUMMARY_PLACEHOLDER instead.
+
+    Args:
+        eg: A dictionary item with "text", "ent_text" and "statement" keys (see stance_llm.process.detect_stance)
+        chain_label: A registered llm chain. See stance_llm.base.get_registered_chains for list
+        chat (bool, optional): whether the chat variant of the chain is used. Defaults to True.
+        entity_mask (optional): string masking the entity in all prompts. Defaults to None.
+
+    Returns:
+        list: one dictionary per distinct step of the chain with the step name and the rendered prompt
+    """
+    task = StanceClassification(
+        input_text=eg["text"], statement=eg["statement"], entity=eg["ent_text"]
+    )
+    if entity_mask is not None:
+        task = task.mask_entity(entity_mask=entity_mask)
+    rendered = {}
+    for path in get_chain_paths(chain_label=chain_label, chat=chat):
+        for step in path:
+            if step["step"] in rendered:
+                continue
+            if step["input"] == "summary":
+                input_text = SUMMARY_PLACEHOLDER
+            else:
+                input_text = task.masked_input_text
+            prompt = step["construct_prompt"](
+                input_text, task.masked_entity, task.statement
+            )
+            if "prefix" in step:
+                prompt += step["prefix"].format(entity=task.masked_entity)
+            rendered[step["step"]] = {
+                "step": step["step"],
+                "prompt_text": prompt,
+                "input": step["input"],
+            }
+    return list(rendered.values())
+
+
+def _count_path(path, prompts, count_tokens, count_tokens2, summary_max_tokens):
+    calls = len(path)
+    input_tokens = 0
+    output_tokens = 0
+    # prompt tokens as counted by stance_llm.ratelimit.RateLimiter, with summaries taking 4 characters per token
+    limited_tokens = 0
+    for step in path:
+        counter = count_tokens2 if step.get("llm2") else count_tokens
+        prompt = prompts[step["step"]]["prompt_text"]
+        if step["input"] == "summary":
+            prompt = prompt.replace(SUMMARY_PLACEHOLDER, "")
+            input_tokens += summary_max_tokens
+            limited_tokens += summary_max_tokens
+        input_tokens += counter(prompt)
+        limited_tokens += count_limited_tokens(prompt)
+        if "options" in step:
+            output_tokens += max(counter(option) for option in step["options"])
+        if "gen_max_tokens" in step:
+            output_tokens += step["gen_max_tokens"]
+    return {
+        "calls": calls,
+        "input_tokens": input_tokens,
+        "output_tokens": output_tokens,
+        "rate_limited_tokens": limited_tokens,
+    }
+
+
+def estimate_run(
+    egs,
+    llm,
+    chain_used: str,
+    chat=True,
+    llm2=None,
+    entity_mask=None,
+    tokenizer=None,
+    input_cost_per_1k=0.0,
+    output_cost_per_1k=0.0,
+    requests_per_minute=None,
+    tokens_per_minute=None,
+    wait_time=0,
+    classification_only=False,
+):
+    """Projects llm calls, tokens, cost and run time of classifying examples with a prompt chain, without calling the llm
+
+    Best case follows the shortest branch of the chain for every example, worst case the longest. Summaries
+    generated during a chain are counted at their max_tokens, both as output and as input of later steps.
+    Input and output tokens are counted with the tokenizer of llm. Run times under tokens_per_minute are projected
+    from "rate_limited_tokens", the prompt tokens as counted by stance_llm.ratelimit.RateLimiter in a run, so that
+    the projection sizes the same limit the run enforces.
+
+    Args:
+        egs: list of examples to classify as dictionaries with at least keys "text","ent_text","statement" (see stance_llm.process.detect_stance)
+        llm: A guidance model backend from guidance.models, used for its tokenizer
+        chain_used: A registered llm chain. See stance_llm.base.get_registered_chains for list
+        chat (bool, optional): whether the chat variant of the chain is used. Defaults to True.
+        llm2 (optional): A second guidance model backend from guidance.models. Defaults to None.
+        entity_mask (optional): string masking the entity in all prompts. Defaults to None.
+        tokenizer (optional): callable taking a string and returning a list of tokens, overriding the tokenizer of llm. Defaults to None.
+        input_cost_per_1k (float, optional): price per 1000 input tokens. Defaults to 0.0.
+        output_cost_per_1k (float, optional): price per 1000 output tokens. Defaults to 0.0.
+        requests_per_minute (optional): rate limit on llm calls. Defaults to None.
+        tokens_per_minute (optional): rate limit on prompt tokens. Defaults to None.
+        wait_time (optional): Wait time (in seconds) between two examples, as in stance_llm.process.process. Defaults to 0.
+        classification_only (bool, optional): project a classification-only run, skipping or capping summaries. Defaults to False.
+
+    Returns:
+        tuple: a report dictionary with "best_case" and "worst_case" projections, and a list of the rendered prompts per example
+    """
+    count_tokens = get_token_counter(llm, tokenizer=tokenizer)
+    count_tokens2 = (
+        count_tokens if llm2 is None else get_token_counter(llm2, tokenizer=tokenizer)
+    )
+    paths = get_chain_paths(
+        chain_label=chain_used, chat=chat, classification_only=classification_only
+    )
+    totals = {
+        case: {"calls": 0, "input_tokens": 0, "output_tokens": 0, "rate_limited_tokens": 0}
+        for case in ["best_case", "worst_case"]
+    }
+    rendered_egs = []
+    n_egs = 0
+    for eg in egs:
+        n_egs += 1
+        prompts = {
+            step["step"]: step
+            for step in render_chain_prompts(
+                eg, chain_label=chain_used, chat=chat, entity_mask=entity_mask
+            )
+        }
+        path_counts = [
+            _count_path(
+                path,
+                prompts=prompts,
+                count_tokens=count_tokens,
+                count_tokens2=count_tokens2,
+                summary_max_tokens=_summary_max_tokens(chat, classification_only),
+            )
+            for path in paths
+        ]
+        for case, counts in [("best_case", path_counts[0]), ("worst_case", path_counts[-1])]:
+            for key in counts:
+                totals[case][key] += counts[key]
+        rendered_egs.append(
+            {
+                "text": eg["text"],
+                "ent_text": eg["ent_text"],
+                "statement": eg["statement"],
+                "prompts": list(prompts.values()),
+                "best_case": path_counts[0],
+                "worst_case": path_counts[-1],
+            }
+        )
+    for case in totals:
+        counts = totals[case]
+        counts["cost"] = (
+            counts["input_tokens"] / 1000 * input_cost_per_1k
+            + counts["output_tokens"] / 1000 * output_cost_per_1k
+        )
+        minutes = n_egs * wait_time / 60
+        if requests_per_minute is not None:
+            minutes = max(minutes, counts["calls"] / requests_per_minute)
+        if tokens_per_minute is not None:
+            minutes = max(minutes, counts["rate_limited_tokens"] / tokens_per_minute)
+        counts["minutes"] = minutes
+    report = {
+        "chain_used": chain_used,
+        "n_examples": n_egs,
+        "chat": chat,
+        "classification_only": classification_only,
+        "input_cost_per_1k": input_cost_per_1k,
+        "output_cost_per_1k": output_cost_per_1k,
+        "requests_per_minute": requests_per_minute,
+        "tokens_per_minute": tokens_per_minute,
+    } | totals
+    logger.info(
+        f"Dry run of chain {chain_used} on {n_egs} examples: best case {totals['best_case']}, worst case {totals['worst_case']}"
+    )
+    return report, rendered_egs
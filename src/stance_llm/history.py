@@ -0,0 +1,140 @@
+import hashlib
+import os
+import sqlite3
+import threading
+
+from loguru import logger
+
+from stance_llm.base import PROMPT_TEMPLATES, StanceClassification
+
+# parameter values at least this long are moved to the blob store
+MIN_BLOB_LENGTH = 64
+
+
+class BlobStore:
+    """Content-addressed store of long strings in a SQLite file, e.g. the input texts of the prompts of a run.
+
+    Strings are stored once under their sha256 hash, so that texts shared by several prompts, examples or runs take
+    up space only once. The store can be shared between threads. Stored strings are committed to the file by
+    commit(), which runs do before writing a classification referring to them (see
+    stance_llm.process.write_classification()).
+
+    Attributes:
+        path (str): path of the SQLite file
+    """
+
+    filename = "prompt_blobs.sqlite"
+
+    def __init__(self, path: str):
+        self.path = path
+        self._pending = 0
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS blobs (hash TEXT PRIMARY KEY, content TEXT NOT NULL)"
+        )
+        self._connection.commit()
+
+    @classmethod
+    def from_run_folder(cls, run_folder: str) -> "BlobStore":
+        """opens the blob store of a run folder (see stance_llm.process.make_export_folder())"""
+        return cls(os.path.join(run_folder, cls.filename))
+
+    def put(self, content: str) -> str:
+        """stores a string if it is not stored yet and returns its hash"""
+        blob_hash = hashlib.sha256(content.encode("utf8")).hexdigest()
+        with self._lock:
+            self._connection.execute(
+                "INSERT OR IGNORE INTO blobs (hash, content) VALUES (?, ?)",
+                (blob_hash, content),
+            )
+            self._pending += 1
+        return blob_hash
+
+    def get(self, blob_hash: str) -> str:
+        """returns the string stored under a hash"""
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT content FROM blobs WHERE hash = ?", (blob_hash,)
+            ).fetchone()
+        if row is None:
+            raise KeyError(f"No blob with hash {blob_hash} in {self.path}")
+        return row[0]
+
+    def __len__(self):
+        with self._lock:
+            return self._connection.execute("SELECT COUNT(*) FROM blobs").fetchone()[0]
+
+    def commit(self) -> None:
+        """commits the strings stored since the last commit"""
+        with self._lock:
+            if self._pending > 0:
+                self._connection.commit()
+                self._pending = 0
+
+    def close(self) -> None:
+        self.commit()
+        self._connection.close()
+
+
+def get_prompt_history(
+    classification: StanceClassification,
+    blob_store=None,
+    min_blob_length=MIN_BLOB_LENGTH,
+) -> dict:
+    """returns the structured prompt history of a classification: template id, parameters and captured answers per chain step
+
+    Parameter values of at least min_blob_length characters are replaced by {"blob": <hash>} references to the blob
+    store, so that the input text is not repeated for every step of the chain. Without a blob store, the values are
+    kept inline. The full prompts can be rebuilt with rebuild_prompts().
+
+    Args:
+        classification: StanceClassification class object after running a chain
+        blob_store (optional): BlobStore to move long parameter values to. Defaults to None.
+        min_blob_length (int, optional): minimal length of parameter values moved to the blob store. Defaults to MIN_BLOB_LENGTH.
+
+    Returns:
+        dict: e.g. {"irrelevance": {"template": "irrelevance", "params": {...}, "chat": True, "outputs": {"answer": "Bezieht Stellung"}}}
+    """
+    history = {}
+    for step, record in classification.steps.items():
+        params = {}
+        for key, value in record["params"].items():
+            if blob_store is not None and isinstance(value, str) and len(value) >= min_blob_length:
+                params[key] = {"blob": blob_store.put(value)}
+            else:
+                params[key] = value
+        history[step] = record | {"params": params}
+    return history
+
+
+def rebuild_prompts(prompt_history: dict, blob_store=None) -> dict:
+    """rebuilds the full prompt texts from a structured prompt history
+
+    Args:
+        prompt_history: prompt history as returned by get_prompt_history() and serialized at ["meta"]["prompt_history"] of a classification
+        blob_store (optional): BlobStore the history references, e.g. BlobStore.from_run_folder(<run folder>). Defaults to None.
+
+    Returns:
+        dict: the prompt text and captured answers per chain step, e.g. {"irrelevance": {"prompt_text": "Analysiere den folgenden Text: ...", "outputs": {"answer": "Bezieht Stellung"}}}
+    """
+    prompts = {}
+    for step, record in prompt_history.items():
+        params = {}
+        for key, value in record["params"].items():
+            if isinstance(value, dict) and "blob" in value:
+                if blob_store is None:
+                    raise ValueError(
+                        f"Prompt history of step {step} references blobs, but no blob store was given"
+                    )
+                value = blob_store.get(value["blob"])
+            params[key] = value
+        if record["template"] in PROMPT_TEMPLATES:
+            prompt_text = str(PROMPT_TEMPLATES[record["template"]](**params))
+        else:
+            logger.warning(
+                f"Unknown prompt template {record['template']} of step {step}. Using the stored prompt text"
+            )
+            prompt_text = params.get("prompt")
+        prompts[step] = {"prompt_text": prompt_text, "outputs": record["outputs"]}
+    return prompts
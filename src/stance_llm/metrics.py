@@ -0,0 +1,205 @@
+import math
+
+import numpy as np
+
+# stance classes evaluated, in the order of the rows and columns of confusion matrices
+EVALUATED_STANCES = ["support", "opposition", "irrelevant"]
+
+
+def encode_stances(stances, classes=EVALUATED_STANCES) -> np.ndarray:
+    """encodes stance labels as class indices, with -1 for errors and missing predictions
+
+    Args:
+        stances: iterable of stance labels, may contain "error" or None
+        classes (optional): list of stance classes. Defaults to EVALUATED_STANCES.
+    """
+    codes = {stance: i for i, stance in enumerate(classes)}
+    return np.array([codes.get(stance, -1) for stance in stances], dtype=np.int64)
+
+
+def confusion_matrices(y_true: np.ndarray, y_pred: np.ndarray, n_classes: int) -> np.ndarray:
+    """computes the confusion matrices of several runs at once
+
+    Examples with a prediction or true value of -1 (errors) are left out.
+
+    Args:
+        y_true: true class indices, shape (n_examples,)
+        y_pred: predicted class indices of each run, shape (n_runs, n_examples)
+        n_classes (int): number of classes
+
+    Returns:
+        np.ndarray: counts of shape (n_runs, n_classes, n_classes), true classes in rows and predicted classes in columns
+    """
+    y_pred = np.atleast_2d(y_pred)
+    n_runs = y_pred.shape[0]
+    y_true = np.broadcast_to(y_true, y_pred.shape)
+    valid = (y_true >= 0) & (y_pred >= 0)
+    run_index = np.broadcast_to(np.arange(n_runs)[:, None], y_pred.shape)
+    flat = (run_index * n_classes + y_true) * n_classes + y_pred
+    counts = np.bincount(flat[valid], minlength=n_runs * n_classes * n_classes)
+    return counts.reshape(n_runs, n_classes, n_classes)
+
+
+def _safe_divide(numerator, denominator):
+    # as in sklearn, metrics with a zero denominator are set to 0
+    return np.divide(
+        numerator,
+        denominator,
+        out=np.zeros(np.broadcast(numerator, denominator).shape, dtype=np.float64),
+        where=denominator != 0,
+    )
+
+
+def metrics_from_confusion(cm: np.ndarray) -> dict:
+    """computes per-class precision, recall and F1, macro averages and accuracy from confusion matrices
+
+    Args:
+        cm: confusion matrices of shape (..., n_classes, n_classes) as returned by confusion_matrices()
+
+    Returns:
+        dict: arrays "precision", "recall", "f1", "support" of shape (..., n_classes) and "macro_precision", "macro_recall", "macro_f1", "accuracy", "n" of shape (...)
+    """
+    true_positives = np.diagonal(cm, axis1=-2, axis2=-1)
+    predicted = cm.sum(axis=-2)
+    support = cm.sum(axis=-1)
+    precision = _safe_divide(true_positives, predicted)
+    recall = _safe_divide(true_positives, support)
+    f1 = _safe_divide(2 * precision * recall, precision + recall)
+    n = support.sum(axis=-1)
+    return {
+        "precision": precision,
+        "recall": recall,
+        "f1": f1,
+        "support": support,
+        "macro_precision": precision.mean(axis=-1),
+        "macro_recall": recall.mean(axis=-1),
+        "macro_f1": f1.mean(axis=-1),
+        "accuracy": _safe_divide(true_positives.sum(axis=-1), n),
+        "n": n,
+    }
+
+
+def pairwise_agreement(y_pred: np.ndarray, n_classes=len(EVALUATED_STANCES)) -> np.ndarray:
+    """computes the share of examples on which each pair of runs predicts the same stance
+
+    Only examples without errors in both runs are compared.
+
+    Args:
+        y_pred: predicted class indices of each run, shape (n_runs, n_examples)
+        n_classes (int, optional): number of classes. Defaults to the number of EVALUATED_STANCES.
+
+    Returns:
+        np.ndarray: agreement of shape (n_runs, n_runs)
+    """
+    valid = (y_pred >= 0).astype(np.int64)
+    # one-hot encoded predictions turn the pairwise comparison into one matrix product
+    one_hot = np.stack([(y_pred == c) for c in range(n_classes)], axis=-1).astype(np.int64)
+    one_hot = one_hot.reshape(y_pred.shape[0], -1)
+    agreeing = one_hot @ one_hot.T
+    compared = valid @ valid.T
+    return _safe_divide(agreeing, compared)
+
+
+def pairwise_mcnemar(correct: np.ndarray, valid=None) -> dict:
+    """runs McNemar tests with continuity correction between all pairs of runs
+
+    Args:
+        correct: whether each run classified each example correctly, shape (n_runs, n_examples)
+        valid (optional): whether each run classified each example without error, shape (n_runs, n_examples). Pairs are compared on the examples valid in both runs. Defaults to None (all valid).
+
+    Returns:
+        dict: arrays of shape (n_runs, n_runs): "only_first_correct" and "only_second_correct" counts, "statistic" and "p_value"
+    """
+    correct = correct.astype(np.int64)
+    if valid is None:
+        valid = np.ones_like(correct)
+    valid = valid.astype(np.int64)
+    wrong = valid - correct * valid
+    correct = correct * valid
+    only_first = correct @ wrong.T
+    only_second = only_first.T
+    discordant = only_first + only_second
+    statistic = _safe_divide(
+        np.maximum(np.abs(only_first - only_second) - 1, 0) ** 2, discordant
+    )
+    # survival function of the chi-squared distribution with one degree of freedom
+    p_value = np.vectorize(math.erfc, otypes=[np.float64])(np.sqrt(statistic / 2))
+    p_value[discordant == 0] = 1.0
+    return {
+        "only_first_correct": only_first,
+        "only_second_correct": only_second,
+        "statistic": statistic,
+        "p_value": p_value,
+    }
+
+
+def bootstrap_confusion_matrices(
+    y_true: np.ndarray, y_pred: np.ndarray, indices: np.ndarray, n_classes: int
+) -> np.ndarray:
+    """computes the confusion matrices of bootstrap samples of several runs at once
+
+    Args:
+        y_true: true class indices, shape (n_examples,)
+        y_pred: predicted class indices of each run, shape (n_runs, n_examples)
+        indices: indices of the examples drawn in each bootstrap sample, shape (n_samples, n_examples)
+        n_classes (int): number of classes
+
+    Returns:
+        np.ndarray: counts of shape (n_runs, n_samples, n_classes, n_classes)
+    """
+    y_pred = np.atleast_2d(y_pred)
+    n_runs = y_pred.shape[0]
+    n_samples = indices.shape[0]
+    sampled_true = np.broadcast_to(y_true[indices], (n_runs,) + indices.shape)
+    sampled_pred = y_pred[:, indices]
+    valid = (sampled_true >= 0) & (sampled_pred >= 0)
+    # one bincount over all runs and samples, with a separate range of bins per run and sample
+    sample_index = np.arange(n_runs * n_samples).reshape(n_runs, n_samples, 1)
+    flat = (sample_index * n_classes + sampled_true) * n_classes + sampled_pred
+    counts = np.bincount(flat[valid], minlength=n_runs * n_samples * n_classes * n_classes)
+    return counts.reshape(n_runs, n_samples, n_classes, n_classes)
+
+
+def bootstrap_intervals(
+    y_true: np.ndarray,
+    y_pred: np.ndarray,
+    n_bootstrap=1000,
+    confidence_level=0.95,
+    seed=None,
+    n_classes=len(EVALUATED_STANCES),
+    chunk_size=1000,
+) -> dict:
+    """computes percentile bootstrap confidence intervals of the metrics of several runs
+
+    All runs are resampled with the same bootstrap samples of examples, drawn as one index matrix per chunk of
+    samples, so that no Python loop runs over samples or examples.
+
+    Args:
+        y_true: true class indices, shape (n_examples,)
+        y_pred: predicted class indices of each run, shape (n_runs, n_examples)
+        n_bootstrap (int, optional): number of bootstrap samples. Defaults to 1000.
+        confidence_level (float, optional): confidence level of the intervals. Defaults to 0.95.
+        seed (optional): seed of the random number generator. Defaults to None.
+        n_classes (int, optional): number of classes. Defaults to the number of EVALUATED_STANCES.
+        chunk_size (int, optional): number of bootstrap samples drawn at once, bounding memory use. Defaults to 1000.
+
+    Returns:
+        dict: for each metric of metrics_from_confusion() except "n" and "support", an array of lower and upper bounds of shape (2, n_runs) or (2, n_runs, n_classes)
+    """
+    y_pred = np.atleast_2d(y_pred)
+    n_examples = y_pred.shape[1]
+    rng = np.random.default_rng(seed)
+    samples = []
+    for start in range(0, n_bootstrap, chunk_size):
+        n_samples = min(chunk_size, n_bootstrap - start)
+        indices = rng.integers(0, n_examples, size=(n_samples, n_examples))
+        cm = bootstrap_confusion_matrices(y_true, y_pred, indices, n_classes=n_classes)
+        samples.append(metrics_from_confusion(cm))
+    alpha = (1 - confidence_level) / 2
+    intervals = {}
+    for metric in samples[0]:
+        if metric in ["n", "support"]:
+            continue
+        values = np.concatenate([sample[metric] for sample in samples], axis=1)
+        intervals[metric] = np.quantile(values, [alpha, 1 - alpha], axis=1)
+    return intervals
@@ -0,0 +1,201 @@
+import queue
+import threading
+import time
+
+from loguru import logger
+
+from stance_llm.retry import RetryQueue
+
+# marks the end of the items on a queue
+_DONE = object()
+
+
+class QueueStats:
+    """Depth and blocking statistics of a bounded queue between two pipeline stages.
+
+    A producer blocked on a full queue means the consuming stage is the bottleneck, a consumer waiting on an empty
+    queue means the producing stage is.
+
+    Attributes:
+        maxsize (int): capacity of the queue
+        puts (int): number of items put on the queue
+        max_depth (int): largest number of items waiting in the queue
+        mean_depth (float): mean number of items waiting in the queue when an item is put
+        put_wait_seconds (float): total time producers were blocked on a full queue
+        get_wait_seconds (float): total time consumers waited on an empty queue
+    """
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self.puts = 0
+        self.max_depth = 0
+        self.depth_sum = 0
+        self.put_wait_seconds = 0.0
+        self.get_wait_seconds = 0.0
+        self._lock = threading.Lock()
+
+    @property
+    def mean_depth(self) -> float:
+        return self.depth_sum / self.puts if self.puts > 0 else 0.0
+
+    def to_dict(self) -> dict:
+        return {
+            "maxsize": self.maxsize,
+            "puts": self.puts,
+            "max_depth": self.max_depth,
+            "mean_depth": round(self.mean_depth, 2),
+            "put_wait_seconds": round(self.put_wait_seconds, 3),
+            "get_wait_seconds": round(self.get_wait_seconds, 3),
+        }
+
+
+class MonitoredQueue:
+    """Bounded queue recording QueueStats. put() blocks while the queue is full, applying backpressure to the producer."""
+
+    def __init__(self, maxsize: int):
+        self._queue = queue.Queue(maxsize=maxsize)
+        self.stats = QueueStats(maxsize=maxsize)
+
+    def put(self, item) -> None:
+        started = time.monotonic()
+        self._queue.put(item)
+        waited = time.monotonic() - started
+        depth = self._queue.qsize()
+        with self.stats._lock:
+            self.stats.puts += 1
+            self.stats.depth_sum += depth
+            self.stats.max_depth = max(self.stats.max_depth, depth)
+            self.stats.put_wait_seconds += waited
+
+    def get(self):
+        started = time.monotonic()
+        item = self._queue.get()
+        waited = time.monotonic() - started
+        with self.stats._lock:
+            self.stats.get_wait_seconds += waited
+        return item
+
+
+class ClassificationPipeline:
+    """Staged pipeline of a reader, classifier workers and a single writer, connected by bounded queues.
+
+    The reader feeds items into the input queue, the workers classify them and put finished items on the output
+    queue, and the writer serializes them. Bounded queues keep memory bounded on large inputs and let serialization
+    overlap with llm calls. Items deferred by a worker for a retry (see stance_llm.retry.RetryQueue) are fed again
+    by the reader once all other items have been read.
+
+    Attributes:
+        classify: function taking an item, the attempt number and the worker index, returning True if the item is finished and False if it was deferred to the retry queue
+        write: function taking a finished item, called on the writer thread only
+        workers (int): number of classifier worker threads
+        queue_size (int): capacity of the input and output queues
+        wait_time (float): Wait time (in seconds) of a worker after each item
+        retry_queue: RetryQueue the classify function defers items to
+    """
+
+    def __init__(
+        self,
+        classify,
+        write,
+        workers=1,
+        queue_size=64,
+        wait_time=0,
+        retry_queue=None,
+    ):
+        self.classify = classify
+        self.write = write
+        self.workers = workers
+        self.queue_size = queue_size
+        self.wait_time = wait_time
+        self.retry_queue = retry_queue if retry_queue is not None else RetryQueue()
+        self.input_queue = MonitoredQueue(maxsize=queue_size)
+        self.output_queue = MonitoredQueue(maxsize=queue_size)
+        self._in_flight = 0
+        self._in_flight_changed = threading.Condition()
+        self._errors = []
+        self.seconds = 0.0
+
+    def _read(self, items) -> None:
+        try:
+            for item in items:
+                self._feed(item, attempts=0)
+            # deferred items may still be pushed by workers busy with the last items
+            while True:
+                with self._in_flight_changed:
+                    while self._in_flight > 0 and len(self.retry_queue) == 0:
+                        self._in_flight_changed.wait()
+                    if len(self.retry_queue) == 0:
+                        break
+                item, attempts = self.retry_queue.pop()
+                self._feed(item, attempts=attempts)
+        except BaseException as error:
+            self._errors.append(error)
+        finally:
+            for _ in range(self.workers):
+                self.input_queue.put(_DONE)
+
+    def _feed(self, item, attempts: int) -> None:
+        with self._in_flight_changed:
+            self._in_flight += 1
+        self.input_queue.put((item, attempts))
+
+    def _work(self, worker_index: int) -> None:
+        while True:
+            task = self.input_queue.get()
+            if task is _DONE:
+                return
+            item, attempts = task
+            try:
+                if self.classify(item, attempts + 1, worker_index):
+                    self.output_queue.put(item)
+            except BaseException as error:
+                self._errors.append(error)
+            finally:
+                with self._in_flight_changed:
+                    self._in_flight -= 1
+                    self._in_flight_changed.notify_all()
+            time.sleep(self.wait_time)
+
+    def _write(self) -> None:
+        while True:
+            item = self.output_queue.get()
+            if item is _DONE:
+                return
+            try:
+                self.write(item)
+            except BaseException as error:
+                self._errors.append(error)
+
+    def run(self, items) -> None:
+        """runs all items through the pipeline and returns once the last item is written
+
+        Args:
+            items: iterable of items to classify, consumed lazily by the reader thread
+        """
+        started = time.monotonic()
+        reader = threading.Thread(target=self._read, args=(items,), daemon=True)
+        workers = [
+            threading.Thread(target=self._work, args=(i,), daemon=True)
+            for i in range(self.workers)
+        ]
+        writer = threading.Thread(target=self._write, daemon=True)
+        for thread in [reader, writer] + workers:
+            thread.start()
+        reader.join()
+        for worker in workers:
+            worker.join()
+        self.output_queue.put(_DONE)
+        writer.join()
+        self.seconds = time.monotonic() - started
+        if len(self._errors) > 0:
+            raise self._errors[0]
+        logger.info(f"Pipeline queue stats: {self.get_stats()}")
+
+    def get_stats(self) -> dict:
+        """returns queue-depth and blocking statistics of the input and output queues"""
+        return {
+            "workers": self.workers,
+            "seconds": round(self.seconds, 3),
+            "input_queue": self.input_queue.stats.to_dict(),
+            "output_queue": self.output_queue.stats.to_dict(),
+        }
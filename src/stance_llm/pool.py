@@ -0,0 +1,270 @@
+import gc
+import os
+import sys
+import threading
+import weakref
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from loguru import logger
+
+from stance_llm.backends import get_backend_label, load_backend, parse_backend_spec
+
+# bytes per gigabyte of memory budgets and "memory_gb" of backend specs
+GB = 1024**3
+
+_DEFAULT_MODEL_POOL = None
+_DEFAULT_MODEL_POOL_LOCK = threading.Lock()
+
+# one call lock per loaded guidance model, shared by all threads calling it (see get_backend_lock())
+_BACKEND_LOCKS = weakref.WeakKeyDictionary()
+_BACKEND_LOCKS_BY_ID = {}
+_BACKEND_LOCKS_LOCK = threading.Lock()
+
+
+def get_spec_key(spec) -> str:
+    """returns the key of a backend spec in a ModelPool, equal for specs loading the same backend"""
+    import srsly
+
+    return srsly.json_dumps(parse_backend_spec(spec), sort_keys=True)
+
+
+def free_memory() -> None:
+    """releases the memory of evicted backends, including cached GPU memory of torch"""
+    gc.collect()
+    if "torch" in sys.modules and sys.modules["torch"].cuda.is_available():
+        sys.modules["torch"].cuda.empty_cache()
+
+
+def estimate_spec_memory(spec) -> int:
+    """returns the memory in bytes a backend spec is expected to take before loading it: its "memory_gb", or the size of a local model file, or 0"""
+    spec = parse_backend_spec(spec)
+    if "memory_gb" in spec:
+        return int(spec["memory_gb"] * GB)
+    model = spec.get("model")
+    if isinstance(model, str) and os.path.isfile(model):
+        return os.path.getsize(model)
+    return 0
+
+
+def estimate_model_memory(llm):
+    """returns the memory in bytes taken by the weights of a loaded guidance Transformers model, or None for other backends"""
+    model_obj = getattr(llm, "model_obj", None)
+    if model_obj is None or not hasattr(model_obj, "parameters"):
+        return None
+    return sum(parameter.numel() * parameter.element_size() for parameter in model_obj.parameters())
+
+
+class ModelHandle:
+    """Handle of a backend in a ModelPool, loading the backend on first use.
+
+    Used as a context manager returning the loaded guidance model. The handle pins the backend while in use, so
+    that the pool does not evict it, and can be entered by several threads and process() calls at once. Pinning does
+    not serialize calls: each llm call of a chain step holds the lock of the loaded model (see get_backend_lock()).
+
+    Attributes:
+        spec (dict): backend spec (see stance_llm.backends.parse_backend_spec())
+        key (str): key of the spec in the pool
+        label (str): label of the backend, e.g. "transformers-gpt2" or the "label" of the spec
+        llm: the loaded guidance model, or None while not loaded
+        memory (int): estimated memory of the loaded backend in bytes
+    """
+
+    def __init__(self, pool, spec: dict, key: str):
+        self.pool = pool
+        self.spec = spec
+        self.key = key
+        self.label = get_backend_label(spec)
+        self.llm = None
+        self.memory = 0
+        self.pins = 0
+        self._load_lock = threading.Lock()
+
+    def __repr__(self):
+        return f"ModelHandle({self.label!r}, loaded={self.llm is not None})"
+
+    def __enter__(self):
+        return self.pool._check_out(self)
+
+    def __exit__(self, *exc_info):
+        self.pool._check_in(self)
+
+
+class ModelPool:
+    """Registry of model backends keyed by backend spec, loaded on first use and kept warm across runs.
+
+    Without a memory budget, backends stay loaded until evicted explicitly. With a memory budget, loading a backend
+    first evicts the least recently used backends not in use until the expected memory of the new backend fits.
+    The memory of a backend is its "memory_gb" if the spec gives it, or the size of the weights of a Transformers
+    model once loaded, or the size of a local model file (e.g. a GGUF file). API backends take no memory. If the
+    backends in use leave no room, the backend is loaded anyway with a warning.
+
+    Attributes:
+        memory_budget_gb (float): memory the loaded backends may take, or None for no limit
+        loads (int): number of backends loaded
+        evictions (int): number of backends evicted
+    """
+
+    def __init__(self, memory_budget_gb=None):
+        self.memory_budget_gb = memory_budget_gb
+        self.loads = 0
+        self.evictions = 0
+        self._handles = {}
+        self._loaded = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, spec) -> ModelHandle:
+        """returns the handle of a backend spec, without loading the backend
+
+        Args:
+            spec: backend spec as a string "<type>:<model>" or dictionary (see stance_llm.backends.parse_backend_spec())
+        """
+        key = get_spec_key(spec)
+        with self._lock:
+            if key not in self._handles:
+                self._handles[key] = ModelHandle(self, parse_backend_spec(spec), key)
+            return self._handles[key]
+
+    def get_memory(self) -> int:
+        """returns the estimated memory of the loaded backends in bytes"""
+        return sum(handle.memory for handle in self._loaded.values())
+
+    def _check_out(self, handle: ModelHandle):
+        with self._lock:
+            handle.pins += 1
+            if handle.key in self._loaded:
+                self._loaded.move_to_end(handle.key)
+        try:
+            # pinned handles are not evicted, so a backend once loaded stays loaded until checked in
+            with handle._load_lock:
+                if handle.llm is None:
+                    self._load(handle)
+        except BaseException:
+            with self._lock:
+                handle.pins -= 1
+            raise
+        return handle.llm
+
+    def _check_in(self, handle: ModelHandle) -> None:
+        with self._lock:
+            handle.pins -= 1
+
+    def _load(self, handle: ModelHandle) -> None:
+        expected = estimate_spec_memory(handle.spec)
+        self._make_room(expected, keep=handle)
+        llm = load_backend(handle.spec)
+        memory = estimate_model_memory(llm)
+        with self._lock:
+            handle.llm = llm
+            handle.memory = memory if memory is not None and "memory_gb" not in handle.spec else expected
+            self._loaded[handle.key] = handle
+            self.loads += 1
+        logger.info(f"Loaded backend {handle.label} ({handle.memory / GB:.2f} GB)")
+        self._make_room(0, keep=handle)
+
+    def _make_room(self, needed: int, keep=None) -> None:
+        if self.memory_budget_gb is None:
+            return
+        budget = self.memory_budget_gb * GB
+        evicted = False
+        with self._lock:
+            while self.get_memory() + needed > budget:
+                # backends are ordered from least to most recently used
+                idle = [h for h in self._loaded.values() if h is not keep and h.pins == 0]
+                if len(idle) == 0:
+                    logger.warning(
+                        f"Backends in use take {self.get_memory() / GB:.2f} GB, exceeding the memory budget of {self.memory_budget_gb} GB"
+                    )
+                    break
+                self._evict(idle[0])
+                evicted = True
+        if evicted:
+            free_memory()
+
+    def _evict(self, handle: ModelHandle) -> None:
+        logger.info(f"Evicting backend {handle.label} ({handle.memory / GB:.2f} GB)")
+        del self._loaded[handle.key]
+        handle.llm = None
+        handle.memory = 0
+        self.evictions += 1
+
+    def evict(self, spec=None) -> None:
+        """evicts the backend of a spec, or all backends not in use
+
+        Args:
+            spec (optional): backend spec to evict. Defaults to None (all backends not in use).
+        """
+        with self._lock:
+            if spec is None:
+                handles = [handle for handle in self._loaded.values() if handle.pins == 0]
+            else:
+                handles = [h for h in [self._loaded.get(get_spec_key(spec))] if h is not None]
+            for handle in handles:
+                if handle.pins > 0:
+                    raise RuntimeError(f"Cannot evict backend {handle.label} while in use")
+                self._evict(handle)
+        free_memory()
+
+    def get_stats(self) -> dict:
+        """returns the loaded backends from least to most recently used, their memory and the loads and evictions"""
+        with self._lock:
+            return {
+                "loaded": [handle.label for handle in self._loaded.values()],
+                "memory_gb": round(self.get_memory() / GB, 3),
+                "memory_budget_gb": self.memory_budget_gb,
+                "loads": self.loads,
+                "evictions": self.evictions,
+            }
+
+
+def get_model_pool() -> ModelPool:
+    """returns the model pool of the process, used for backend specs passed to process() and detect_stance() without a pool"""
+    global _DEFAULT_MODEL_POOL
+    with _DEFAULT_MODEL_POOL_LOCK:
+        if _DEFAULT_MODEL_POOL is None:
+            _DEFAULT_MODEL_POOL = ModelPool()
+        return _DEFAULT_MODEL_POOL
+
+
+def resolve_backend(llm, model_pool=None):
+    """returns the handle of a backend spec from a model pool, or llm itself if it is a guidance model or handle already
+
+    Args:
+        llm: guidance model backend, ModelHandle, or backend spec as a string or dictionary
+        model_pool (optional): ModelPool to take handles from. Defaults to None (the pool of get_model_pool()).
+    """
+    if isinstance(llm, (str, dict)):
+        return (model_pool if model_pool is not None else get_model_pool()).get(llm)
+    return llm
+
+
+def get_backend_lock(llm) -> threading.Lock:
+    """returns the lock serializing calls to a guidance model backend, the same for all threads, runs and ensembles
+
+    guidance models are not safe to use from several threads at once. The lock is held for one llm call only (see
+    stance_llm.base.StanceClassification._run_step()), so a thread holding a backend never waits for another
+    thread calling it.
+
+    Args:
+        llm: guidance model backend
+    """
+    with _BACKEND_LOCKS_LOCK:
+        try:
+            return _BACKEND_LOCKS.setdefault(llm, threading.Lock())
+        except TypeError:
+            # backends that cannot be referenced weakly are kept alive by the registry
+            return _BACKEND_LOCKS_BY_ID.setdefault(id(llm), (llm, threading.Lock()))[1]
+
+
+@contextmanager
+def use_backend(llm):
+    """context manager returning the guidance model of a backend, pinning the backend against eviction while in use
+
+    Args:
+        llm: guidance model backend or ModelHandle
+    """
+    if isinstance(llm, ModelHandle):
+        with llm as backend:
+            yield backend
+    else:
+        yield llm
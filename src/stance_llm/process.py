@@ -1,37 +1,88 @@
+import hashlib
 import os
 import time
+import uuid
+from contextlib import ExitStack
+from functools import partial
 from datetime import date
 from typing_extensions import Self
 
-import srsly
-from tqdm import tqdm
-from sklearn.metrics import classification_report
 from loguru import logger
-from wonderwords import RandomWord
 
 from stance_llm.base import (
     StanceClassification,
     get_registered_chains,
     get_allowed_dual_llm_chains,
 )
+from stance_llm.cache import StepCache
+from stance_llm.estimate import estimate_run
+from stance_llm.pipeline import ClassificationPipeline
+from stance_llm.pool import resolve_backend, use_backend
+from stance_llm.schedule import group_entities
+from stance_llm.ratelimit import RateLimiter
+from stance_llm.history import BlobStore, get_prompt_history
+from stance_llm.readers import (
+    count_egs,
+    find_classifications_file,
+    read_classifications,
+    read_egs,
+    read_jsonl,
+)
+from stance_llm.runs import update_run_index
+from stance_llm.writers import (
+    COMPRESSION_SUFFIXES,
+    get_classification_writer,
+    get_export_dict,
+    write_json_atomic,
+    write_jsonl_atomic,
+)
+from stance_llm.deadline import Deadline, run_with_deadline
+from stance_llm.retry import (
+    RetryQueue,
+    get_retry_policy,
+    get_error_info,
+    iter_with_retries,
+)
+
+# entries of the in-memory step cache of runs of the multi-entity chain without a step cache
+MULTI_ENTITY_CACHE_ENTRIES = 10000
 
 
 def detect_stance(
-    eg: dict, llm, chain_label: str, llm2=None, chat=True, entity_mask=None
+    eg: dict,
+    llm,
+    chain_label: str,
+    llm2=None,
+    chat=True,
+    entity_mask=None,
+    classification_only=False,
+    deadline=None,
+    step_cache=None,
+    rate_limiter=None,
+    ensemble=None,
+    model_pool=None,
 ) -> Self:
     """Detect stance of an entity in a dictionary input
 
     Expects a dictionary item with a "text" key containing text to classify, a key "ent_text"
     containing a string matching the entity to detect stance for and a key "statement"
-    containing the statement to evaluate the stance against
+    containing the statement to evaluate the stance against. The multi-entity chain "me" classifies the entity
+    together with the other entities of the text listed at an optional key "ent_texts" (see
+    stance_llm.schedule.group_entities())
 
     Args:
         eg: A dictionary item with a "text" key containing text to classify and a "ent_text" key containing a string matching the organizational entity to predict stance for and a key "statement" containing the statement to evaluate the stance against
-        llm: A guidance model backend from guidance.models
+        llm: A guidance model backend from guidance.models, a stance_llm.pool.ModelHandle, or a backend spec loaded from model_pool
         chain_label: A implemented llm chain. See stance_llm.base.get_registered_chains for list
+        classification_only (bool, optional): Stop after the decisive selection of a stance and skip free-text summaries that do not feed into it. Summaries that later steps build on are capped and stopped early. Defaults to False.
+        deadline (optional): stance_llm.deadline.Deadline the steps of the chain register with. Defaults to None.
+        step_cache (optional): stance_llm.cache.StepCache answering steps already run with the same prompt and program. Defaults to None.
+        rate_limiter (optional): stance_llm.ratelimit.RateLimiter the llm calls of the chain wait for. Defaults to None.
+        ensemble (optional): stance_llm.ensemble.Ensemble of chain configurations voting on the stance. chain_label and llm2 are then ignored, and llm, chat and entity_mask serve as defaults of the members. Defaults to None.
+        model_pool (optional): stance_llm.pool.ModelPool loading llm and llm2 if they are given as backend specs (see stance_llm.backends.load_backend()). Defaults to None (the pool of stance_llm.pool.get_model_pool()).
 
     Returns:
-        A StanceClassification class object with a stance and meta data
+        A StanceClassification class object with a stance and meta data, or a stance_llm.ensemble.EnsembleClassification
     """
     if 'text' not in eg.keys():
         logger.error("Input dictionary for classification has not text key")
@@ -39,6 +90,17 @@ def detect_stance(
         logger.error("Input dictionary for classification has not ent_text key")
     if 'statement' not in eg.keys():
         logger.error("Input dictionary for classification has not statement key")
+    if ensemble is not None:
+        return ensemble.classify(
+            eg,
+            llm=llm,
+            chat=chat,
+            entity_mask=entity_mask,
+            classification_only=classification_only,
+            deadline=deadline,
+            rate_limiter=rate_limiter,
+            model_pool=model_pool,
+        )
     chain_labels = get_registered_chains()
     if chain_label not in chain_labels:
         raise NameError("Chain label is not registered")
@@ -54,52 +116,197 @@ def detect_stance(
     task = StanceClassification(input_text=text, statement=statement, entity=entity)
     if entity_mask is not None:
         task = task.mask_entity(entity_mask=entity_mask)
-    if chain_label == "sis":
-        classification = task.summarize_irrelevant_stance_chain(
-            llm=llm, chat=chat, llm2=llm2
-        )
-    if chain_label == "is":
-        classification = task.irrelevant_stance_chain(llm=llm, chat=chat, llm2=llm2)
-    if chain_label == "nise":
-        classification = task.nested_irrelevant_summary_explicit(
-            llm=llm, chat=chat, llm2=llm2
-        )
-    if chain_label == "s2is":
-        classification = task.summarize_v2_irrelevant_stance_chain(
-            llm=llm, chat=chat, llm2=llm2
-        )
-    if chain_label == "s2":
-        classification = task.summarize_v2_chain(llm=llm, chat=chat, llm2=llm2)
-    if chain_label == "is2":
-        classification = task.irrelevant_summarize_v2_chain(
-            llm=llm, chat=chat, llm2=llm2
-        )
-    if chain_label == "nis2e":
-        classification = task.nested_irrelevant_summary_v2_explicit(
-            llm=llm, chat=chat, llm2=llm2
-        )
+    task.deadline = deadline
+    task.step_cache = step_cache
+    task.rate_limiter = rate_limiter
+    with ExitStack() as backends:
+        # handles are pinned for the whole chain, and each llm call of a step holds the lock of the backend
+        llm = backends.enter_context(use_backend(resolve_backend(llm, model_pool)))
+        if llm2 is not None:
+            llm2 = backends.enter_context(use_backend(resolve_backend(llm2, model_pool)))
+        if chain_label == "sis":
+            classification = task.summarize_irrelevant_stance_chain(
+                llm=llm, chat=chat, llm2=llm2, classification_only=classification_only
+            )
+        if chain_label == "is":
+            classification = task.irrelevant_stance_chain(
+                llm=llm, chat=chat, llm2=llm2, classification_only=classification_only
+            )
+        if chain_label == "nise":
+            classification = task.nested_irrelevant_summary_explicit(
+                llm=llm, chat=chat, llm2=llm2, classification_only=classification_only
+            )
+        if chain_label == "s2is":
+            classification = task.summarize_v2_irrelevant_stance_chain(
+                llm=llm, chat=chat, llm2=llm2, classification_only=classification_only
+            )
+        if chain_label == "s2":
+            classification = task.summarize_v2_chain(
+                llm=llm, chat=chat, llm2=llm2, classification_only=classification_only
+            )
+        if chain_label == "is2":
+            classification = task.irrelevant_summarize_v2_chain(
+                llm=llm, chat=chat, llm2=llm2, classification_only=classification_only
+            )
+        if chain_label == "nis2e":
+            classification = task.nested_irrelevant_summary_v2_explicit(
+                llm=llm, chat=chat, llm2=llm2, classification_only=classification_only
+            )
+        if chain_label == "me":
+            classification = task.multi_entity_chain(
+                llm=llm,
+                chat=chat,
+                entities=eg.get("ent_texts"),
+                classification_only=classification_only,
+            )
     return classification
 
 
+# sklearn, numpy, tqdm, srsly and polars are imported in the functions using them, so that importing
+# stance_llm.process stays fast for short-lived workers. tests/test_imports.py guards against regressions.
+
+RUN_ALIAS_ADJECTIVES = [
+    "agile", "amber", "bold", "brave", "bright", "calm", "clever", "cosmic",
+    "crimson", "curious", "daring", "dusty", "eager", "early", "fancy", "fierce",
+    "gentle", "golden", "grand", "happy", "hidden", "humble", "icy", "jolly",
+    "keen", "kind", "lively", "lucky", "mellow", "merry", "misty", "modest",
+    "noble", "olive", "patient", "plain", "polite", "proud", "quick", "quiet",
+    "rapid", "rosy", "royal", "rustic", "shiny", "silent", "silver", "simple",
+    "sleek", "smooth", "snowy", "solid", "spicy", "steady", "sunny", "swift",
+    "tidy", "tiny", "vivid", "warm", "wild", "wise", "witty", "young",
+]
+RUN_ALIAS_NOUNS = [
+    "badger", "beaver", "bison", "falcon", "ferret", "finch", "fox", "gecko",
+    "heron", "ibex", "jackal", "koala", "lark", "lemur", "lynx", "marmot",
+    "marten", "mole", "moose", "newt", "otter", "owl", "panda", "parrot",
+    "pelican", "puffin", "quail", "rabbit", "raven", "robin", "salmon", "seal",
+    "shrew", "sparrow", "squid", "stork", "swan", "tapir", "tiger", "toad",
+    "trout", "turtle", "viper", "vole", "walrus", "weasel", "whale", "wolf",
+    "wombat", "wren", "yak", "zebra", "alpaca", "birch", "cedar", "clover",
+    "delta", "fjord", "glacier", "harbor", "meadow", "river", "summit", "valley",
+]
+
+def make_run_alias(seed=None) -> str:
+    """returns a name for a classification run made of two words and a hexadecimal suffix, e.g. "happy-parrot-3f9a2c1b"
+
+    The words and suffix are derived from a hash of the seed, so equal seeds give equal aliases. The suffix widens the
+    4096 word pairs to about 1.8e13 aliases, so that aliases drawn without a seed practically never collide.
+
+    Args:
+        seed (optional): string or number the alias is derived from. Defaults to None (a random uuid4, giving a new alias on every call).
+    """
+    if seed is None:
+        seed = uuid.uuid4().hex
+    digest = hashlib.blake2b(str(seed).encode("utf8"), digest_size=12).digest()
+    value = int.from_bytes(digest[:8], "big")
+    adjective = RUN_ALIAS_ADJECTIVES[value % len(RUN_ALIAS_ADJECTIVES)]
+    noun = RUN_ALIAS_NOUNS[(value // len(RUN_ALIAS_ADJECTIVES)) % len(RUN_ALIAS_NOUNS)]
+    return f"{adjective}-{noun}-{digest[8:].hex()}"
+
+
+def make_new_run_alias(export_folder: str, model_used, chains: list) -> str:
+    """returns a run alias drawn with make_run_alias() that no run of the model with one of the chains in export_folder has
+
+    Args:
+        export_folder: directory to which all outputs are saved
+        model_used: llm model name
+        chains (list): prompt chains (short names) of the run
+    """
+    while True:
+        run_alias = make_run_alias()
+        taken = [
+            chain
+            for chain in chains
+            if find_run_folder(export_folder, model_used=model_used, chain_used=chain, run_alias=run_alias) is not None
+        ]
+        if len(taken) == 0:
+            return run_alias
+        logger.warning(f"Run alias {run_alias} is taken. Drawing another")
+
+
 def make_export_folder(
-    export_folder: str, model_used, chain_used: str, run_alias: str
+    export_folder: str, model_used, chain_used: str, run_alias: str, resume=False
 ) -> str:
     """creates folder of format <export_folder/<chain_used>/<model_used>/<current date>/<run_alias>
 
+    When resuming, the folder of a run with the same alias started on an earlier date is returned instead.
+
     Args:
         export_folder: directory to which all outputs are saved
         model_used: llm model name
         chain_used: prompt chain (short name)
         run_alias: name of the classification run to be saved
+        resume (bool, optional): Whether to return the folder of an existing run with the same alias. Defaults to False.
+
+    Raises:
+        FileExistsError: if not resuming and a run with the same alias already has a folder, which the new run would overwrite
     """
+    existing_folder = find_run_folder(
+        export_folder=export_folder,
+        model_used=model_used,
+        chain_used=chain_used,
+        run_alias=run_alias,
+    )
+    if existing_folder is not None:
+        if resume:
+            return existing_folder
+        raise FileExistsError(
+            f"A run with alias {run_alias} already exists at {existing_folder}. Choose another run alias or resume the run"
+        )
     today = str(date.today())
     folder_path = os.path.join(export_folder, chain_used, model_used, today, run_alias)
-    if os.path.exists(folder_path):
-        return folder_path
-    else:
-        logger.info(f"Creating folder at {folder_path}")
-        os.makedirs(folder_path)
-        return folder_path
+    logger.info(f"Creating folder at {folder_path}")
+    os.makedirs(folder_path)
+    return folder_path
+
+
+def get_run_folder(export_folder: str, model_used, chain_used: str, run_alias: str) -> str:
+    """returns the folder of the run with the alias, which is created if the run has none yet (see make_export_folder())
+
+    Args:
+        export_folder: directory to which all outputs are saved
+        model_used: llm model name
+        chain_used: prompt chain (short name)
+        run_alias: name of the classification run
+    """
+    return make_export_folder(
+        export_folder=export_folder,
+        model_used=model_used,
+        chain_used=chain_used,
+        run_alias=run_alias,
+        resume=True,
+    )
+
+
+def find_run_folder(export_folder: str, model_used, chain_used: str, run_alias: str):
+    """returns the folder of an existing run at <export_folder/<chain_used>/<model_used>/<date>/<run_alias>, the latest if there are several, or None
+
+    Args:
+        export_folder: directory to which all outputs are saved
+        model_used: llm model name
+        chain_used: prompt chain (short name)
+        run_alias: name of the classification run
+    """
+    model_folder = os.path.join(export_folder, chain_used, model_used)
+    if not os.path.isdir(model_folder):
+        return None
+    for run_date in sorted(os.listdir(model_folder), reverse=True):
+        folder_path = os.path.join(model_folder, run_date, run_alias)
+        if os.path.isdir(folder_path):
+            return folder_path
+    return None
+
+
+def get_example_key(eg: dict, id_key=None):
+    """returns the key identifying an example among the classifications of a run: its id if id_key is given, its text, entity and statement otherwise
+
+    Args:
+        eg: example to classify, or a serialized classification (see stance_llm.writers.get_export_dict())
+        id_key (optional): key of the id of examples to classify. Serialized classifications store it at "id". Defaults to None.
+    """
+    if id_key is not None:
+        return str(eg[id_key] if id_key in eg else eg["id"])
+    return (eg["text"], eg["ent_text"], eg["statement"])
 
 
 def get_prompt_texts_from_meta(classification: StanceClassification) -> dict:
@@ -123,6 +330,303 @@ def get_prompt_texts_from_meta(classification: StanceClassification) -> dict:
     return components
 
 
+def classify_with_retry(
+    eg: dict,
+    attempts: int,
+    run_alias: str,
+    retry_queue: RetryQueue,
+    retry_policies=None,
+    entity_mask=None,
+    classification_only=False,
+    timeout=None,
+    step_timeout=None,
+    prompt_history="full",
+    blob_store=None,
+    **detect_stance_kwargs,
+) -> bool:
+    """Classifies an example and annotates it with the predicted stance and meta data, deferring retryable failures
+
+    If classification fails with an error that has a retry policy and attempts are left, the example is pushed
+    to the retry queue with an exponential backoff delay. Otherwise a failed example gets the stance "error"
+    and structured error information (type, message, attempt count) at ["meta"]["error"].
+
+    Args:
+        eg: A dictionary item to classify (see detect_stance())
+        attempts (int): number of the current attempt for this example, starting at 1
+        run_alias: name of the classification run
+        retry_queue: RetryQueue collecting deferred examples
+        retry_policies (optional): dictionary mapping error class names to RetryPolicy objects. Defaults to stance_llm.retry.DEFAULT_RETRY_POLICIES.
+        entity_mask (optional): string masking the entity in all prompts. Defaults to None.
+        classification_only (bool, optional): Skip free-text summaries not needed for the stance label (see detect_stance()). Defaults to False.
+        timeout (optional): seconds allowed for classifying the example, after which it fails with stance_llm.deadline.ClassificationTimeout. Defaults to None.
+        step_timeout (optional): seconds allowed for each step of the chain. Defaults to None.
+        prompt_history (str, optional): "structured" to store template ids, parameters and answers per chain step (see stance_llm.history.get_prompt_history()), "full" to store the full prompt text of every step. Defaults to "full".
+        blob_store (optional): stance_llm.history.BlobStore for long parameters of a structured prompt history. Defaults to None.
+        **detect_stance_kwargs: further arguments to detect_stance(): llm, chain_label, chat, llm2, step_cache, rate_limiter, ensemble
+
+    Returns:
+        bool: True if the example is finished (classified or marked as error), False if it was deferred for a retry
+    """
+    eg["run_alias"] = run_alias
+    eg["meta"] = {"rationale_skipped": False, "attempts": attempts}
+    if entity_mask is not None:
+        eg["meta"] = eg["meta"] | {"entity_mask": entity_mask}
+    try:
+        if timeout is None and step_timeout is None:
+            eg["stance_classification"] = detect_stance(
+                eg,
+                entity_mask=entity_mask,
+                classification_only=classification_only,
+                **detect_stance_kwargs,
+            )
+        else:
+            deadline = Deadline(timeout=timeout, step_timeout=step_timeout)
+            eg["stance_classification"] = run_with_deadline(
+                detect_stance,
+                deadline,
+                eg,
+                entity_mask=entity_mask,
+                classification_only=classification_only,
+                deadline=deadline,
+                **detect_stance_kwargs,
+            )
+    except Exception as error:
+        policy = get_retry_policy(error, retry_policies=retry_policies)
+        if policy is not None and policy.should_retry(attempts):
+            delay = policy.get_delay(attempts)
+            logger.warning(
+                f"Classification attempt {attempts} failed with {type(error).__name__}. Retrying in {delay:.1f} seconds."
+            )
+            retry_queue.push(eg, attempts=attempts, delay=delay)
+            return False
+        logger.error(
+            f"Classification failed for task after {attempts} attempt(s) with {type(error).__name__}: {error}. Writing error to stance_pred."
+        )
+        eg.pop("stance_classification", None)
+        eg["stance_pred"] = "error"
+        eg["meta"] = eg["meta"] | {
+            "prompt_history": None,
+            "error": get_error_info(error, attempts=attempts),
+        }
+        return True
+    eg["stance_pred"] = eg["stance_classification"].stance
+    eg["meta"]["rationale_skipped"] = eg["stance_classification"].meta.get("rationale_skipped", False)
+    if prompt_history == "structured":
+        history = get_prompt_history(eg["stance_classification"], blob_store=blob_store)
+    else:
+        history = get_prompt_texts_from_meta(classification=eg["stance_classification"])
+    eg["meta"] = eg["meta"] | {"prompt_history": history}
+    if "ensemble" in eg["stance_classification"].meta:
+        eg["meta"]["ensemble"] = eg["stance_classification"].meta["ensemble"]
+    return True
+
+
+def classify_in_worker(
+    eg: dict, attempts: int, worker_index: int, llms: list, **kwargs
+) -> bool:
+    """classifies an example on a pipeline worker with the llm backend assigned to the worker
+
+    guidance model backends are not safe to use from several threads at once, so each llm call of a backend shared
+    by several workers holds the lock of the backend (see stance_llm.pool.get_backend_lock()).
+
+    Args:
+        eg: A dictionary item to classify (see detect_stance())
+        attempts (int): number of the current attempt for this example, starting at 1
+        worker_index (int): index of the pipeline worker
+        llms (list): guidance model backends or stance_llm.pool.ModelHandle objects, assigned to workers in turn
+        **kwargs: further arguments to classify_with_retry()
+
+    Returns:
+        bool: True if the example is finished, False if it was deferred for a retry
+    """
+    i = worker_index % len(llms)
+    with use_backend(llms[i]) as backend:
+        return classify_with_retry(eg, attempts=attempts, llm=backend, **kwargs)
+
+
+class _DeferredChains:
+    """collects the retry delays of the chains of an example that classify_with_retry() deferred"""
+
+    def __init__(self):
+        self.delays = []
+
+    def push(self, item, attempts: int, delay: float) -> None:
+        self.delays.append(delay)
+
+
+def classify_chains_in_worker(
+    eg: dict,
+    attempts: int,
+    worker_index: int,
+    llms: list,
+    chains: list,
+    retry_queue: RetryQueue,
+    step_cache=None,
+    blob_stores=None,
+    done_keys=None,
+    id_key=None,
+    **kwargs,
+) -> bool:
+    """classifies an example with several chains on a pipeline worker, running the steps the chains share once
+
+    Each chain classifies a copy of the example, collected at ["chain_classifications"][<chain label>] of the
+    example. Steps shared by the chains (e.g. the irrelevance check of "is", "is2", "nise" and "nis2e") are answered
+    from step_cache, or from a step cache kept for the example if none is given. If a chain fails with a retryable
+    error, the example is deferred and only the chains that did not finish are run again.
+
+    Args:
+        eg: A dictionary item to classify (see detect_stance())
+        attempts (int): number of the current attempt for this example, starting at 1
+        worker_index (int): index of the pipeline worker
+        llms (list): guidance model backends or stance_llm.pool.ModelHandle objects, assigned to workers in turn
+        chains (list): chain labels to classify the example with
+        retry_queue: RetryQueue collecting deferred examples
+        step_cache (optional): stance_llm.cache.StepCache shared by all examples. Defaults to None.
+        blob_stores (dict, optional): stance_llm.history.BlobStore of the run of each chain. Defaults to None.
+        done_keys (dict, optional): keys of the examples each chain classified before a resumed run (see prepare_resume()). Defaults to None.
+        id_key (optional): key of the id of the examples. Defaults to None.
+        **kwargs: further arguments to classify_with_retry()
+
+    Returns:
+        bool: True if all chains finished the example, False if it was deferred for a retry
+    """
+    i = worker_index % len(llms)
+    blob_stores = blob_stores or {}
+    chain_egs = eg.setdefault("chain_classifications", {})
+    key = get_example_key(eg, id_key=id_key) if done_keys is not None else None
+    deferred = _DeferredChains()
+    example_cache = step_cache if step_cache is not None else StepCache()
+    with use_backend(llms[i]) as backend:
+        for chain in chains:
+            if chain in chain_egs or (done_keys is not None and key in done_keys[chain]):
+                continue
+            chain_eg = {k: v for k, v in eg.items() if k != "chain_classifications"}
+            finished = classify_with_retry(
+                chain_eg,
+                attempts=attempts,
+                llm=backend,
+                chain_label=chain,
+                retry_queue=deferred,
+                step_cache=example_cache,
+                blob_store=blob_stores.get(chain),
+                **kwargs,
+            )
+            if finished:
+                chain_egs[chain] = chain_eg
+    if len(deferred.delays) > 0:
+        retry_queue.push(eg, attempts=attempts, delay=max(deferred.delays))
+        return False
+    return True
+
+
+def write_chain_classifications(eg: dict, chain_writes: dict) -> None:
+    """passes the classifications of an example by several chains (see classify_chains_in_worker()) to the write function of each chain
+
+    Args:
+        eg: example classified by several chains
+        chain_writes (dict): write function of each chain label, e.g. write_classification() with the writer of the run of the chain
+    """
+    for chain, chain_eg in eg.pop("chain_classifications").items():
+        chain_writes[chain](chain_eg)
+
+
+def write_classification(
+    eg: dict,
+    pred_egs: list,
+    writer=None,
+    progress=None,
+    counts=None,
+    on_classified=None,
+    blob_store=None,
+) -> None:
+    """collects a finished example on the pipeline writer thread and serializes it if a writer is given
+
+    Args:
+        eg: classified example
+        pred_egs (list): list collecting the classified examples, or None to not keep them
+        writer (optional): writer with a write() method, e.g. stance_llm.writers.JsonlClassificationWriter. Defaults to None.
+        blob_store (optional): stance_llm.history.BlobStore of the prompt history of the example, committed before the example is written, so that written classifications never refer to blobs lost in a crash. Defaults to None.
+        progress (optional): tqdm progress bar. Defaults to None.
+        counts (optional): dictionary counting the classifications ("n_classifications") and errors ("error_count"). Defaults to None.
+        on_classified (optional): function called with each classified example. Defaults to None.
+    """
+    if counts is not None:
+        counts["n_classifications"] += 1
+        counts["error_count"] += eg["stance_pred"] == "error"
+    if pred_egs is not None:
+        pred_egs.append(eg)
+    if writer is not None:
+        if blob_store is not None:
+            blob_store.commit()
+        writer.write(eg)
+    if progress is not None:
+        progress.update(1)
+    if on_classified is not None:
+        on_classified(eg)
+
+
+def prepare_resume(
+    run_folder: str,
+    model_used: str,
+    chain_used: str,
+    run_alias: str,
+    id_key=None,
+    true_stance_key=None,
+    output_format="jsonl",
+    compression=None,
+) -> tuple:
+    """reads the classifications of a run to resume, and repairs JSONL output cut off by a crash so it can be appended to
+
+    Args:
+        run_folder: folder of the run
+        model_used: llm model name
+        chain_used: prompt chain (short name)
+        run_alias: name of the classification run
+        id_key (optional): key of the id of the examples. Defaults to None.
+        true_stance_key (optional): key of the true stance of the examples. Defaults to None.
+        output_format (str, optional): output format of the resumed run, which must match the existing classifications. Defaults to "jsonl".
+        compression (optional): compression of the resumed run, which must match the existing classifications. Defaults to None.
+
+    Returns:
+        tuple: the set of keys of the classified examples (see get_example_key()) and the counts of classifications and errors so far
+    """
+    counts = {"n_classifications": 0, "error_count": 0}
+    try:
+        path = find_classifications_file(run_folder)
+    except FileNotFoundError:
+        logger.info(f"No classifications to resume in {run_folder}. Starting run {run_alias} from scratch")
+        return set(), counts
+    expected_name = "classifications." + (
+        output_format
+        if output_format != "jsonl"
+        else "jsonl" + COMPRESSION_SUFFIXES[compression]
+    )
+    if os.path.basename(path) != expected_name:
+        raise ValueError(
+            f"Cannot resume run {run_alias}: its classifications are in {os.path.basename(path)}, not {expected_name}"
+        )
+    classifications = list(read_classifications(run_folder))
+    if output_format == "jsonl":
+        writer = get_classification_writer(
+            folder_path=run_folder,
+            model_used=model_used,
+            chain_used=chain_used,
+            run_alias=run_alias,
+            id_key=id_key,
+            true_stance_key=true_stance_key,
+            compression=compression,
+            atomic=True,
+        )
+        for row in classifications:
+            writer.write_row(row)
+        writer.close()
+    done_keys = {get_example_key(row, id_key=id_key) for row in classifications}
+    counts["n_classifications"] = len(classifications)
+    counts["error_count"] = sum(row["stance_pred"] == "error" for row in classifications)
+    logger.info(f"Resuming run {run_alias} after {len(classifications)} classifications")
+    return done_keys, counts
+
+
 def process(
     egs,
     llm,
@@ -136,131 +640,405 @@ def process(
     chat=True,
     llm2=None,
     entity_mask=None,
+    dry_run=False,
+    tokenizer=None,
+    input_cost_per_1k=0.0,
+    output_cost_per_1k=0.0,
+    requests_per_minute=None,
+    tokens_per_minute=None,
+    classification_only=False,
+    retry_policies=None,
+    timeout=None,
+    step_timeout=None,
+    workers=1,
+    queue_size=64,
+    collect=True,
+    run_alias=None,
+    output_format="jsonl",
+    row_group_size=10000,
+    prompt_history="full",
+    compression=None,
+    on_classified=None,
+    step_cache=None,
+    resume=False,
+    show_progress=True,
+    ensemble=None,
+    scheduler=None,
+    model_pool=None,
 ):
-    r_word = RandomWord()
-    run_alias = "-".join(r_word.random_words(2))
-    logger.info(f"Starting run {run_alias}")
     """serves like a main function that
      - sends data together with constructed prompts to the llm (detect_stance())
      - assigns run alias (specific name) and saves classifications together with prompt texts (get_prompt_texts_from_meta() & save_classifications_jsonl())
     
     Args:
-        egs: list of examples to classify as dictionaries with at least keys "text","ent_text","statement" (see detect_stance())
-        llm: A guidance model backend from guidance.models
+        egs: examples to classify as dictionaries with at least keys "text","ent_text","statement" (see detect_stance()). A list, a generator, or the path of a .jsonl, .jsonl.gz or .parquet file read lazily (see stance_llm.readers.read_egs())
+        llm: A guidance model backend from guidance.models, a backend spec (see stance_llm.backends.load_backend()) loaded lazily from model_pool, or a list of backends or specs assigned to the workers in turn
         export_folder: Folder for evaluation output.
         model_used: name of the currently employed llm
-        chain_used: name of propt chain of the current execution
+        chain_used: name of propt chain of the current execution, or a list of chain labels to classify every example with all of them in one pass. Steps the chains share are run once per example (see classify_chains_in_worker()) and each chain writes to its own run folder under the same run alias.
         true_stance_key: contains true stance. Defaults to None.
         wait_time: Wait time between two prompts sent to the llm. Defaults to 5.
         id_key = id of the instance. Defaults to None.
+        dry_run (bool, optional): render and count the prompts of the chain instead of calling the llm. See stance_llm.estimate.estimate_run. Defaults to False.
+        tokenizer (optional): callable taking a string and returning a list of tokens, used for counting tokens in a dry run instead of the tokenizer of llm. Defaults to None.
+        input_cost_per_1k (float, optional): price per 1000 input tokens for the cost projection of a dry run. Defaults to 0.0.
+        output_cost_per_1k (float, optional): price per 1000 output tokens for the cost projection of a dry run. Defaults to 0.0.
+        requests_per_minute (optional): rate limit on llm calls, enforced across all workers (see stance_llm.ratelimit.RateLimiter) and used for the time projection of a dry run. Defaults to None.
+        tokens_per_minute (optional): rate limit on prompt tokens, enforced and projected like requests_per_minute. Defaults to None.
+        classification_only (bool, optional): Skip free-text summaries not needed for the stance label and cap the others (see detect_stance()). Recorded in the meta data of every example. Defaults to False.
+        retry_policies (optional): dictionary mapping error class names to stance_llm.retry.RetryPolicy objects. Failed examples with a matching error are retried with exponential backoff once all other examples are processed. Pass an empty dictionary to disable retries. Defaults to stance_llm.retry.DEFAULT_RETRY_POLICIES.
+        timeout (optional): seconds allowed for classifying one example. Examples exceeding it are cancelled and fail with a ClassificationTimeout, recording the chain step reached at ["meta"]["error"]["step"]. Defaults to None.
+        step_timeout (optional): seconds allowed for each step of the chain, with the same effect as timeout. Defaults to None.
+        workers (int, optional): number of classifier threads. Examples are read, classified and written in a pipeline of bounded queues (see stance_llm.pipeline.ClassificationPipeline). Defaults to 1.
+        queue_size (int, optional): capacity of the queues between reading, classifying and writing. Defaults to 64.
+        collect (bool, optional): keep the classified examples in memory and return them. Set to False for large corpora with stream_out, so that memory does not grow with the number of examples. Defaults to True.
+        run_alias (optional): name of the run. Defaults to None (two random words).
+        output_format (str, optional): format of the streamed out classifications: "jsonl", or "parquet" or "arrow" for columnar output with dictionary-encoded columns (see stance_llm.writers.ColumnarClassificationWriter). Defaults to "jsonl".
+        row_group_size (int, optional): number of classifications per row group written to columnar output. Defaults to 10000.
+        prompt_history (str, optional): "structured" to store the template id, parameters and answers of each chain step at ["meta"]["prompt_history"], with long parameters such as the input text stored once in a prompt_blobs.sqlite file of the run (see stance_llm.history). "full" stores the full prompt text of every step instead. Defaults to "full".
+        compression (optional): "gzip" or "zstd" to compress JSONL output in frames appended as the run progresses (classifications.jsonl.gz or .zst), or the compression codec of columnar output. Defaults to None.
+        on_classified (optional): function called with each classified example as soon as it is written, e.g. to update metrics online (see stance_llm.sequential). Defaults to None.
+        step_cache (optional): stance_llm.cache.StepCache shared by the workers, so that steps already run with the same model, prompt and program (e.g. in an earlier run of another chain) are not sent to the llm again. Defaults to None (an in-memory cache of the last MULTI_ENTITY_CACHE_ENTRIES steps in runs of the multi-entity chain "me").
+        resume (bool, optional): continue the run named run_alias: examples already in its classifications (by id_key, or by text, entity and statement) are skipped and new classifications are added to them. Requires stream_out. Defaults to False.
+        show_progress (bool, optional): show a progress bar. Defaults to True.
+        ensemble (optional): stance_llm.ensemble.Ensemble classifying each example with several chain configurations and voting on the stance (see detect_stance()). The vote distribution is stored at ["meta"]["ensemble"]. chain_used then only names the run. Defaults to None.
+        scheduler (optional): stance_llm.schedule.ExampleScheduler classifying examples grouped by text and entity and bucketed by length, to reuse the prompt prefixes cached by local backends. Classifications are still written and returned in input order, except for examples deferred for a retry, which come at the end. Defaults to None.
+        model_pool (optional): stance_llm.pool.ModelPool loading backends given as specs and keeping them warm for later runs. Workers share a backend through its thread-safe handle. Defaults to None (the pool of stance_llm.pool.get_model_pool()).
 
     Return:
-        Returns the classifications (with text, statement, etc.) together with the extracted predicted stance ("pred_stance") from out of the StanceClassification class attribute "stance" as well as the prompt texts from the attribute "meta"
-    
+        Returns the classifications (with text, statement, etc.) together with the extracted predicted stance ("pred_stance") from out of the StanceClassification class attribute "stance" as well as the prompt texts from the attribute "meta".
+        Returns None if collect is False. A resumed run returns only the examples classified after resuming.
+        With a list of chain labels, returns a dictionary of the classifications of each chain.
+        In a dry run, returns the projection report of stance_llm.estimate.estimate_run instead
     """
-    pred_egs = []
-    for eg in tqdm(egs):
-        try:
-            eg["stance_classification"] = detect_stance(
-                eg,
-                llm=llm,
-                chain_label=chain_used,
+    from tqdm import tqdm
+
+    multi_chain = isinstance(chain_used, (list, tuple))
+    if multi_chain:
+        unregistered = [chain for chain in chain_used if chain not in get_registered_chains()]
+        if len(unregistered) > 0:
+            raise NameError(f"Chain labels {unregistered} are not registered")
+        if dry_run or ensemble is not None:
+            raise ValueError("Dry runs and ensembles take a single chain label as chain_used")
+    if run_alias is None:
+        run_alias = make_new_run_alias(
+            export_folder, model_used, list(chain_used) if multi_chain else [chain_used]
+        )
+    llms = [
+        resolve_backend(backend, model_pool)
+        for backend in (llm if isinstance(llm, (list, tuple)) else [llm])
+    ]
+    llm2 = resolve_backend(llm2, model_pool) if llm2 is not None else None
+    n_egs = len(egs) if hasattr(egs, "__len__") else None
+    if isinstance(egs, (str, os.PathLike)):
+        n_egs = count_egs(str(egs))
+        egs = read_egs(str(egs))
+    if not collect and not stream_out:
+        logger.warning(
+            "Neither collecting nor streaming out classifications. Results of the run are discarded"
+        )
+    if dry_run:
+        logger.info(f"Starting dry run {run_alias}")
+        with use_backend(llms[0]) as backend:
+            report, rendered_egs = estimate_run(
+                egs=egs,
+                llm=backend,
+                chain_used=chain_used,
                 chat=chat,
                 llm2=llm2,
                 entity_mask=entity_mask,
+                tokenizer=tokenizer,
+                input_cost_per_1k=input_cost_per_1k,
+                output_cost_per_1k=output_cost_per_1k,
+                requests_per_minute=requests_per_minute,
+                tokens_per_minute=tokens_per_minute,
+                wait_time=wait_time,
+                classification_only=classification_only,
             )
-            eg["run_alias"] = run_alias
-            eg["stance_pred"] = eg["stance_classification"].stance
-            eg["meta"] = {
-                "prompt_history": get_prompt_texts_from_meta(
-                    classification=eg["stance_classification"]
-                )
-            }
-            if entity_mask is not None:
-                eg["meta"] = eg["meta"] | {"entity_mask": entity_mask}
-            pred_egs.append(eg)
-            if stream_out:
-                save_classifications_jsonl(
-                    export_folder=export_folder,
-                    egs_with_classifications=pred_egs,
+        report = {"run_alias": run_alias, "model_used": model_used} | report
+        if stream_out:
+            save_dry_run_json(
+                export_folder=export_folder,
+                report=report,
+                rendered_egs=rendered_egs,
+                model_used=model_used,
+                chain_used=chain_used,
+                run_alias=run_alias,
+            )
+        return report
+    logger.info(f"Starting run {run_alias}")
+    chains = list(chain_used) if multi_chain else [chain_used]
+    if "me" in chains:
+        # the entities of a text share the first step of the multi-entity chain through the step cache
+        egs = group_entities(egs)
+        if step_cache is None:
+            step_cache = StepCache(max_entries=MULTI_ENTITY_CACHE_ENTRIES)
+    if workers > len(llms):
+        logger.info(
+            f"{workers} workers share {len(llms)} llm backend(s). Calls to a shared backend are serialized, only reading and writing run in parallel"
+        )
+    if prompt_history not in ["structured", "full"]:
+        raise ValueError(
+            f"Unsupported prompt history {prompt_history}. Use structured or full"
+        )
+    if resume and not stream_out:
+        raise ValueError("Only runs streaming out classifications can be resumed")
+    writers = {}
+    blob_stores = {}
+    done_keys = {chain: set() for chain in chains}
+    counts = {chain: {"n_classifications": 0, "error_count": 0} for chain in chains}
+    if stream_out:
+        for chain in chains:
+            run_folder = make_export_folder(
+                export_folder=export_folder,
+                model_used=model_used,
+                chain_used=chain,
+                run_alias=run_alias,
+                resume=resume,
+            )
+            if resume:
+                done_keys[chain], counts[chain] = prepare_resume(
+                    run_folder,
                     model_used=model_used,
-                    chain_used=chain_used,
+                    chain_used=chain,
                     run_alias=run_alias,
-                    true_stance_key=true_stance_key,
                     id_key=id_key,
-                )
-            time.sleep(wait_time)
-        except:
-            # if error return error stance classification
-            logger.error(f"Classification failed for task. Writing error to stance_pred.")
-            eg["run_alias"] = run_alias
-            eg["stance_pred"] = "error"
-            eg["meta"] = {
-                "prompt_history": None
-            }
-            if entity_mask is not None:
-                eg["meta"] = eg["meta"] | {"entity_mask": entity_mask}
-            pred_egs.append(eg)
-            if stream_out:
-                save_classifications_jsonl(
-                    export_folder=export_folder,
-                    egs_with_classifications=pred_egs,
-                    model_used=model_used,
-                    chain_used=chain_used,
-                    run_alias=run_alias,
                     true_stance_key=true_stance_key,
-                    id_key=id_key,
+                    output_format=output_format,
+                    compression=compression,
                 )
-            time.sleep(wait_time)
-    if stream_out:
-        save_run_meta_info_json(
-            export_folder=export_folder,
-            model_used=model_used,
-            chain_used=chain_used,
-            run_alias=run_alias,
-            entity_mask=entity_mask,
+            if prompt_history == "structured":
+                blob_stores[chain] = BlobStore.from_run_folder(run_folder)
+            writers[chain] = get_classification_writer(
+                folder_path=run_folder,
+                model_used=model_used,
+                chain_used=chain,
+                run_alias=run_alias,
+                id_key=id_key,
+                true_stance_key=true_stance_key,
+                output_format=output_format,
+                row_group_size=row_group_size,
+                compression=compression,
+                append=len(done_keys[chain]) > 0,
+            )
+        if resume:
+            # examples classified by all chains are skipped, the others only by the chains that classified them
+            done_everywhere = set.intersection(*done_keys.values())
+            egs = (eg for eg in egs if get_example_key(eg, id_key=id_key) not in done_everywhere)
+            if n_egs is not None:
+                n_egs = max(n_egs - len(done_everywhere), 0)
+    rate_limiter = None
+    if requests_per_minute is not None or tokens_per_minute is not None:
+        rate_limiter = RateLimiter(
+            requests_per_minute=requests_per_minute, tokens_per_minute=tokens_per_minute
+        )
+    pred_egs = {chain: [] for chain in chains} if collect else None
+    retry_queue = RetryQueue()
+    progress = None
+    if show_progress:
+        progress = tqdm(total=n_egs * len(chains) if n_egs is not None else None)
+    chain_writes = {
+        chain: partial(
+            write_classification,
+            pred_egs=pred_egs[chain] if collect else None,
+            writer=writers.get(chain),
+            progress=progress,
+            counts=counts[chain],
+            on_classified=on_classified,
+            blob_store=blob_stores.get(chain),
+        )
+        for chain in chains
+    }
+    classify_kwargs = dict(
+        llms=llms,
+        run_alias=run_alias,
+        retry_queue=retry_queue,
+        retry_policies=retry_policies,
+        chat=chat,
+        llm2=llm2,
+        entity_mask=entity_mask,
+        classification_only=classification_only,
+        timeout=timeout,
+        step_timeout=step_timeout,
+        prompt_history=prompt_history,
+        step_cache=step_cache,
+        rate_limiter=rate_limiter,
+    )
+    if multi_chain:
+        classify = partial(
+            classify_chains_in_worker,
+            chains=chains,
+            blob_stores=blob_stores,
+            done_keys=done_keys if resume else None,
+            id_key=id_key,
+            **classify_kwargs,
         )
+        write = partial(write_chain_classifications, chain_writes=chain_writes)
+    else:
+        classify = partial(
+            classify_in_worker,
+            chain_label=chain_used,
+            blob_store=blob_stores.get(chain_used),
+            ensemble=ensemble,
+            **classify_kwargs,
+        )
+        write = chain_writes[chain_used]
+    if scheduler is not None:
+        egs = scheduler.order(egs)
+        classify = scheduler.skip_deferred(classify)
+    pipeline = ClassificationPipeline(
+        classify=classify,
+        write=write if scheduler is None else scheduler.restore_order(write),
+        workers=workers,
+        queue_size=queue_size,
+        wait_time=wait_time,
+        retry_queue=retry_queue,
+    )
+    try:
+        pipeline.run(egs)
+    finally:
+        if scheduler is not None:
+            scheduler.flush(write)
+        if progress is not None:
+            progress.close()
+        for writer in writers.values():
+            writer.close()
+        for blob_store in blob_stores.values():
+            blob_store.close()
+    if stream_out:
+        for chain in chains:
+            save_run_meta_info_json(
+                export_folder=export_folder,
+                model_used=model_used,
+                chain_used=chain,
+                run_alias=run_alias,
+                entity_mask=entity_mask,
+                classification_only=classification_only,
+                chat=chat,
+                run_stats=counts[chain]
+                | {
+                    "output_format": output_format,
+                    "prompt_history": prompt_history,
+                    "compression": compression,
+                    "pipeline": pipeline.get_stats(),
+                }
+                | ({"chains_run_together": chains} if multi_chain else {})
+                | ({"ensemble": ensemble.describe()} if ensemble is not None else {})
+                | ({"schedule": scheduler.get_stats()} if scheduler is not None else {}),
+            )
     logger.info(f"finished run {run_alias}")
+    if collect and not multi_chain:
+        return pred_egs[chain_used]
     return pred_egs
 
 
-def evaluate(egs_with_preds):
+def evaluate(egs_with_preds, n_bootstrap=0, confidence_level=0.95, seed=None):
     """creates and outputs evaluation metrics: for each stance class: precision, recall, f1, accuracy, and macro (precision, recall, F1, accuracy) and micro (precision, recall, F1, accuracy)
 
     Args:
-        egs_with_preds: list of dictionaries containing predicted stances at a key "stance_pred" and true stances under at key "stance_true"
+        egs_with_preds: iterable of dictionaries containing predicted stances at a key "stance_pred" and true stances under at key "stance_true"
+        n_bootstrap (int, optional): number of bootstrap samples for confidence intervals of accuracy, macro averages and per-class metrics, reported at the key "confidence_intervals" (see stance_llm.metrics.bootstrap_intervals()). Defaults to 0 (no confidence intervals).
+        confidence_level (float, optional): confidence level of the intervals. Defaults to 0.95.
+        seed (optional): seed of the bootstrap resampling. Defaults to None.
     """
+    from sklearn.metrics import classification_report
+    from stance_llm.metrics import EVALUATED_STANCES
+
     y_true = []
     y_pred = []
+    error_types = {}
     for eg in egs_with_preds:
         if eg["stance_pred"] != "error":
             y_pred.append(eg["stance_pred"])
             y_true.append(eg["stance_true"])
-    classes = ["support", "opposition", "irrelevant"]
+        else:
+            error_type = eg.get("meta", {}).get("error", {}).get("type", "unknown")
+            error_types[error_type] = error_types.get(error_type, 0) + 1
     logger.info("Creating evaluation report")
-    eval_metrics = classification_report(
-        y_true, y_pred, labels=classes, output_dict=True
-    )
-    eval_metrics["error_count"] = len([eg for eg in egs_with_preds if eg["stance_pred"] == "error"])
+    if len(y_pred) > 0:
+        eval_metrics = classification_report(
+            y_true, y_pred, labels=EVALUATED_STANCES, output_dict=True
+        )
+    else:
+        logger.warning("No classifications without errors to evaluate")
+        eval_metrics = {}
+    if n_bootstrap > 0 and len(y_pred) > 0:
+        eval_metrics["confidence_intervals"] = get_confidence_intervals(
+            y_true,
+            y_pred,
+            n_bootstrap=n_bootstrap,
+            confidence_level=confidence_level,
+            seed=seed,
+        )
+    error_count = sum(error_types.values())
+    eval_metrics["error_count"] = error_count
+    eval_metrics["error_types"] = error_types
+    if error_count > 0:
+        logger.warning(
+            f"{error_count} examples with classification errors are excluded from evaluation: {error_types}"
+        )
     logger.info(
         f"----------- Evaluation metrics ------------ \n {eval_metrics} \n ------------------"
     )
     return eval_metrics
 
 
+def get_confidence_intervals(
+    y_true: list, y_pred: list, n_bootstrap=1000, confidence_level=0.95, seed=None
+) -> dict:
+    """computes bootstrap confidence intervals of the metrics of evaluate(), keyed like the metrics of classification_report
+
+    Args:
+        y_true (list): true stances
+        y_pred (list): predicted stances, without errors
+        n_bootstrap (int, optional): number of bootstrap samples. Defaults to 1000.
+        confidence_level (float, optional): confidence level of the intervals. Defaults to 0.95.
+        seed (optional): seed of the bootstrap resampling. Defaults to None.
+
+    Returns:
+        dict: [lower, upper] bounds, e.g. {"accuracy": [0.71, 0.83], "macro avg": {"f1-score": [0.65, 0.79], ...}, "support": {"precision": [...], ...}, ...}
+    """
+    from stance_llm.metrics import EVALUATED_STANCES, bootstrap_intervals, encode_stances
+
+    intervals = bootstrap_intervals(
+        encode_stances(y_true),
+        encode_stances(y_pred),
+        n_bootstrap=n_bootstrap,
+        confidence_level=confidence_level,
+        seed=seed,
+    )
+    confidence_intervals = {
+        "confidence_level": confidence_level,
+        "n_bootstrap": n_bootstrap,
+        "accuracy": intervals["accuracy"][:, 0].tolist(),
+        "macro avg": {
+            "precision": intervals["macro_precision"][:, 0].tolist(),
+            "recall": intervals["macro_recall"][:, 0].tolist(),
+            "f1-score": intervals["macro_f1"][:, 0].tolist(),
+        },
+    }
+    for i, stance in enumerate(EVALUATED_STANCES):
+        confidence_intervals[stance] = {
+            "precision": intervals["precision"][:, 0, i].tolist(),
+            "recall": intervals["recall"][:, 0, i].tolist(),
+            "f1-score": intervals["f1"][:, 0, i].tolist(),
+        }
+    return confidence_intervals
+
+
 def save_evaluations_json(
     export_folder: str, eval_metrics, chain_used: str, model_used: str, run_alias: str
 ) -> None:
-    """serializes metrics to metrics.json file at <export_folder/<chain_used>/<model_used>/<current date>/<run_alias>
+    """serializes metrics to metrics.json file at <export_folder/<chain_used>/<model_used>/<current date>/<run_alias> and updates the run index of the export folder (see stance_llm.runs.RunIndex)
 
     Args:
         export_folder: directory target for serialization
-        eval_metrics: dictionary with evaluation metrics per stance class and macro and average (for each: precision ,recall, F1, accuracy)
+        eval_metrics: dictionary with evaluation metrics per stance class and macro and average (for each: precision ,recall, F1, accuracy), and their bootstrap confidence intervals if computed (see evaluate())
         chain_used: prompt chain (short name)
         model_used: llm model name
         run_alias: name of the classification run to be saved
     """
-    export_folder_path = make_export_folder(
+    export_folder_path = get_run_folder(
         export_folder=export_folder,
         chain_used=chain_used,
         model_used=model_used,
@@ -268,7 +1046,8 @@ def save_evaluations_json(
     )
     out_dict = {"run_alias": run_alias, "metrics": eval_metrics}
     logger.info(f"Saving evaluation report to {str(export_folder_path)}")
-    srsly.write_json(os.path.join(export_folder_path, "metrics.json"), out_dict)
+    write_json_atomic(os.path.join(export_folder_path, "metrics.json"), out_dict)
+    update_run_index(export_folder, export_folder_path, metrics=eval_metrics)
 
 
 def save_run_meta_info_json(
@@ -277,8 +1056,11 @@ def save_run_meta_info_json(
     model_used: str,
     run_alias: str,
     entity_mask: str,
+    classification_only=False,
+    chat=True,
+    run_stats=None,
 ) -> None:
-    """serializes run meta information to meta.json file at <export_folder/<chain_used>/<model_used>/<current date>/<run_alias>
+    """serializes run meta information to meta.json file at <export_folder/<chain_used>/<model_used>/<current date>/<run_alias> and updates the run index of the export folder (see stance_llm.runs.RunIndex)
 
     Args:
         export_folder: directory target for serialization
@@ -286,9 +1068,12 @@ def save_run_meta_info_json(
         model_used: llm model name
         run_alias: name of the classification run to be saved
         entity_mask: string used to mask the original entity string in the classified text, if any is given
+        classification_only (bool, optional): whether free-text summaries were skipped or capped in the run. Defaults to False.
+        chat (bool, optional): whether the chat variant of the chain was used. Defaults to True.
+        run_stats (optional): dictionary of statistics of the run to serialize alongside, e.g. pipeline queue stats. Defaults to None.
 
     """
-    export_folder_path = make_export_folder(
+    export_folder_path = get_run_folder(
         export_folder=export_folder,
         chain_used=chain_used,
         model_used=model_used,
@@ -304,9 +1089,45 @@ def save_run_meta_info_json(
         "model_used": model_used,
         "date_run": str(date.today()),
         "entity_masking": entity_masking,
+        "classification_only": classification_only,
+        "chat": chat,
     }
+    if run_stats is not None:
+        out_dict = out_dict | run_stats
     logger.info(f"Saving run meta-information to {str(export_folder_path)}")
-    srsly.write_json(os.path.join(export_folder_path, "meta.json"), out_dict)
+    write_json_atomic(os.path.join(export_folder_path, "meta.json"), out_dict)
+    update_run_index(export_folder, export_folder_path, meta=out_dict)
+
+
+def save_dry_run_json(
+    export_folder: str,
+    report: dict,
+    rendered_egs,
+    model_used: str,
+    chain_used: str,
+    run_alias: str,
+) -> None:
+    """serializes a dry run projection to dry_run.json and the rendered prompts to dry_run_prompts.jsonl at <export_folder/<chain_used>/<model_used>/<current date>/<run_alias>
+
+    Args:
+        export_folder: directory target for serialization
+        report: projection report as returned by stance_llm.estimate.estimate_run
+        rendered_egs: list of examples with rendered prompts as returned by stance_llm.estimate.estimate_run
+        model_used: llm model name
+        chain_used: prompt chain (short name)
+        run_alias: name of the dry run to be saved
+    """
+    export_folder_path = get_run_folder(
+        export_folder=export_folder,
+        chain_used=chain_used,
+        model_used=model_used,
+        run_alias=run_alias,
+    )
+    logger.info(f"Saving dry run projection to {str(export_folder_path)}")
+    write_json_atomic(os.path.join(export_folder_path, "dry_run.json"), report)
+    write_jsonl_atomic(
+        os.path.join(export_folder_path, "dry_run_prompts.jsonl"), rendered_egs
+    )
 
 
 def save_classifications_jsonl(
@@ -329,32 +1150,26 @@ def save_classifications_jsonl(
         id_key (optional): id of the example. Defaults to None.
         true_stance_key (optional): contains true stance. Defaults to None.
     """
-    to_export = []
-    for eg in egs_with_classifications:
-        if "stance_classification" in eg.keys():
-            export_dict = {
-                "text": eg["text"],
-                "ent_text": eg["ent_text"],
-                "statement": eg["statement"],
-                "stance_pred": eg["stance_classification"].stance,
-                "model_used": model_used,
-                "chain_used": chain_used,
-                "run_alias": run_alias,
-                "meta": eg["meta"],
-            }
-            if id_key is not None:
-                export_dict = export_dict | {"id": eg[id_key]}
-            if true_stance_key is not None:
-                export_dict = export_dict | {"stance_true": eg[true_stance_key]}
-            to_export.append(export_dict)
-    export_subfolder = make_export_folder(
+    to_export = [
+        get_export_dict(
+            eg,
+            model_used=model_used,
+            chain_used=chain_used,
+            run_alias=run_alias,
+            id_key=id_key,
+            true_stance_key=true_stance_key,
+        )
+        for eg in egs_with_classifications
+        if "stance_pred" in eg.keys()
+    ]
+    export_subfolder = get_run_folder(
         export_folder=export_folder,
         model_used=model_used,
         chain_used=chain_used,
         run_alias=run_alias,
     )
     filepath = os.path.join(export_subfolder, "classifications.jsonl")
-    srsly.write_jsonl(filepath, to_export)
+    write_jsonl_atomic(filepath, to_export)
 
 
 def prepare_prodigy_egs(prodigy_egs, remove_flagged=True):
@@ -367,52 +1182,114 @@ def prepare_prodigy_egs(prodigy_egs, remove_flagged=True):
         and annotated stances at ["accept"][0]
         remove_flagged (bool, optional): remove examples marked as flagged. defaults to True
     """
-    egs = []
     if remove_flagged:
         logger.info(
             "Removing flagged evaluation examples. To avoid this, set remove_flagged to False"
         )
+    return list(
+        convert_prodigy_egs(prodigy_egs, remove_flagged=remove_flagged, deduplicate=False)
+    )
+
+
+def get_prodigy_task_key(prodigy_eg: dict):
+    """returns the key deduplicating a prodigy annotation: its "_task_hash", or its paragraph id, organisation and statement"""
+    if "_task_hash" in prodigy_eg:
+        return prodigy_eg["_task_hash"]
+    return (prodigy_eg["par_id"], prodigy_eg["meta"]["org_text"], prodigy_eg["statement_de"])
+
+
+def convert_prodigy_egs(prodigy_egs, remove_flagged=True, deduplicate=True):
+    """Converts prodigy annotations to examples for stance classification one at a time, without copying the export
+
+    Args:
+        prodigy_egs: iterable of dicts exported from prodigy db (see prepare_prodigy_egs()), e.g. a generator over a JSONL export
+        remove_flagged (bool, optional): leave out examples marked as flagged. Defaults to True.
+        deduplicate (bool, optional): leave out repeated annotations of a task, e.g. by several annotators, keeping the first (see get_prodigy_task_key()). Defaults to True.
+
+    Returns:
+        generator of dictionaries with keys "id", "text", "ent_text", "statement" and "stance_true"
+    """
+    seen = set()
     for eg in prodigy_egs:
-        refactored = {
+        if remove_flagged and eg.get("flagged") is True:
+            continue
+        if deduplicate:
+            task_key = get_prodigy_task_key(eg)
+            if task_key in seen:
+                continue
+            seen.add(task_key)
+        yield {
             "id": eg["par_id"],
             "text": eg["text"],
             "ent_text": eg["meta"]["org_text"],
             "statement": eg["statement_de"],
             "stance_true": eg["accept"][0],
         }
-        if remove_flagged:
-            if "flagged" in eg.keys():
-                if eg["flagged"] is not True:
-                    egs.append(refactored)
-            if "flagged" not in eg.keys():
-                egs.append(refactored)
-        if remove_flagged is not True:
-            egs.append(refactored)
-    return egs
+
+
+def read_prodigy_egs(path: str, remove_flagged=True, deduplicate=True):
+    """Reads a prodigy JSONL export (optionally compressed) lazily and converts its annotations for stance classification
+
+    The result can be passed to process() or process_evaluate() as egs, which then classify the export as it is read.
+
+    Args:
+        path: path of a .jsonl, .jsonl.gz or .jsonl.zst export of a prodigy dataset (e.g. from prodigy db-out)
+        remove_flagged (bool, optional): leave out examples marked as flagged. Defaults to True.
+        deduplicate (bool, optional): leave out repeated annotations of a task (see convert_prodigy_egs()). Defaults to True.
+
+    Returns:
+        generator of examples (see convert_prodigy_egs())
+    """
+    return convert_prodigy_egs(
+        read_jsonl(path), remove_flagged=remove_flagged, deduplicate=deduplicate
+    )
 
 
 def process_evaluate(
     egs,
     llm,
     model_used: str,
-    chain_used: str,
+    chain_used,
     chat=True,
     wait_time=0.5,
     export_folder="./evaluations",
     llm2=None,
     entity_mask=None,
+    classification_only=False,
+    retry_policies=None,
+    timeout=None,
+    step_timeout=None,
+    collect=True,
+    output_format="jsonl",
+    row_group_size=10000,
+    prompt_history="full",
+    compression=None,
+    n_bootstrap=0,
 ):
     """Process a list of examples to via a llm backend, stream out results, evaluate against true values and save evaluations
 
     Args:
-        egs: A list of dictionary items with a "text" key containing text to classify, a "ent_text" key containing a string for the organizational entity to predict stance for and a "stance_true" key containing a true stance to evaluate against
-        llm: A guidance model backend from guidance.models
+        egs: A list or generator of dictionary items with a "text" key containing text to classify, a "ent_text" key containing a string for the organizational entity to predict stance for and a "stance_true" key containing a true stance to evaluate against, or the path of a .jsonl, .jsonl.gz or .parquet file with such items
+        llm: A guidance model backend from guidance.models, or a backend spec (see process())
         model_used: String giving label for model backend
-        chain_used: An implemented llm chain. See stance_llm.base.get_registered_chains for list
+        chain_used: An implemented llm chain, or a list of chains run together, each evaluated in its own run folder (see process()). See stance_llm.base.get_registered_chains for list
         chat (bool, optional): Should a chat model variant be used? Defaults to True.
         wait_time (int): Wait time (in seconds) between two prompts sent to the llm. Defaults to 5.
         export_folder (str, optional): Folder for evaluation output. Defaults to "./evaluations".
+        classification_only (bool, optional): Skip free-text summaries not needed for the stance label (see detect_stance()). Defaults to False.
+        retry_policies (optional): dictionary mapping error class names to stance_llm.retry.RetryPolicy objects (see process()). Defaults to stance_llm.retry.DEFAULT_RETRY_POLICIES.
+        timeout (optional): seconds allowed for classifying one example (see process()). Defaults to None.
+        step_timeout (optional): seconds allowed for each step of the chain (see process()). Defaults to None.
+        collect (bool, optional): keep the classified examples in memory and return them. If False, the evaluation reads the streamed out classifications back and None is returned (see process()). Defaults to True.
+        output_format (str, optional): format of the streamed out classifications, "jsonl", "parquet" or "arrow" (see process()). Defaults to "jsonl".
+        row_group_size (int, optional): number of classifications per row group written to columnar output (see process()). Defaults to 10000.
+        prompt_history (str, optional): "structured" or "full" prompt history (see process()). Defaults to "full".
+        compression (optional): compression of the classifications output (see process()). Defaults to None.
+        n_bootstrap (int, optional): number of bootstrap samples for confidence intervals of the metrics (see evaluate()). Defaults to 0 (no confidence intervals).
     """
+    multi_chain = isinstance(chain_used, (list, tuple))
+    chains = list(chain_used) if multi_chain else [chain_used]
+    run_alias = make_new_run_alias(export_folder, model_used, chains)
     preds = process(
         egs=egs,
         llm=llm,
@@ -425,22 +1302,170 @@ def process_evaluate(
         chat=chat,
         llm2=llm2,
         entity_mask=entity_mask,
-    )
-    eval_metrics = evaluate(preds)
-    run_alias = preds[0]["run_alias"]
-    assert all([pred["run_alias"] == run_alias for pred in preds])
-    save_evaluations_json(
-        export_folder=export_folder,
-        eval_metrics=eval_metrics,
-        model_used=model_used,
-        chain_used=chain_used,
+        classification_only=classification_only,
+        retry_policies=retry_policies,
+        timeout=timeout,
+        step_timeout=step_timeout,
+        collect=collect,
         run_alias=run_alias,
+        output_format=output_format,
+        row_group_size=row_group_size,
+        prompt_history=prompt_history,
+        compression=compression,
     )
-    save_run_meta_info_json(
-        export_folder=export_folder,
-        model_used=model_used,
-        chain_used=chain_used,
-        run_alias=run_alias,
-        entity_mask=entity_mask,
-    )
+    for chain in chains:
+        if collect:
+            chain_preds = preds[chain] if multi_chain else preds
+        else:
+            run_folder = get_run_folder(
+                export_folder=export_folder,
+                chain_used=chain,
+                model_used=model_used,
+                run_alias=run_alias,
+            )
+            chain_preds = read_classifications(run_folder)
+        save_evaluations_json(
+            export_folder=export_folder,
+            eval_metrics=evaluate(chain_preds, n_bootstrap=n_bootstrap),
+            model_used=model_used,
+            chain_used=chain,
+            run_alias=run_alias,
+        )
     return preds
+
+
+def repair_run(
+    run_folder: str,
+    llm,
+    llm2=None,
+    wait_time=0.5,
+    retry_policies=None,
+    timeout=None,
+    step_timeout=None,
+):
+    """Classifies the examples of an existing run again that failed with stance_pred "error" and merges the results back in place
+
+    Chain, entity mask, chat variant and classification-only setting of the original run are read from its meta.json.
+    The classifications file is rewritten in its format with the repaired examples, and metrics.json is recomputed if the run was evaluated.
+
+    Args:
+        run_folder: folder of the run as created by make_export_folder(), containing meta.json and the classifications (classifications.jsonl, .parquet or .arrow)
+        llm: A guidance model backend from guidance.models, ideally the model used in the original run (see "model_used" in meta.json)
+        llm2 (optional): A second guidance model backend from guidance.models, as in the original run. Defaults to None.
+        wait_time (int): Wait time (in seconds) between two prompts sent to the llm. Defaults to 0.5.
+        retry_policies (optional): dictionary mapping error class names to stance_llm.retry.RetryPolicy objects (see process()). Defaults to stance_llm.retry.DEFAULT_RETRY_POLICIES.
+        timeout (optional): seconds allowed for classifying one example (see process()). Defaults to None.
+        step_timeout (optional): seconds allowed for each step of the chain (see process()). Defaults to None.
+
+    Returns:
+        list: the classifications of the run, with the repaired examples
+    """
+    import srsly
+    from tqdm import tqdm
+
+    run_meta = srsly.read_json(os.path.join(run_folder, "meta.json"))
+    classifications = list(read_classifications(run_folder))
+    entity_mask = run_meta["entity_masking"]
+    if entity_mask == "None":
+        entity_mask = None
+    if "chat" not in run_meta:
+        logger.warning(
+            "meta.json of the run does not record whether a chat model was used. Assuming chat=True"
+        )
+    chat = run_meta.get("chat", True)
+    classification_only = run_meta.get("classification_only", False)
+    # runs before structured prompt histories stored full prompt texts
+    prompt_history = run_meta.get("prompt_history", "full")
+    blob_store = None
+    if prompt_history == "structured":
+        blob_store = BlobStore.from_run_folder(run_folder)
+    error_indices = [
+        i for i, row in enumerate(classifications) if row["stance_pred"] == "error"
+    ]
+    logger.info(
+        f"Repairing {len(error_indices)} of {len(classifications)} classifications of run {run_meta['run_alias']} with chain {run_meta['chain_used']} and model {run_meta['model_used']}"
+    )
+    error_egs = []
+    row_indices = {}
+    for i in error_indices:
+        eg = {
+            "text": classifications[i]["text"],
+            "ent_text": classifications[i]["ent_text"],
+            "statement": classifications[i]["statement"],
+        }
+        row_indices[id(eg)] = i
+        error_egs.append(eg)
+    retry_queue = RetryQueue()
+    for eg, previous_attempts in iter_with_retries(
+        tqdm(error_egs), retry_queue=retry_queue
+    ):
+        i = row_indices[id(eg)]
+        finished = classify_with_retry(
+            eg,
+            attempts=previous_attempts + 1,
+            run_alias=classifications[i]["run_alias"],
+            retry_queue=retry_queue,
+            retry_policies=retry_policies,
+            llm=llm,
+            chain_label=run_meta["chain_used"],
+            chat=chat,
+            llm2=llm2,
+            entity_mask=entity_mask,
+            classification_only=classification_only,
+            timeout=timeout,
+            step_timeout=step_timeout,
+            prompt_history=prompt_history,
+            blob_store=blob_store,
+        )
+        if finished:
+            classifications[i] = classifications[i] | {
+                "stance_pred": eg["stance_pred"],
+                "meta": eg["meta"] | {"repaired": str(date.today())},
+            }
+        time.sleep(wait_time)
+    if blob_store is not None:
+        blob_store.close()
+    writer = get_classification_writer(
+        folder_path=run_folder,
+        model_used=run_meta["model_used"],
+        chain_used=run_meta["chain_used"],
+        run_alias=run_meta["run_alias"],
+        output_format=run_meta.get("output_format", "jsonl"),
+        compression=run_meta.get("compression"),
+        atomic=True,
+    )
+    for row in classifications:
+        writer.write_row(row)
+    writer.close()
+    n_remaining = len([row for row in classifications if row["stance_pred"] == "error"])
+    logger.info(
+        f"Repaired {len(error_indices) - n_remaining} classifications, {n_remaining} errors remain"
+    )
+    run_meta["repairs"] = run_meta.get("repairs", []) + [
+        {
+            "date": str(date.today()),
+            "error_count_before": len(error_indices),
+            "error_count_after": n_remaining,
+        }
+    ]
+    run_meta["error_count"] = n_remaining
+    write_json_atomic(os.path.join(run_folder, "meta.json"), run_meta)
+    # run folders are at <export_folder>/<chain_used>/<model_used>/<date>/<run_alias>
+    export_folder = os.path.abspath(os.path.join(run_folder, *[os.pardir] * 4))
+    update_run_index(export_folder, run_folder, meta=run_meta)
+    metrics_path = os.path.join(run_folder, "metrics.json")
+    if os.path.exists(metrics_path):
+        previous_metrics = srsly.read_json(metrics_path)["metrics"]
+        # confidence intervals are recomputed with the settings of the original evaluation
+        previous_intervals = previous_metrics.get("confidence_intervals", {})
+        eval_metrics = evaluate(
+            classifications,
+            n_bootstrap=previous_intervals.get("n_bootstrap", 0),
+            confidence_level=previous_intervals.get("confidence_level", 0.95),
+        )
+        logger.info(f"Saving recomputed evaluation report to {run_folder}")
+        write_json_atomic(
+            metrics_path, {"run_alias": run_meta["run_alias"], "metrics": eval_metrics}
+        )
+        update_run_index(export_folder, run_folder, metrics=eval_metrics)
+    return classifications
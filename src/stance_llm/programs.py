@@ -0,0 +1,118 @@
+from stance_llm.cache import get_program_key
+
+# guidance programs of the chain steps, keyed by program name and parameters, built on first use
+_STEP_PROGRAMS = {}
+
+# opener and closer grammars of the chat roles, built on first use
+_ROLE_TAGS = {}
+
+
+class StepProgram:
+    """Guidance grammar of a chain step, built once and reused for all examples.
+
+    guidance grammars do not depend on the model they are run with, so one StepProgram serves all models and
+    threads. Its cache key (see stance_llm.cache.get_program_key()) is computed once as well, as describing a
+    grammar takes longer than building it.
+
+    Attributes:
+        name (str): name of the program in build_step_program()
+        grammar: guidance grammar capturing the answer of the step
+        key (str): description of the grammar used in step cache keys
+    """
+
+    def __init__(self, name: str, grammar, key=None):
+        self.name = name
+        self.grammar = grammar
+        self.key = key if key is not None else get_program_key(grammar)
+
+    def __repr__(self):
+        return f"StepProgram({self.name!r})"
+
+    def with_prefix(self, prefix: str):
+        """returns the program preceded by a literal text, e.g. the start of an answer naming the entity
+
+        Args:
+            prefix (str): text the llm answer is forced to start with
+        """
+        return StepProgram(self.name, prefix + self.grammar, key=f"{prefix!r}+{self.key}")
+
+
+def build_step_program(name: str, max_tokens=None, stop=None):
+    """builds the guidance grammar of a chain step
+
+    Args:
+        name (str): "irrelevance", "general_stance", "yes_no", "summary", "summary_v2_stance" or "summary_v2_stance_summary"
+        max_tokens (int, optional): max_tokens of free-text summaries. Defaults to None.
+        stop (str, optional): stop string of free-text summaries. Defaults to None.
+    """
+    from guidance import gen, select
+
+    from stance_llm.base import (
+        IRRELEVANCE_ANSWERS,
+        IRRELEVANCE_ANSWERS2,
+        SUMMARY_V2_MAX_TOKENS,
+        SUMMARY_V2_STANCE_ANSWERS,
+    )
+
+    if name == "irrelevance":
+        return select(list(IRRELEVANCE_ANSWERS.values()), name="answer")
+    if name == "general_stance":
+        return select(list(IRRELEVANCE_ANSWERS2.values()), name="answer_general")
+    if name == "yes_no":
+        return select(["Ja", "Nein"], name="answer")
+    if name == "summary":
+        if stop is None:
+            return gen(name="summary", max_tokens=max_tokens)
+        return gen(name="summary", max_tokens=max_tokens, stop=stop)
+    if name == "summary_v2_stance":
+        return select(list(SUMMARY_V2_STANCE_ANSWERS.values()), name="stance")
+    if name == "summary_v2_stance_summary":
+        return select(list(SUMMARY_V2_STANCE_ANSWERS.values()), name="stance") + gen(
+            name="summary", max_tokens=SUMMARY_V2_MAX_TOKENS
+        )
+    raise ValueError(f"Unknown step program {name}")
+
+
+def get_step_program(name: str, max_tokens=None, stop=None) -> StepProgram:
+    """returns the precompiled program of a chain step, building it on first use (see build_step_program())"""
+    params = (name, max_tokens, stop)
+    program = _STEP_PROGRAMS.get(params)
+    if program is None:
+        # threads building the same program at once keep the first one stored
+        program = _STEP_PROGRAMS.setdefault(
+            params, StepProgram(name, build_step_program(name, max_tokens=max_tokens, stop=stop))
+        )
+    return program
+
+
+def build_multi_entity_program(entities: list) -> StepProgram:
+    """builds the program of the joint step of the multi-entity chain, with one line per entity giving its name and a stance
+
+    The stances are appended to the "stances" capture in the order of the entities. The program depends on the
+    entities of a text, so it is built for every text instead of reused, and keyed by the entities and answers
+    instead of a description of the grammar.
+
+    Args:
+        entities (list): names of the entities, without line breaks
+    """
+    from guidance import select
+
+    from stance_llm.base import MULTI_ENTITY_STANCE_ANSWERS
+
+    answers = list(MULTI_ENTITY_STANCE_ANSWERS.values())
+    grammar = None
+    for entity in entities:
+        line = f"{entity}: " + select(answers, name="stances", list_append=True) + "\n"
+        grammar = line if grammar is None else grammar + line
+    return StepProgram("multi_entity", grammar, key=f"multi_entity:{entities!r}:{answers!r}")
+
+
+def get_role_tags(role: str) -> tuple:
+    """returns the opener and closer grammars of the "user" or "assistant" chat role, building them on first use"""
+    tags = _ROLE_TAGS.get(role)
+    if tags is None:
+        import guidance
+
+        block = getattr(guidance, role)()
+        tags = _ROLE_TAGS.setdefault(role, (block.opener, block.closer))
+    return tags
@@ -0,0 +1,80 @@
+import threading
+import time
+from collections import deque
+
+from loguru import logger
+
+# seconds over which rate limits apply
+RATE_LIMIT_WINDOW = 60.0
+
+
+def count_limited_tokens(prompt: str) -> int:
+    """returns the prompt tokens a call counts against tokens_per_minute, approximated as 4 characters per token"""
+    return len(prompt) // 4
+
+
+class RateLimiter:
+    """Limits the llm calls and prompt tokens sent per minute, shared by all workers of a run.
+
+    Calls are recorded in a sliding window of one minute. A call waits until sending it keeps both the number of
+    calls and the number of tokens in the window within the limits. Limits apply within one process; runs split over
+    several processes divide them between the processes (see stance_llm.cli).
+
+    Attributes:
+        requests_per_minute (int): maximal llm calls per minute, or None
+        tokens_per_minute (int): maximal prompt tokens per minute, or None
+        seconds_waited (float): total time calls waited for the limits
+    """
+
+    def __init__(self, requests_per_minute=None, tokens_per_minute=None):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.seconds_waited = 0.0
+        self._calls = deque()
+        self._tokens_in_window = 0
+        self._lock = threading.Lock()
+
+    def _expire(self, now: float) -> None:
+        while len(self._calls) > 0 and self._calls[0][0] <= now - RATE_LIMIT_WINDOW:
+            _, tokens = self._calls.popleft()
+            self._tokens_in_window -= tokens
+
+    def _get_wait(self, tokens: int, now: float) -> float:
+        """returns the seconds until a call with the given tokens fits into the window, 0 if it fits now"""
+        wait = 0.0
+        if self.requests_per_minute is not None and len(self._calls) >= self.requests_per_minute:
+            i = len(self._calls) - self.requests_per_minute
+            wait = max(wait, self._calls[i][0] + RATE_LIMIT_WINDOW - now)
+        if self.tokens_per_minute is not None:
+            # a call larger than the limit is sent once the window is empty
+            excess = self._tokens_in_window + min(tokens, self.tokens_per_minute) - self.tokens_per_minute
+            for sent_at, sent_tokens in self._calls:
+                if excess <= 0:
+                    break
+                excess -= sent_tokens
+                wait = max(wait, sent_at + RATE_LIMIT_WINDOW - now)
+        return wait
+
+    def acquire(self, tokens=0) -> float:
+        """waits until a call with the given number of prompt tokens is within the limits and records it
+
+        Args:
+            tokens (int, optional): number of prompt tokens of the call. Defaults to 0.
+
+        Returns:
+            float: seconds waited
+        """
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._expire(now)
+                wait = self._get_wait(tokens, now)
+                if wait <= 0:
+                    self._calls.append((now, tokens))
+                    self._tokens_in_window += tokens
+                    self.seconds_waited += waited
+                    return waited
+            logger.debug(f"Waiting {wait:.1f} seconds for rate limits")
+            time.sleep(wait)
+            waited += wait
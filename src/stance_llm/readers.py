@@ -0,0 +1,187 @@
+import gzip
+import io
+import os
+
+from loguru import logger
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+def get_source_format(path: str) -> str:
+    """returns the format of an example file from its extension: "jsonl", "jsonl.gz", "jsonl.zst" or "parquet"
+
+    Args:
+        path: path of the file
+    """
+    path = str(path)
+    if path.endswith(".jsonl.gz") or path.endswith(".json.gz"):
+        return "jsonl.gz"
+    if path.endswith(".jsonl.zst"):
+        return "jsonl.zst"
+    if path.endswith(".jsonl"):
+        return "jsonl"
+    if path.endswith(".parquet"):
+        return "parquet"
+    raise ValueError(
+        f"Unsupported file format of {path}. Use .jsonl, .jsonl.gz, .jsonl.zst or .parquet"
+    )
+
+
+def _open_text(path: str):
+    if path.endswith(".gz"):
+        return gzip.open(path, "rt", encoding="utf8")
+    if path.endswith(".zst"):
+        if zstandard is None:
+            raise ImportError(
+                "Reading zstd compressed files requires the zstandard package. Install it with pip install zstandard"
+            )
+        f = open(path, "rb")
+        reader = zstandard.ZstdDecompressor().stream_reader(f, read_across_frames=True, closefd=True)
+        return io.TextIOWrapper(reader, encoding="utf8")
+    return open(path, "r", encoding="utf8")
+
+
+def _iter_complete_lines(f, path: str):
+    """yields the lines of an open text file up to a truncated last line or compressed frame"""
+    n_lines = 0
+    try:
+        for line in f:
+            if not line.endswith("\n"):
+                logger.warning(f"Skipping incomplete last line of {path} after {n_lines} lines")
+                return
+            n_lines += 1
+            yield line
+    # a character cut off at the end of the file fails to decode
+    except (EOFError, gzip.BadGzipFile, UnicodeDecodeError) as error:
+        logger.warning(f"Stopped reading {path} at a truncated or corrupt frame after {n_lines} lines: {error}")
+    except Exception as error:
+        if zstandard is not None and isinstance(error, zstandard.ZstdError):
+            logger.warning(f"Stopped reading {path} at a truncated or corrupt frame after {n_lines} lines: {error}")
+        else:
+            raise
+
+
+def read_jsonl(path: str):
+    """lazily reads a JSONL file, optionally gzip or zstd compressed, recovering all complete records of a file truncated by a crash
+
+    A record is complete if its line is terminated. A truncated last line or compressed frame is skipped with a
+    warning instead of failing the whole read. A complete line that is not valid JSON is skipped with a warning,
+    and the records after it are still read.
+
+    Args:
+        path: path of a .jsonl, .jsonl.gz or .jsonl.zst file
+
+    Returns:
+        generator of dictionaries
+    """
+    import srsly
+
+    path = str(path)
+    with _open_text(path) as f:
+        for line_number, line in enumerate(_iter_complete_lines(f, path), start=1):
+            if not line.strip():
+                continue
+            try:
+                record = srsly.json_loads(line)
+            except ValueError as error:
+                logger.warning(f"Skipping corrupt line {line_number} of {path}: {error}")
+                continue
+            yield record
+
+
+def _read_parquet(path: str, columns=None, batch_size=1024):
+    import polars as pl
+
+    lazy_egs = pl.scan_parquet(path)
+    if columns is not None:
+        lazy_egs = lazy_egs.select(columns)
+    n_rows = count_egs(path)
+    for offset in range(0, n_rows, batch_size):
+        # the slice is pushed down to the reader, so only the row groups of the batch are loaded.
+        # Categorical columns of different part files are merged under a global string cache
+        with pl.StringCache():
+            batch = lazy_egs.slice(offset, batch_size).collect()
+        yield from batch.iter_rows(named=True)
+
+
+def read_egs(path: str, columns=None, batch_size=1024):
+    """lazily reads examples to classify from a JSONL file, optionally gzip or zstd compressed, or a Parquet file
+
+    Examples are yielded one at a time, so that a corpus does not need to fit into memory. Parquet files are read
+    in batches of rows through polars.
+
+    Args:
+        path: path of a .jsonl, .jsonl.gz, .jsonl.zst or .parquet file with one example per line or row (see detect_stance()), or a glob of .parquet files
+        columns (optional): list of columns to read from a Parquet file, e.g. to skip large columns not needed for classification. Defaults to None (all columns).
+        batch_size (int, optional): number of rows per batch read from a Parquet file. Defaults to 1024.
+
+    Returns:
+        generator of example dictionaries
+    """
+    if "*" not in path and not os.path.exists(path):
+        raise FileNotFoundError(f"No file with examples at {path}")
+    source_format = get_source_format(path)
+    logger.info(f"Reading examples from {path} ({source_format})")
+    if source_format in ["jsonl", "jsonl.gz", "jsonl.zst"]:
+        return read_jsonl(path)
+    return _read_parquet(path, columns=columns, batch_size=batch_size)
+
+
+def count_egs(path: str):
+    """returns the number of examples in a Parquet file from its meta data, or None for JSONL files, whose length is unknown without reading them
+
+    Args:
+        path: path of a .jsonl, .jsonl.gz, .jsonl.zst or .parquet file
+    """
+    import polars as pl
+
+    if get_source_format(path) == "parquet":
+        return pl.scan_parquet(path).select(pl.len()).collect().item()
+    return None
+
+
+def find_classifications_file(run_folder: str) -> str:
+    """returns the path of the classifications file (or folder, for columnar output) of a run, in any of the output formats
+
+    Args:
+        run_folder: folder of the run as created by stance_llm.process.make_export_folder()
+    """
+    for output_format in ["jsonl", "jsonl.gz", "jsonl.zst", "parquet", "arrow"]:
+        path = os.path.join(run_folder, f"classifications.{output_format}")
+        if os.path.exists(path):
+            return path
+    raise FileNotFoundError(f"No classifications file in {run_folder}")
+
+
+def read_classifications(run_folder: str):
+    """lazily reads the classifications of a run from its classifications.jsonl file or its classifications.parquet or classifications.arrow folder
+
+    Args:
+        run_folder: folder of the run as created by stance_llm.process.make_export_folder()
+
+    Returns:
+        generator of serialized classifications (see stance_llm.writers.get_export_dict())
+    """
+    import polars as pl
+    import srsly
+
+    path = find_classifications_file(run_folder)
+    if ".jsonl" in path:
+        yield from read_jsonl(path)
+        return
+    if path.endswith(".parquet"):
+        rows = _read_parquet(os.path.join(path, "*.parquet"))
+    else:
+        rows = (
+            row
+            for part in sorted(os.listdir(path))
+            for row in pl.read_ipc(
+                os.path.join(path, part), memory_map=True
+            ).iter_rows(named=True)
+        )
+    for row in rows:
+        # columnar output stores the nested meta data as JSON strings
+        yield row | {"meta": srsly.json_loads(row["meta"])}
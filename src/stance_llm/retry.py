@@ -0,0 +1,142 @@
+import heapq
+import itertools
+import random
+import threading
+import time
+
+from loguru import logger
+
+
+class RetryPolicy:
+    """Retry policy with exponential backoff and jitter for one class of errors.
+
+    Attributes:
+        max_attempts (int): maximum number of attempts per example, including the first one
+        base_delay (float): delay in seconds before the first retry
+        max_delay (float): upper bound of the delay in seconds
+        jitter (float): fraction of the delay that is randomly subtracted, between 0 and 1
+    """
+
+    def __init__(self, max_attempts=3, base_delay=1.0, max_delay=60.0, jitter=0.5):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.jitter = jitter
+
+    def __repr__(self):
+        return f"RetryPolicy(max_attempts={self.max_attempts}, base_delay={self.base_delay}, max_delay={self.max_delay}, jitter={self.jitter})"
+
+    def get_delay(self, attempts: int) -> float:
+        """returns the delay in seconds before the next attempt, given the number of attempts made so far
+
+        Args:
+            attempts (int): number of attempts made so far
+        """
+        delay = min(self.max_delay, self.base_delay * 2 ** (attempts - 1))
+        return delay * (1 - self.jitter * random.random())
+
+    def should_retry(self, attempts: int) -> bool:
+        """whether another attempt is allowed after the given number of attempts"""
+        return attempts < self.max_attempts
+
+
+# policies are matched by the name of the error class or of one of its base classes, so that errors
+# of llm provider clients (e.g. openai.RateLimitError) are covered without importing the clients
+DEFAULT_RETRY_POLICIES = {
+    "ClassificationTimeout": RetryPolicy(max_attempts=2, base_delay=2.0, max_delay=60.0),
+    "RateLimitError": RetryPolicy(max_attempts=6, base_delay=10.0, max_delay=120.0),
+    "APITimeoutError": RetryPolicy(max_attempts=4, base_delay=2.0, max_delay=60.0),
+    "APIConnectionError": RetryPolicy(max_attempts=4, base_delay=2.0, max_delay=60.0),
+    "InternalServerError": RetryPolicy(max_attempts=4, base_delay=5.0, max_delay=60.0),
+    "TimeoutError": RetryPolicy(max_attempts=3, base_delay=2.0, max_delay=60.0),
+    "ConnectionError": RetryPolicy(max_attempts=3, base_delay=2.0, max_delay=60.0),
+}
+
+
+def get_retry_policy(error: Exception, retry_policies=None):
+    """returns the retry policy matching an error, or None if the error should not be retried
+
+    Args:
+        error: the exception raised while classifying an example
+        retry_policies (optional): dictionary mapping error class names to RetryPolicy objects. Defaults to DEFAULT_RETRY_POLICIES.
+    """
+    if retry_policies is None:
+        retry_policies = DEFAULT_RETRY_POLICIES
+    for error_class in type(error).__mro__:
+        if error_class.__name__ in retry_policies:
+            return retry_policies[error_class.__name__]
+    return None
+
+
+def get_error_info(error: Exception, attempts: int) -> dict:
+    """returns structured information on an error for serialization in the meta data of an example
+
+    Args:
+        error: the exception raised while classifying an example
+        attempts (int): number of attempts made for the example
+    """
+    error_info = {
+        "type": type(error).__name__,
+        "message": str(error),
+        "attempts": attempts,
+    }
+    if getattr(error, "step", None) is not None:
+        error_info["step"] = error.step
+    return error_info
+
+
+class RetryQueue:
+    """Queue of examples whose classification failed with a retryable error, ordered by when they are due.
+
+    Retries are deferred rather than awaited in place, so that a transient provider error does not stall the run.
+    The queue is drained once all other examples have been processed. It can be shared between threads.
+    """
+
+    def __init__(self):
+        self._heap = []
+        self._counter = itertools.count()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._heap)
+
+    def push(self, item, attempts: int, delay: float) -> None:
+        """defers an item to be retried after a delay
+
+        Args:
+            item: the example to retry
+            attempts (int): number of attempts made for the item so far
+            delay (float): delay in seconds before the item is due
+        """
+        with self._lock:
+            heapq.heappush(
+                self._heap,
+                (time.monotonic() + delay, next(self._counter), item, attempts),
+            )
+
+    def pop(self):
+        """waits until the next item is due and returns it together with the number of attempts made so far"""
+        with self._lock:
+            due, _, item, attempts = heapq.heappop(self._heap)
+        wait = due - time.monotonic()
+        if wait > 0:
+            logger.info(f"Waiting {wait:.1f} seconds for next retry")
+            time.sleep(wait)
+        return item, attempts
+
+
+def iter_with_retries(items, retry_queue: RetryQueue):
+    """yields items together with the number of attempts made for them so far, followed by the deferred items of a retry queue
+
+    The retry queue is drained once all items are consumed, including items deferred while draining.
+
+    Args:
+        items: iterable of items to process
+        retry_queue: RetryQueue to which failed items are pushed while processing
+    """
+    for item in items:
+        yield item, 0
+    if len(retry_queue) > 0:
+        logger.info(f"Retrying {len(retry_queue)} deferred examples")
+    while len(retry_queue) > 0:
+        yield retry_queue.pop()
@@ -0,0 +1,225 @@
+import os
+import sqlite3
+from datetime import datetime
+
+from loguru import logger
+
+RUN_INDEX_FILENAME = "runs.sqlite"
+
+RUN_INDEX_COLUMNS = {
+    "run_folder": "TEXT PRIMARY KEY",
+    "run_alias": "TEXT",
+    "chain_used": "TEXT",
+    "model_used": "TEXT",
+    "date_run": "TEXT",
+    "entity_masking": "TEXT",
+    "classification_only": "INTEGER",
+    "chat": "INTEGER",
+    "output_format": "TEXT",
+    "n_classifications": "INTEGER",
+    "error_count": "INTEGER",
+    "seconds": "REAL",
+    "accuracy": "REAL",
+    "macro_f1": "REAL",
+    "meta": "TEXT",
+    "metrics": "TEXT",
+    "updated": "TEXT",
+}
+
+
+class RunIndex:
+    """SQLite index of the runs in an export folder, at <export_folder>/runs.sqlite.
+
+    The index is updated whenever run meta information or evaluation metrics are saved (see
+    stance_llm.process.save_run_meta_info_json() and stance_llm.process.save_evaluations_json()), so that runs can
+    be listed and filtered without walking the export folder. The full meta.json and metrics.json contents are
+    stored as JSON alongside the indexed columns.
+
+    Attributes:
+        export_folder (str): export folder of the runs
+        path (str): path of the SQLite file
+    """
+
+    def __init__(self, export_folder: str):
+        self.export_folder = export_folder
+        self.path = os.path.join(export_folder, RUN_INDEX_FILENAME)
+        os.makedirs(export_folder, exist_ok=True)
+        with self._connect() as connection:
+            columns = ", ".join(
+                f"{name} {column_type}" for name, column_type in RUN_INDEX_COLUMNS.items()
+            )
+            connection.execute(f"CREATE TABLE IF NOT EXISTS runs ({columns})")
+            for column in ["chain_used", "model_used", "date_run"]:
+                connection.execute(
+                    f"CREATE INDEX IF NOT EXISTS runs_{column} ON runs ({column})"
+                )
+
+    def _connect(self):
+        # several processes may write to the index of an export folder, so writers wait for each other
+        return sqlite3.connect(self.path, timeout=30)
+
+    def _upsert(self, run_folder: str, values: dict) -> None:
+        values = {"run_folder": os.path.abspath(run_folder)} | values
+        values["updated"] = datetime.now().isoformat(timespec="seconds")
+        columns = ", ".join(values)
+        placeholders = ", ".join("?" for _ in values)
+        updates = ", ".join(f"{name} = excluded.{name}" for name in values if name != "run_folder")
+        with self._connect() as connection:
+            connection.execute(
+                f"INSERT INTO runs ({columns}) VALUES ({placeholders}) ON CONFLICT(run_folder) DO UPDATE SET {updates}",
+                list(values.values()),
+            )
+
+    def index_meta(self, run_folder: str, meta: dict) -> None:
+        """adds or updates a run with the contents of its meta.json
+
+        Args:
+            run_folder: folder of the run
+            meta: run meta information as serialized to meta.json
+        """
+        import srsly
+
+        values = {
+            "run_alias": meta.get("run_alias"),
+            "chain_used": meta.get("chain_used"),
+            "model_used": meta.get("model_used"),
+            "date_run": meta.get("date_run"),
+            "entity_masking": meta.get("entity_masking"),
+            "classification_only": meta.get("classification_only"),
+            "chat": meta.get("chat"),
+            "output_format": meta.get("output_format", "jsonl"),
+            "meta": srsly.json_dumps(meta),
+        }
+        for key in ["n_classifications", "error_count"]:
+            if key in meta:
+                values[key] = meta[key]
+        if "pipeline" in meta:
+            values["seconds"] = meta["pipeline"].get("seconds")
+        self._upsert(run_folder, values)
+
+    def index_metrics(self, run_folder: str, metrics: dict) -> None:
+        """adds or updates the evaluation metrics of a run, as serialized to metrics.json
+
+        Args:
+            run_folder: folder of the run
+            metrics: evaluation metrics as returned by stance_llm.process.evaluate()
+        """
+        import srsly
+
+        values = {
+            "accuracy": metrics.get("accuracy"),
+            "macro_f1": metrics.get("macro avg", {}).get("f1-score"),
+            "metrics": srsly.json_dumps(metrics),
+        }
+        if "error_count" in metrics:
+            values["error_count"] = metrics["error_count"]
+        self._upsert(run_folder, values)
+
+    def query(
+        self,
+        chain_used=None,
+        model_used=None,
+        entity_masking=None,
+        date_from=None,
+        date_to=None,
+        min_macro_f1=None,
+        order_by="date_run",
+        descending=True,
+        limit=None,
+    ) -> list:
+        """lists runs matching all given filters
+
+        Args:
+            chain_used (optional): prompt chain (short name). Defaults to None.
+            model_used (optional): llm model name. Defaults to None.
+            entity_masking (optional): entity mask, "None" for runs without masking. Defaults to None.
+            date_from (optional): earliest run date as "YYYY-MM-DD". Defaults to None.
+            date_to (optional): latest run date as "YYYY-MM-DD". Defaults to None.
+            min_macro_f1 (optional): minimal macro-averaged F1 score of evaluated runs. Defaults to None.
+            order_by (str, optional): column to sort by, one of RUN_INDEX_COLUMNS. Defaults to "date_run".
+            descending (bool, optional): sort in descending order. Defaults to True.
+            limit (optional): maximal number of runs returned. Defaults to None.
+
+        Returns:
+            list: runs as dictionaries with the indexed columns, and "meta" and "metrics" parsed from JSON
+        """
+        import srsly
+
+        if order_by not in RUN_INDEX_COLUMNS:
+            raise ValueError(f"Cannot order runs by {order_by}")
+        conditions = []
+        params = []
+        for column, value in [
+            ("chain_used", chain_used),
+            ("model_used", model_used),
+            ("entity_masking", entity_masking),
+        ]:
+            if value is not None:
+                conditions.append(f"{column} = ?")
+                params.append(value)
+        for condition, value in [
+            ("date_run >= ?", date_from),
+            ("date_run <= ?", date_to),
+            ("macro_f1 >= ?", min_macro_f1),
+        ]:
+            if value is not None:
+                conditions.append(condition)
+                params.append(value)
+        sql = "SELECT * FROM runs"
+        if len(conditions) > 0:
+            sql += " WHERE " + " AND ".join(conditions)
+        sql += f" ORDER BY {order_by} {'DESC' if descending else 'ASC'}"
+        if limit is not None:
+            sql += " LIMIT ?"
+            params.append(limit)
+        with self._connect() as connection:
+            connection.row_factory = sqlite3.Row
+            rows = connection.execute(sql, params).fetchall()
+        runs = []
+        for row in rows:
+            run = dict(row)
+            for key in ["meta", "metrics", "classification_only", "chat"]:
+                if run[key] is None:
+                    continue
+                run[key] = srsly.json_loads(run[key]) if key in ["meta", "metrics"] else bool(run[key])
+            runs.append(run)
+        return runs
+
+    def rebuild(self) -> int:
+        """indexes all runs in the export folder from their meta.json and metrics.json files, e.g. for runs made before the index existed
+
+        Returns:
+            int: number of runs indexed
+        """
+        import srsly
+
+        n_runs = 0
+        for root, _, files in os.walk(self.export_folder):
+            if "meta.json" not in files:
+                continue
+            self.index_meta(root, srsly.read_json(os.path.join(root, "meta.json")))
+            if "metrics.json" in files:
+                metrics = srsly.read_json(os.path.join(root, "metrics.json"))
+                self.index_metrics(root, metrics["metrics"])
+            n_runs += 1
+        logger.info(f"Indexed {n_runs} runs in {self.path}")
+        return n_runs
+
+
+def update_run_index(export_folder: str, run_folder: str, meta=None, metrics=None) -> None:
+    """updates the run index of an export folder, logging instead of failing the run if the index cannot be written
+
+    Args:
+        export_folder: export folder of the run
+        run_folder: folder of the run
+        meta (optional): run meta information to index. Defaults to None.
+        metrics (optional): evaluation metrics to index. Defaults to None.
+    """
+    try:
+        run_index = RunIndex(export_folder)
+        if meta is not None:
+            run_index.index_meta(run_folder, meta)
+        if metrics is not None:
+            run_index.index_metrics(run_folder, metrics)
+    except sqlite3.Error as error:
+        logger.warning(f"Could not update the run index of {export_folder}: {error}")
@@ -0,0 +1,200 @@
+import itertools
+import threading
+
+from loguru import logger
+
+
+def count_text_switches(egs: list) -> int:
+    """returns the number of neighbouring examples with different texts, i.e. of prompts that cannot reuse the prompt prefix of the example before"""
+    return sum(a["text"] != b["text"] for a, b in zip(egs, egs[1:]))
+
+
+def group_entities(egs, window=1000):
+    """yields the examples with the entities of all examples sharing their text and statement at the key "ent_texts"
+
+    Used by the multi-entity chain "me" to classify the entities of a text together. Examples already listing
+    their entities at "ent_texts" are left unchanged.
+
+    Args:
+        egs: iterable of examples, consumed one window at a time
+        window (int, optional): number of examples grouped together, or None to group all examples at once. Defaults to 1000.
+    """
+    egs = iter(egs)
+    while True:
+        window_egs = list(itertools.islice(egs, window)) if window is not None else list(egs)
+        if len(window_egs) == 0:
+            return
+        entities = {}
+        for eg in window_egs:
+            entities.setdefault((eg["text"], eg["statement"]), {})[eg["ent_text"]] = None
+        for eg in window_egs:
+            if "ent_texts" not in eg:
+                eg["ent_texts"] = list(entities[(eg["text"], eg["statement"])])
+        yield from window_egs
+
+
+class ExampleScheduler:
+    """Reorders the examples of a run to reuse prompt prefixes, and restores the input order of the classifications.
+
+    Examples are read in windows of `window` examples. Within a window, examples sharing a text are classified one
+    after the other, ordered by entity, so that the prompts of a step start with the same text (and entity) as the
+    prompt before. Local backends such as guidance's Transformers and LlamaCpp models keep the KV cache of the
+    previous prompt and only process the tokens after the common prefix. Texts are further bucketed by their length
+    in tokens (approximated as 4 characters per token without a tokenizer), so that prompts of similar length are
+    sent together. Examples of one text keep their order of statements.
+
+    Classifications are written in input order: a classification finished ahead of its turn is held back until all
+    examples before it are written. An example deferred to the retry queue (see stance_llm.retry) gives up its
+    position, so that it does not hold back the examples after it, and its classification is written out of order
+    once retried. At most about a window of classifications is held back.
+
+    Attributes:
+        window (int): number of examples reordered together, or None to reorder all examples at once
+        bucket_tokens (int): width of the length buckets in tokens
+        tokenizer: callable taking a string and returning a list of tokens, or None
+    """
+
+    def __init__(self, window=1000, bucket_tokens=64, tokenizer=None):
+        self.window = window
+        self.bucket_tokens = bucket_tokens
+        self.tokenizer = tokenizer
+        self._positions = {}
+        self._held = {}
+        self._skipped = set()
+        self._deferred = {}
+        self._next_position = 0
+        self._lock = threading.Lock()
+        self._stats = {
+            "windows": 0,
+            "egs": 0,
+            "text_switches_before": 0,
+            "text_switches_after": 0,
+            "max_held": 0,
+            "deferred": 0,
+        }
+
+    def get_length(self, text: str) -> int:
+        """returns the length of a text in tokens"""
+        if self.tokenizer is not None:
+            return len(self.tokenizer(text))
+        return len(text) // 4
+
+    def order_window(self, egs: list) -> list:
+        """returns the examples of a window sorted by length bucket, text and entity"""
+        lengths = {}
+        for eg in egs:
+            if eg["text"] not in lengths:
+                lengths[eg["text"]] = self.get_length(eg["text"])
+        # sorted() is stable, so examples of a text and entity keep their input order
+        return sorted(
+            egs,
+            key=lambda eg: (lengths[eg["text"]] // self.bucket_tokens, eg["text"], eg["ent_text"]),
+        )
+
+    def order(self, egs):
+        """yields the examples in scheduled order, recording their input positions
+
+        Args:
+            egs: iterable of examples, consumed one window at a time
+        """
+        egs = iter(egs)
+        position = 0
+        while True:
+            window = list(itertools.islice(egs, self.window)) if self.window is not None else list(egs)
+            if len(window) == 0:
+                return
+            with self._lock:
+                for eg in window:
+                    self._positions.setdefault(id(eg), []).append(position)
+                    position += 1
+            ordered = self.order_window(window)
+            self._stats["windows"] += 1
+            self._stats["egs"] += len(window)
+            self._stats["text_switches_before"] += count_text_switches(window)
+            self._stats["text_switches_after"] += count_text_switches(ordered)
+            yield from ordered
+
+    def defer(self, eg: dict) -> None:
+        """gives up the input position of an example deferred to the retry queue, so that the examples after it are written without waiting for its retry
+
+        Args:
+            eg: the deferred example
+        """
+        with self._lock:
+            positions = self._positions.get(id(eg))
+            # an example deferred again on retry has given up its position already
+            if not positions:
+                return
+            self._skipped.add(positions.pop(0))
+            if len(positions) == 0:
+                del self._positions[id(eg)]
+            self._deferred[id(eg)] = self._deferred.get(id(eg), 0) + 1
+            self._stats["deferred"] += 1
+
+    def skip_deferred(self, classify):
+        """returns a classify function of a stance_llm.pipeline.ClassificationPipeline that gives up the input positions of the examples it defers (see defer())
+
+        Args:
+            classify: function taking an example, the attempt number and the worker index, returning False if the example was deferred
+        """
+
+        def classify_and_skip(eg: dict, *args, **kwargs) -> bool:
+            finished = classify(eg, *args, **kwargs)
+            if not finished:
+                self.defer(eg)
+            return finished
+
+        return classify_and_skip
+
+    def restore_order(self, write):
+        """returns a write function passing classifications on to write in input order, and retried classifications (see defer()) as they come
+
+        Args:
+            write: function taking a classified example
+        """
+
+        def write_in_order(eg: dict) -> None:
+            retried = None
+            with self._lock:
+                if self._deferred.get(id(eg), 0) > 0:
+                    self._deferred[id(eg)] -= 1
+                    if self._deferred[id(eg)] == 0:
+                        del self._deferred[id(eg)]
+                    retried = eg
+                else:
+                    position = self._positions[id(eg)].pop(0)
+                    if len(self._positions[id(eg)]) == 0:
+                        del self._positions[id(eg)]
+                    self._held[position] = eg
+                    self._stats["max_held"] = max(self._stats["max_held"], len(self._held))
+                # positions given up by deferred examples are released with the next classification written
+                ready = []
+                while self._next_position in self._held or self._next_position in self._skipped:
+                    if self._next_position in self._skipped:
+                        self._skipped.remove(self._next_position)
+                    else:
+                        ready.append(self._held.pop(self._next_position))
+                    self._next_position += 1
+            for ready_eg in ready:
+                write(ready_eg)
+            if retried is not None:
+                write(retried)
+
+        return write_in_order
+
+    def flush(self, write) -> None:
+        """writes classifications still held back, e.g. after a run failed, in input order
+
+        Args:
+            write: function taking a classified example
+        """
+        with self._lock:
+            held = [self._held.pop(position) for position in sorted(self._held)]
+        if len(held) > 0:
+            logger.warning(f"Writing {len(held)} classifications held back for reordering")
+        for eg in held:
+            write(eg)
+
+    def get_stats(self) -> dict:
+        """returns the number of windows and examples scheduled, the neighbouring examples with different texts before and after reordering, the largest number of classifications held back and the number of examples deferred"""
+        return dict(self._stats) | {"window": self.window, "bucket_tokens": self.bucket_tokens}
@@ -0,0 +1,295 @@
+import os
+import random
+from statistics import NormalDist
+
+import numpy as np
+import srsly
+from loguru import logger
+
+from stance_llm.metrics import (
+    EVALUATED_STANCES,
+    bootstrap_intervals,
+    confusion_matrices,
+    encode_stances,
+    metrics_from_confusion,
+)
+from stance_llm.process import (
+    evaluate,
+    make_new_run_alias,
+    process,
+    save_evaluations_json,
+)
+
+SEQUENTIAL_METRICS = ["accuracy", "macro_f1"]
+
+
+def stratified_order(egs: list, stance_key="stance_true", seed=None) -> list:
+    """orders examples so that every prefix contains the stance classes in about the proportions of the whole set
+
+    Examples are shuffled within each class, and the classes are interleaved by the position of each example
+    within its class relative to the class size.
+
+    Args:
+        egs (list): examples with true stances
+        stance_key (str, optional): key of the true stance. Defaults to "stance_true".
+        seed (optional): seed of the shuffling. Defaults to None.
+    """
+    rng = random.Random(seed)
+    by_stance = {}
+    for eg in egs:
+        by_stance.setdefault(eg[stance_key], []).append(eg)
+    positioned = []
+    for stance_egs in by_stance.values():
+        rng.shuffle(stance_egs)
+        for i, eg in enumerate(stance_egs):
+            positioned.append(((i + rng.random()) / len(stance_egs), eg))
+    positioned.sort(key=lambda item: item[0])
+    return [eg for _, eg in positioned]
+
+
+def get_reference_value(reference, metric="macro_f1") -> float:
+    """returns the reference value of a metric, given as a number or as the folder of an evaluated run
+
+    Args:
+        reference: value of the metric, or folder of a run with a metrics.json
+        metric (str, optional): one of SEQUENTIAL_METRICS. Defaults to "macro_f1".
+    """
+    if isinstance(reference, (int, float)):
+        return float(reference)
+    metrics = srsly.read_json(os.path.join(reference, "metrics.json"))["metrics"]
+    if metric == "accuracy":
+        return metrics["accuracy"]
+    return metrics["macro avg"]["f1-score"]
+
+
+class SequentialEvaluator:
+    """Updates evaluation metrics as classifications arrive and decides when a run cannot beat a reference.
+
+    After min_examples classifications and then every check_every classifications, an upper confidence bound of
+    the metric on the whole gold set is computed. For accuracy, a Wilson bound on the accuracy of the examples
+    not classified yet is combined with the correct classifications so far. For macro F1, the upper bound of a
+    bootstrap interval of the classified examples is used, which relies on the examples arriving in random
+    stratified order (see stratified_order()). The run is stopped once the bound falls below the reference.
+    The bound is checked repeatedly, so the confidence level should be high.
+
+    Attributes:
+        n_total (int): number of examples in the gold set
+        reference (float): value of the metric to beat
+        metric (str): "accuracy" or "macro_f1"
+        confidence_level (float): one-sided confidence level of the upper bound
+        min_examples (int): number of classifications before the first check
+        check_every (int): number of classifications between checks
+        stopped (bool): whether the run should be stopped
+        upper_bound (float): upper bound at the last check
+        llm_calls (int): number of llm calls of the classifications so far, without steps answered from a step cache
+    """
+
+    def __init__(
+        self,
+        n_total: int,
+        reference: float,
+        metric="macro_f1",
+        confidence_level=0.99,
+        min_examples=30,
+        check_every=10,
+        n_bootstrap=1000,
+        seed=None,
+    ):
+        if metric not in SEQUENTIAL_METRICS:
+            raise ValueError(f"Unsupported metric {metric}. Use one of {SEQUENTIAL_METRICS}")
+        self.n_total = n_total
+        self.reference = reference
+        self.metric = metric
+        self.confidence_level = confidence_level
+        self.min_examples = min_examples
+        self.check_every = check_every
+        self.n_bootstrap = n_bootstrap
+        self.seed = seed
+        self.y_true = []
+        self.y_pred = []
+        self.error_types = {}
+        self.n_seen = 0
+        self.n_with_calls = 0
+        self.llm_calls = 0
+        self.stopped = False
+        self.upper_bound = None
+        self.stopped_at = None
+
+    def update(self, eg: dict) -> None:
+        """adds a classified example and checks whether the run can still beat the reference"""
+        self.n_seen += 1
+        # the calls of failed examples are not known, so they are left out of the calls per example
+        if "stance_classification" in eg:
+            self.n_with_calls += 1
+            self.llm_calls += sum(
+                not step["cached"] for step in eg["stance_classification"].steps.values()
+            )
+        if eg["stance_pred"] != "error":
+            self.y_true.append(eg["stance_true"])
+            self.y_pred.append(eg["stance_pred"])
+        else:
+            error_type = eg.get("meta", {}).get("error", {}).get("type", "unknown")
+            self.error_types[error_type] = self.error_types.get(error_type, 0) + 1
+        n = len(self.y_pred)
+        if self.stopped or n < self.min_examples or (n - self.min_examples) % self.check_every != 0:
+            return
+        self.upper_bound = self.get_upper_bound()
+        logger.info(
+            f"Upper bound of {self.metric} after {n} classifications: {self.upper_bound:.3f} (reference {self.reference:.3f})"
+        )
+        if self.upper_bound < self.reference:
+            logger.info(
+                f"Stopping run after {self.n_seen} of {self.n_total} examples: {self.metric} cannot beat the reference"
+            )
+            self.stopped = True
+            self.stopped_at = self.n_seen
+
+    def get_upper_bound(self) -> float:
+        """returns the upper confidence bound of the metric on the whole gold set"""
+        y_true = encode_stances(self.y_true)
+        y_pred = encode_stances(self.y_pred)
+        n = len(y_pred)
+        if self.metric == "accuracy":
+            n_correct = int((y_true == y_pred).sum())
+            remaining = max(self.n_total - self.n_seen, 0)
+            z = NormalDist().inv_cdf(self.confidence_level)
+            p = n_correct / n
+            upper = (
+                p
+                + z**2 / (2 * n)
+                + z * np.sqrt(p * (1 - p) / n + z**2 / (4 * n**2))
+            ) / (1 + z**2 / n)
+            return (n_correct + remaining * upper) / (n + remaining)
+        intervals = bootstrap_intervals(
+            y_true,
+            y_pred,
+            n_bootstrap=self.n_bootstrap,
+            confidence_level=2 * self.confidence_level - 1,
+            seed=self.seed,
+            n_classes=len(EVALUATED_STANCES),
+        )
+        return float(intervals["macro_f1"][1, 0])
+
+    def get_current_value(self) -> float:
+        """returns the metric on the examples classified so far"""
+        cm = confusion_matrices(
+            encode_stances(self.y_true),
+            encode_stances(self.y_pred),
+            n_classes=len(EVALUATED_STANCES),
+        )
+        return float(metrics_from_confusion(cm)[self.metric][0])
+
+    def get_evaluated_egs(self) -> list:
+        """returns the true and predicted stances and error types of the examples so far, as input to stance_llm.process.evaluate()"""
+        egs = [
+            {"stance_true": stance_true, "stance_pred": stance_pred}
+            for stance_true, stance_pred in zip(self.y_true, self.y_pred)
+        ]
+        for error_type, count in self.error_types.items():
+            egs += [{"stance_pred": "error", "meta": {"error": {"type": error_type}}}] * count
+        return egs
+
+    def get_report(self) -> dict:
+        """returns the state of the sequential evaluation, including the estimated llm calls saved by stopping early"""
+        n_skipped = self.n_total - self.n_seen
+        calls_per_example = self.llm_calls / self.n_with_calls if self.n_with_calls > 0 else 0.0
+        return {
+            "metric": self.metric,
+            "reference": self.reference,
+            "value": self.get_current_value() if len(self.y_pred) > 0 else None,
+            "upper_bound": self.upper_bound,
+            "confidence_level": self.confidence_level,
+            "stopped_early": self.stopped,
+            "n_classified": self.n_seen,
+            "n_total": self.n_total,
+            "n_skipped": n_skipped,
+            "llm_calls": self.llm_calls,
+            "llm_calls_saved_estimate": round(n_skipped * calls_per_example),
+        }
+
+
+def sequential_evaluate(
+    egs: list,
+    llm,
+    model_used: str,
+    chain_used: str,
+    reference,
+    metric="macro_f1",
+    confidence_level=0.99,
+    min_examples=30,
+    check_every=10,
+    export_folder="./evaluations",
+    seed=None,
+    **process_kwargs,
+) -> dict:
+    """Classifies a gold set in stratified random order, updating metrics online, and stops once the run cannot beat a reference run
+
+    Used to screen chain and model combinations: a candidate that is clearly worse than the best run so far is
+    stopped before classifying the whole gold set. Classifications and metrics are saved as with process_evaluate(),
+    and the state of the sequential evaluation is added to metrics.json at the key "sequential".
+
+    Args:
+        egs (list): examples with a "stance_true" key (see process_evaluate())
+        llm: A guidance model backend from guidance.models
+        model_used: String giving label for model backend
+        chain_used: An implemented llm chain. See stance_llm.base.get_registered_chains for list
+        reference: value of the metric to beat, or folder of an evaluated reference run
+        metric (str, optional): "macro_f1" or "accuracy". Defaults to "macro_f1".
+        confidence_level (float, optional): one-sided confidence level of the upper bound deciding to stop. Defaults to 0.99.
+        min_examples (int, optional): number of classifications before the first check. Defaults to 30.
+        check_every (int, optional): number of classifications between checks. Defaults to 10.
+        export_folder (str, optional): Folder for evaluation output. Defaults to "./evaluations".
+        seed (optional): seed of the stratified order and the bootstrap. Defaults to None.
+        **process_kwargs: further arguments to process(), e.g. chat, wait_time, entity_mask, or collect=False to not keep the classifications in memory
+
+    Returns:
+        dict: the evaluation metrics (see evaluate()) with the sequential evaluation at the key "sequential"
+    """
+    ordered = stratified_order(egs, seed=seed)
+    evaluator = SequentialEvaluator(
+        n_total=len(ordered),
+        reference=get_reference_value(reference, metric=metric),
+        metric=metric,
+        confidence_level=confidence_level,
+        min_examples=min_examples,
+        check_every=check_every,
+        seed=seed,
+    )
+
+    def feed():
+        for eg in ordered:
+            if evaluator.stopped:
+                return
+            yield eg
+
+    # small queues keep the examples read ahead of the stopping decision few
+    process_kwargs.setdefault("queue_size", max(1, process_kwargs.get("workers", 1)))
+    run_alias = make_new_run_alias(export_folder, model_used, [chain_used])
+    preds = process(
+        egs=feed(),
+        llm=llm,
+        export_folder=export_folder,
+        model_used=model_used,
+        chain_used=chain_used,
+        true_stance_key="stance_true",
+        stream_out=True,
+        run_alias=run_alias,
+        on_classified=evaluator.update,
+        **process_kwargs,
+    )
+    report = evaluator.get_report()
+    logger.info(
+        f"Sequential evaluation classified {report['n_classified']} of {report['n_total']} examples, saving about {report['llm_calls_saved_estimate']} llm calls"
+    )
+    # without collecting, the classifications are only on disk and the evaluator's records are evaluated
+    eval_metrics = evaluate(preds if preds is not None else evaluator.get_evaluated_egs()) | {
+        "sequential": report
+    }
+    save_evaluations_json(
+        export_folder=export_folder,
+        eval_metrics=eval_metrics,
+        model_used=model_used,
+        chain_used=chain_used,
+        run_alias=run_alias,
+    )
+    return eval_metrics
@@ -0,0 +1,383 @@
+import gzip
+import os
+import shutil
+
+from loguru import logger
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+# columns with few distinct values, stored dictionary-encoded in columnar output
+CATEGORICAL_COLUMNS = [
+    "ent_text",
+    "statement",
+    "stance_pred",
+    "stance_true",
+    "model_used",
+    "chain_used",
+    "run_alias",
+]
+
+OUTPUT_FORMATS = ["jsonl", "parquet", "arrow"]
+
+COMPRESSION_SUFFIXES = {None: "", "gzip": ".gz", "zstd": ".zst"}
+
+
+def get_export_dict(
+    eg: dict,
+    model_used: str,
+    chain_used: str,
+    run_alias: str,
+    id_key=None,
+    true_stance_key=None,
+) -> dict:
+    """builds the serialized form of a classified example
+
+    Args:
+        eg: classified example with keys "text", "ent_text", "statement", "stance_pred" and "meta"
+        model_used: llm model name
+        chain_used: prompt chain (short name)
+        run_alias: name of the classification run
+        id_key (optional): key of the id of the example. Defaults to None.
+        true_stance_key (optional): key of the true stance of the example. Defaults to None.
+    """
+    export_dict = {
+        "text": eg["text"],
+        "ent_text": eg["ent_text"],
+        "statement": eg["statement"],
+        "stance_pred": eg["stance_pred"],
+        "model_used": model_used,
+        "chain_used": chain_used,
+        "run_alias": run_alias,
+        "meta": eg["meta"],
+    }
+    if id_key is not None:
+        export_dict = export_dict | {"id": eg[id_key]}
+    if true_stance_key is not None:
+        export_dict = export_dict | {"stance_true": eg[true_stance_key]}
+    return export_dict
+
+
+def write_json_atomic(path: str, data) -> None:
+    """writes JSON to a temporary file and renames it to path, so that a crash never leaves a truncated file
+
+    Args:
+        path: path of the JSON file
+        data: JSON-serializable data
+    """
+    import srsly
+
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf8") as f:
+        f.write(srsly.json_dumps(data, indent=2))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def write_jsonl_atomic(path: str, lines) -> None:
+    """writes JSONL to a temporary file and renames it to path, so that a crash never leaves a truncated file
+
+    Args:
+        path: path of the JSONL file
+        lines: iterable of JSON-serializable dictionaries
+    """
+    import srsly
+
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf8") as f:
+        for line in lines:
+            f.write(srsly.json_dumps(line) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def get_compressor(compression: str):
+    """returns a function compressing bytes into one self-contained gzip member or zstd frame
+
+    Concatenated gzip members and zstd frames are valid gzip and zstd streams, so compressed output can be appended
+    to frame by frame. Each frame carries a checksum, so that a frame truncated by a crash is detected when reading.
+
+    Args:
+        compression: "gzip" or "zstd"
+    """
+    if compression == "gzip":
+        return gzip.compress
+    if compression == "zstd":
+        if zstandard is None:
+            raise ImportError(
+                "zstd compression requires the zstandard package. Install it with pip install zstandard"
+            )
+        compressor = zstandard.ZstdCompressor(write_checksum=True)
+        return compressor.compress
+    raise ValueError(f"Unsupported compression {compression}. Use gzip or zstd")
+
+
+class JsonlClassificationWriter:
+    """Appends classified examples to a classifications.jsonl file as they are finished.
+
+    With compression, examples are buffered and appended in self-contained gzip members or zstd frames of
+    frame_size examples (classifications.jsonl.gz or classifications.jsonl.zst), each flushed to disk. After a
+    crash, stance_llm.readers.read_jsonl() recovers all examples up to the last complete line or frame.
+
+    Attributes:
+        filepath (str): path of the classifications.jsonl file
+        model_used (str): llm model name
+        chain_used (str): prompt chain (short name)
+        run_alias (str): name of the classification run
+        id_key (str): key of the id of the examples, if any
+        true_stance_key (str): key of the true stance of the examples, if any
+        compression (str): "gzip", "zstd" or None
+        frame_size (int): number of examples per compressed frame
+        atomic (bool): write to a temporary file renamed to filepath on close, e.g. when rewriting an existing run
+        append (bool): append to an existing file, e.g. when resuming a run
+        n_written (int): number of examples written
+    """
+
+    filename = "classifications.jsonl"
+
+    def __init__(
+        self,
+        folder_path: str,
+        model_used: str,
+        chain_used: str,
+        run_alias: str,
+        id_key=None,
+        true_stance_key=None,
+        compression=None,
+        frame_size=100,
+        atomic=False,
+        append=False,
+    ):
+        if atomic and append:
+            raise ValueError("A classification writer cannot be both atomic and appending")
+        self.filepath = os.path.join(
+            folder_path, self.filename + COMPRESSION_SUFFIXES[compression]
+        )
+        self.model_used = model_used
+        self.chain_used = chain_used
+        self.run_alias = run_alias
+        self.id_key = id_key
+        self.true_stance_key = true_stance_key
+        self.compression = compression
+        self.frame_size = frame_size
+        self.atomic = atomic
+        self.append = append
+        self.n_written = 0
+        self._compress = get_compressor(compression) if compression is not None else None
+        self._lines = []
+        self._write_path = f"{self.filepath}.tmp" if atomic else self.filepath
+        self._file = open(self._write_path, "ab" if append else "wb")
+
+    def write(self, eg: dict) -> None:
+        self.write_row(
+            get_export_dict(
+                eg,
+                model_used=self.model_used,
+                chain_used=self.chain_used,
+                run_alias=self.run_alias,
+                id_key=self.id_key,
+                true_stance_key=self.true_stance_key,
+            )
+        )
+
+    def write_row(self, export_dict: dict) -> None:
+        """writes a classification already in its serialized form (see get_export_dict())"""
+        import srsly
+
+        self._lines.append(srsly.json_dumps(export_dict) + "\n")
+        if self._compress is None or len(self._lines) >= self.frame_size:
+            self.flush()
+
+    def flush(self) -> None:
+        """writes the buffered examples, as one frame if compressed"""
+        if len(self._lines) == 0:
+            return
+        data = "".join(self._lines).encode("utf8")
+        if self._compress is not None:
+            data = self._compress(data)
+        self._file.write(data)
+        self._file.flush()
+        self.n_written += len(self._lines)
+        self._lines = []
+
+    def close(self) -> None:
+        self.flush()
+        os.fsync(self._file.fileno())
+        self._file.close()
+        if self.atomic:
+            os.replace(self._write_path, self.filepath)
+        logger.info(f"Wrote {self.n_written} classifications to {self.filepath}")
+
+
+class ColumnarClassificationWriter:
+    """Writes classified examples to compressed Parquet or Arrow IPC files in row groups as they are finished.
+
+    Each row group is written through polars to a part file in a classifications.parquet or classifications.arrow
+    folder, which polars reads as one table, e.g. with polars.scan_parquet("<run folder>/classifications.parquet/*.parquet").
+    Columns with few distinct values (see CATEGORICAL_COLUMNS) are stored as categoricals, i.e. dictionary-encoded,
+    so that repeated model, chain and run names do not inflate the output. The nested "meta" column varies between
+    chains and is stored as a JSON string. Arrow IPC files are uncompressed by default, so that they can be
+    memory-mapped with polars.read_ipc(memory_map=True).
+
+    Attributes:
+        folder_path (str): path of the classifications.parquet or classifications.arrow folder
+        output_format (str): "parquet" or "arrow"
+        row_group_size (int): number of examples buffered and written per part file
+        compression (str): compression codec
+        append (bool): add part files to an existing folder, e.g. when resuming a run
+        n_written (int): number of examples written
+    """
+
+    def __init__(
+        self,
+        folder_path: str,
+        model_used: str,
+        chain_used: str,
+        run_alias: str,
+        id_key=None,
+        true_stance_key=None,
+        output_format="parquet",
+        row_group_size=10000,
+        compression=None,
+        append=False,
+    ):
+        if output_format not in ["parquet", "arrow"]:
+            raise ValueError(
+                f"Unsupported columnar output format {output_format}. Use parquet or arrow"
+            )
+        self.folder_path = os.path.join(folder_path, f"classifications.{output_format}")
+        self.model_used = model_used
+        self.chain_used = chain_used
+        self.run_alias = run_alias
+        self.id_key = id_key
+        self.true_stance_key = true_stance_key
+        self.output_format = output_format
+        self.row_group_size = row_group_size
+        if compression is None:
+            compression = "zstd" if output_format == "parquet" else "uncompressed"
+        self.compression = compression
+        self.append = append
+        self.n_written = 0
+        self.n_parts = 0
+        self._rows = []
+        if append and os.path.exists(self.folder_path):
+            self.n_parts = len(
+                [name for name in os.listdir(self.folder_path) if name.startswith("part-")]
+            )
+            return
+        if os.path.exists(self.folder_path):
+            shutil.rmtree(self.folder_path)
+        os.makedirs(self.folder_path)
+
+    def write(self, eg: dict) -> None:
+        self.write_row(
+            get_export_dict(
+                eg,
+                model_used=self.model_used,
+                chain_used=self.chain_used,
+                run_alias=self.run_alias,
+                id_key=self.id_key,
+                true_stance_key=self.true_stance_key,
+            )
+        )
+
+    def write_row(self, export_dict: dict) -> None:
+        """buffers a classification already in its serialized form (see get_export_dict()) and writes a row group once the buffer is full"""
+        import srsly
+
+        self._rows.append(export_dict | {"meta": srsly.json_dumps(export_dict["meta"])})
+        if len(self._rows) >= self.row_group_size:
+            self.flush()
+
+    def flush(self) -> None:
+        """writes the buffered examples as one row group"""
+        import polars as pl
+
+        if len(self._rows) == 0:
+            return
+        df = pl.DataFrame(self._rows, infer_schema_length=None).with_columns(
+            [
+                pl.col(column).cast(pl.Categorical)
+                for column in CATEGORICAL_COLUMNS
+                if column in self._rows[0]
+            ]
+        )
+        filepath = os.path.join(
+            self.folder_path, f"part-{self.n_parts:05d}.{self.output_format}"
+        )
+        if self.output_format == "parquet":
+            df.write_parquet(filepath, compression=self.compression)
+        else:
+            df.write_ipc(filepath, compression=self.compression)
+        self.n_written += len(self._rows)
+        self.n_parts += 1
+        self._rows = []
+
+    def close(self) -> None:
+        self.flush()
+        logger.info(
+            f"Wrote {self.n_written} classifications in {self.n_parts} row groups to {self.folder_path}"
+        )
+
+
+def get_classification_writer(
+    folder_path: str,
+    model_used: str,
+    chain_used: str,
+    run_alias: str,
+    id_key=None,
+    true_stance_key=None,
+    output_format="jsonl",
+    row_group_size=10000,
+    compression=None,
+    atomic=False,
+    append=False,
+):
+    """returns a writer for classified examples in the given output format
+
+    Args:
+        folder_path: folder of the run (see stance_llm.process.make_export_folder())
+        model_used: llm model name
+        chain_used: prompt chain (short name)
+        run_alias: name of the classification run
+        id_key (optional): key of the id of the examples. Defaults to None.
+        true_stance_key (optional): key of the true stance of the examples. Defaults to None.
+        output_format (str, optional): one of OUTPUT_FORMATS. Defaults to "jsonl".
+        row_group_size (int, optional): number of examples per row group of columnar output. Defaults to 10000.
+        compression (optional): "gzip" or "zstd" for JSONL output, or a compression codec of columnar output. Defaults to None (uncompressed JSONL, see ColumnarClassificationWriter for columnar output).
+        atomic (bool, optional): write JSONL output to a temporary file renamed on close. Defaults to False.
+        append (bool, optional): add to the existing classifications of the run instead of replacing them. Defaults to False.
+    """
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError(
+            f"Unsupported output format {output_format}. Use one of {OUTPUT_FORMATS}"
+        )
+    if output_format == "jsonl":
+        return JsonlClassificationWriter(
+            folder_path=folder_path,
+            model_used=model_used,
+            chain_used=chain_used,
+            run_alias=run_alias,
+            id_key=id_key,
+            true_stance_key=true_stance_key,
+            compression=compression,
+            atomic=atomic,
+            append=append,
+        )
+    return ColumnarClassificationWriter(
+        folder_path=folder_path,
+        model_used=model_used,
+        chain_used=chain_used,
+        run_alias=run_alias,
+        id_key=id_key,
+        true_stance_key=true_stance_key,
+        output_format=output_format,
+        row_group_size=row_group_size,
+        compression=compression,
+        append=append,
+    )
@@ -50,6 +50,23 @@ def gpt2_trf():
     return gpt2_trf
 
 
+@pytest.fixture(scope="module")
+def llamacpp_gguf():
+    # quantized GGUF model for the llama.cpp backend, given by the STANCE_LLM_GGUF environment variable
+    pytest.importorskip("llama_cpp")
+    path = os.environ.get("STANCE_LLM_GGUF")
+    if path is None or not os.path.isfile(path):
+        pytest.skip("Set STANCE_LLM_GGUF to the path of a GGUF model to test the llama.cpp backend")
+    return path
+
+
+@pytest.fixture(scope="module")
+def mock_llm():
+    # guidance mock model, runs offline and is used where only the mechanics of a chain are tested
+    mock_llm = models.Mock()
+    return mock_llm
+
+
 # RUN STANCE DETECTIONS FOR ALL CHAINS --------------
 
 
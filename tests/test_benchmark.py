@@ -0,0 +1,97 @@
+import os
+import shutil
+
+import polars as pl
+
+from stance_llm.base import get_registered_chains
+from stance_llm.benchmark import cheapest_meeting_target, pareto_frontier, run_benchmark
+from stance_llm.cache import StepCache, get_model_id
+from stance_llm.process import detect_stance
+
+
+def test_step_cache_answers_shared_steps(test_examples, mock_llm):
+    """Test if a step shared by two chains is answered from the cache with the same outputs"""
+    step_cache = StepCache()
+    first = detect_stance(test_examples[0], llm=mock_llm, chain_label="is", chat=False, step_cache=step_cache)
+    second = detect_stance(test_examples[0], llm=mock_llm, chain_label="is2", chat=False, step_cache=step_cache)
+    assert not first.steps["irrelevance"]["cached"]
+    assert step_cache.hits >= 1
+    cached_steps = [step for step in second.steps.values() if step["cached"]]
+    assert len(cached_steps) >= 1
+    again = detect_stance(test_examples[0], llm=mock_llm, chain_label="is", chat=False, step_cache=step_cache)
+    assert again.stance == first.stance
+    assert all(step["cached"] for step in again.steps.values())
+    assert again.steps["irrelevance"]["seconds"] == first.steps["irrelevance"]["seconds"]
+
+
+def test_step_cache_persists(test_examples, mock_llm, test_output_dir):
+    """Test if a step cache written to SQLite answers steps after reopening"""
+    os.makedirs(test_output_dir, exist_ok=True)
+    path = os.path.join(test_output_dir, "steps.sqlite")
+    step_cache = StepCache(path)
+    first = detect_stance(test_examples[1], llm=mock_llm, chain_label="is", chat=False, step_cache=step_cache)
+    step_cache.close()
+    reopened = StepCache(path)
+    again = detect_stance(test_examples[1], llm=mock_llm, chain_label="is", chat=False, step_cache=reopened)
+    reopened.close()
+    shutil.rmtree(test_output_dir)
+    assert again.stance == first.stance
+    assert all(step["cached"] for step in again.steps.values())
+
+
+class LocalModel:
+    """Stands in for a guidance Transformers model, identified by the path of its weights"""
+
+    def __init__(self, name_or_path):
+        self.model_obj = type("Weights", (), {"name_or_path": name_or_path})()
+
+
+def test_step_cache_tells_local_models_apart():
+    """Test if local models loaded from different weights get different keys and unidentified models are not cached"""
+    step_cache = StepCache()
+    keys = [
+        step_cache.make_key(LocalModel(path), False, "Prompt", "program")
+        for path in ["models/a", "models/b", "models/a"]
+    ]
+    assert keys[0] != keys[1]
+    assert keys[0] == keys[2]
+    assert get_model_id(object()) is None
+    assert step_cache.make_key(object(), False, "Prompt", "program") is None
+
+
+def test_pareto_frontier():
+    """Test if dominated chains are left off the frontier and the cheapest chain reaching a target is found"""
+    table = pl.DataFrame(
+        {
+            "chain": ["a", "b", "c", "d"],
+            "cost": [1.0, 2.0, 3.0, 4.0],
+            "macro_f1": [0.5, 0.4, 0.7, 0.7],
+        }
+    )
+    frontier = pareto_frontier(table)
+    assert frontier.filter(pl.col("pareto"))["chain"].to_list() == ["a", "c"]
+    assert cheapest_meeting_target(frontier, 0.6)["chain"] == "c"
+    assert cheapest_meeting_target(frontier, 0.9) is None
+
+
+def test_run_benchmark(test_examples, mock_llm, test_output_dir):
+    """Test if all chains are benchmarked, shared steps are cached and the report is written"""
+    table = run_benchmark(
+        egs=test_examples,
+        llms={"mock": mock_llm},
+        chat=False,
+        export_folder=test_output_dir,
+        costs={"mock": (0.5, 1.5)},
+        tokenizer=lambda text: text.split(),
+        target=0.0,
+    )
+    files = sorted(os.listdir(test_output_dir))
+    report = open(os.path.join(test_output_dir, "pareto.md"), encoding="utf8").read()
+    shutil.rmtree(test_output_dir)
+    assert sorted(table["chain"].to_list()) == sorted(get_registered_chains())
+    assert files == ["benchmark.csv", "benchmark.json", "pareto.md"]
+    assert (table["llm_calls"] >= len(test_examples)).all()
+    assert table["cached_calls"].sum() > 0
+    assert (table["cost"] > 0).all()
+    assert table["pareto"].any()
+    assert "Cheapest chain reaching a macro F1 of 0.0" in report
@@ -0,0 +1,90 @@
+import os
+import shutil
+import time
+
+import pytest
+import srsly
+
+from stance_llm.backends import get_backend_chat, get_backend_label, parse_backend_spec
+from stance_llm.cli import load_config, main, run_config, validate_config
+from stance_llm.ratelimit import RateLimiter
+from stance_llm.readers import read_classifications
+
+
+@pytest.fixture
+def run_config_file(test_examples, test_output_dir):
+    os.makedirs(test_output_dir, exist_ok=True)
+    input_path = os.path.join(test_output_dir, "egs.jsonl")
+    egs = [dict(eg, id=f"{i}-{j}") for i in range(4) for j, eg in enumerate(test_examples)]
+    srsly.write_jsonl(input_path, egs)
+    config_path = os.path.join(test_output_dir, "config.yaml")
+    srsly.write_yaml(
+        config_path,
+        {
+            "input": input_path,
+            "chain": "is",
+            "backend": "mock",
+            "export_folder": os.path.join(test_output_dir, "runs"),
+            "id_key": "id",
+            "workers": 2,
+            "evaluate": True,
+        },
+    )
+    yield config_path
+    shutil.rmtree(test_output_dir)
+
+
+def test_backend_spec():
+    """Test if backend specs are parsed from strings and labelled"""
+    spec = parse_backend_spec("openai:gpt-3.5-turbo")
+    assert spec == {"type": "openai", "model": "gpt-3.5-turbo"}
+    assert get_backend_label(spec) == "openai-gpt-3.5-turbo"
+    assert get_backend_chat(spec)
+    assert not get_backend_chat({"type": "transformers", "model": "gpt2"})
+    with pytest.raises(ValueError):
+        parse_backend_spec("unknown:model")
+
+
+def test_validate_config():
+    """Test if defaults are filled in and unknown or missing keys are rejected"""
+    config = validate_config({"input": "egs.jsonl", "chain": "is", "backend": "mock"})
+    assert config["model_used"] == "mock"
+    assert config["workers"] == 1
+    with pytest.raises(ValueError):
+        validate_config({"input": "egs.jsonl", "chain": "is", "backend": "mock", "worker": 2})
+    with pytest.raises(ValueError):
+        validate_config({"input": "egs.jsonl", "backend": "mock"})
+
+
+def test_cli_run_and_resume(run_config_file):
+    """Test if the command runs a config, evaluates it and resumes it without classifying examples twice"""
+    assert main(["run", run_config_file, "--resume"]) == 0
+    config = load_config(run_config_file)
+    run_folders = run_config(config | {"resume": True})
+    assert len(run_folders) == 1
+    assert len(os.listdir(os.path.dirname(run_folders[0]))) == 1
+    classifications = list(read_classifications(run_folders[0]))
+    assert len(classifications) == 12
+    assert len({row["id"] for row in classifications}) == 12
+    assert os.path.exists(os.path.join(run_folders[0], "metrics.json"))
+    assert srsly.read_json(os.path.join(run_folders[0], "config.json"))["chain"] == "is"
+
+
+def test_cli_run_processes(run_config_file):
+    """Test if a config run with several processes classifies every example once across the shards"""
+    run_folders = run_config(load_config(run_config_file) | {"processes": 2})
+    assert len(run_folders) == 2
+    ids = [row["id"] for run_folder in run_folders for row in read_classifications(run_folder)]
+    assert sorted(ids) == sorted(f"{i}-{j}" for i in range(4) for j in range(3))
+
+
+def test_rate_limiter_waits():
+    """Test if calls beyond the limit wait until earlier calls leave the window"""
+    rate_limiter = RateLimiter(requests_per_minute=2)
+    rate_limiter._calls.append((time.monotonic() - 59.8, 0))
+    assert rate_limiter.acquire() == 0.0
+    assert rate_limiter.acquire() > 0.0
+    token_limiter = RateLimiter(tokens_per_minute=100)
+    assert token_limiter.acquire(tokens=60) == 0.0
+    token_limiter._calls[0] = (time.monotonic() - 59.9, 60)
+    assert token_limiter.acquire(tokens=60) > 0.0
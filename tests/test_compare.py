@@ -0,0 +1,99 @@
+import os
+import shutil
+
+import numpy as np
+import polars as pl
+from scipy.stats import chi2
+from sklearn.metrics import classification_report
+
+from stance_llm.compare import compare_runs
+from stance_llm.metrics import (
+    EVALUATED_STANCES,
+    bootstrap_intervals,
+    confusion_matrices,
+    metrics_from_confusion,
+    pairwise_mcnemar,
+)
+from stance_llm.process import evaluate, process_evaluate
+from stance_llm.runs import RunIndex
+
+
+def test_vectorized_metrics_match_sklearn():
+    """Test if metrics computed for several runs at once equal those of sklearn per run"""
+    rng = np.random.default_rng(0)
+    y_true = rng.integers(0, 3, size=200)
+    y_pred = rng.integers(-1, 3, size=(4, 200))
+    metrics = metrics_from_confusion(confusion_matrices(y_true, y_pred, 3))
+    for run in range(4):
+        valid = y_pred[run] >= 0
+        report = classification_report(
+            y_true[valid], y_pred[run][valid], labels=[0, 1, 2], output_dict=True, zero_division=0
+        )
+        assert np.isclose(metrics["macro_f1"][run], report["macro avg"]["f1-score"])
+        assert np.isclose(metrics["f1"][run, 1], report["1"]["f1-score"])
+        assert np.isclose(metrics["accuracy"][run], (y_true[valid] == y_pred[run][valid]).mean())
+
+
+def test_pairwise_mcnemar():
+    """Test if McNemar tests count discordant pairs and give p-values of the chi-squared distribution"""
+    correct = np.array([[1] * 20 + [0] * 5, [0] * 20 + [1] * 5]).astype(bool)
+    mcnemar = pairwise_mcnemar(correct)
+    assert mcnemar["only_first_correct"][0, 1] == 20
+    assert mcnemar["only_second_correct"][0, 1] == 5
+    assert np.isclose(mcnemar["statistic"][0, 1], 14**2 / 25)
+    assert np.isclose(mcnemar["p_value"][0, 1], chi2.sf(14**2 / 25, df=1))
+    assert mcnemar["p_value"][0, 0] == 1.0
+
+
+def test_compare_runs_writes_comparison_table(test_examples, mock_llm, test_output_dir):
+    """Test if runs on the same examples are joined and compared in one table"""
+    for chain_used in ["is", "sis", "nise"]:
+        process_evaluate(
+            egs=[dict(eg) for eg in test_examples],
+            llm=mock_llm,
+            export_folder=test_output_dir,
+            chain_used=chain_used,
+            model_used="mock",
+            chat=False,
+            wait_time=0,
+        )
+    run_folders = [run["run_folder"] for run in RunIndex(test_output_dir).query()]
+    export_path = os.path.join(test_output_dir, "comparison.csv")
+    comparison = compare_runs(run_folders, export_path=export_path)
+    runs_table = pl.read_csv(export_path)
+    pairs_table = pl.read_csv(os.path.join(test_output_dir, "comparison_pairs.csv"))
+    shutil.rmtree(test_output_dir)
+    assert comparison["runs"].height == 3
+    assert runs_table.height == 3
+    assert pairs_table.height == 3
+    assert all(n == len(test_examples) for n in runs_table["n"])
+    assert f"{EVALUATED_STANCES[0]}_f1" in runs_table.columns
+    assert all(0 <= p <= 1 for p in pairs_table["mcnemar_p_value"])
+
+
+def test_bootstrap_intervals_cover_point_estimates():
+    """Test if bootstrap intervals of several runs contain their point estimates and narrow with more examples"""
+    rng = np.random.default_rng(1)
+    y_true = rng.integers(0, 3, size=300)
+    y_pred = np.where(rng.random((2, 300)) < 0.7, y_true, rng.integers(0, 3, size=(2, 300)))
+    metrics = metrics_from_confusion(confusion_matrices(y_true, y_pred, 3))
+    intervals = bootstrap_intervals(y_true, y_pred, n_bootstrap=2000, seed=0, chunk_size=300)
+    assert intervals["macro_f1"].shape == (2, 2)
+    assert intervals["f1"].shape == (2, 2, 3)
+    assert np.all(intervals["accuracy"][0] <= metrics["accuracy"])
+    assert np.all(intervals["accuracy"][1] >= metrics["accuracy"])
+    small = bootstrap_intervals(y_true[:50], y_pred[:, :50], n_bootstrap=2000, seed=0)
+    assert np.all(
+        np.diff(small["accuracy"], axis=0) > np.diff(intervals["accuracy"], axis=0)
+    )
+
+
+def test_evaluate_reports_confidence_intervals(test_examples):
+    """Test if evaluate reports bootstrap intervals keyed like its metrics"""
+    egs = [eg | {"stance_pred": eg["stance_true"]} for eg in test_examples]
+    eval_metrics = evaluate(egs, n_bootstrap=200, seed=0)
+    intervals = eval_metrics["confidence_intervals"]
+    assert intervals["n_bootstrap"] == 200
+    assert intervals["accuracy"] == [1.0, 1.0]
+    assert set(intervals["macro avg"]) == {"precision", "recall", "f1-score"}
+    assert "support" in intervals
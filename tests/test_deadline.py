@@ -0,0 +1,139 @@
+import shutil
+import threading
+import time
+
+import pytest
+
+from stance_llm.process import process
+from stance_llm.deadline import ClassificationTimeout, Deadline, run_with_deadline
+
+
+class SlowLLM:
+    """Wraps a guidance model and delays every call"""
+
+    def __init__(self, llm, delay):
+        self.llm = llm
+        self.delay = delay
+
+    def __add__(self, other):
+        time.sleep(self.delay)
+        return self.llm + other
+
+
+class ConcurrencyProbe(SlowLLM):
+    """Slow model wrapper recording the largest number of calls running at once"""
+
+    def __init__(self, llm, delay):
+        super().__init__(llm, delay)
+        self.running = 0
+        self.max_running = 0
+        self._lock = threading.Lock()
+
+    def __add__(self, other):
+        with self._lock:
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+        try:
+            return super().__add__(other)
+        finally:
+            with self._lock:
+                self.running -= 1
+
+
+def test_run_with_deadline_returns_result():
+    """Test if functions finishing before the deadline return their result"""
+    assert run_with_deadline(lambda x: x + 1, Deadline(timeout=5), 1) == 2
+
+
+def test_run_with_deadline_raises_with_step():
+    """Test if an expired step deadline raises ClassificationTimeout with the step reached"""
+    deadline = Deadline(step_timeout=0.1)
+
+    def slow_chain():
+        deadline.start_step("summary")
+        time.sleep(1)
+        deadline.start_step("stance")
+
+    with pytest.raises(ClassificationTimeout) as error:
+        run_with_deadline(slow_chain, deadline)
+    assert error.value.step == "summary"
+
+
+def test_process_marks_timeouts_and_continues(test_examples, mock_llm, test_output_dir):
+    """Test if examples exceeding their deadline are marked as timeouts while the run goes on"""
+    preds = process(
+        egs=[dict(eg) for eg in test_examples],
+        llm=SlowLLM(mock_llm, delay=1),
+        export_folder=test_output_dir,
+        chain_used="is",
+        model_used="mock",
+        chat=False,
+        wait_time=0,
+        timeout=0.2,
+        retry_policies={},
+    )
+    shutil.rmtree(test_output_dir)
+    assert len(preds) == len(test_examples)
+    assert all(pred["stance_pred"] == "error" for pred in preds)
+    assert all(pred["meta"]["error"]["type"] == "ClassificationTimeout" for pred in preds)
+    assert all(pred["meta"]["error"]["step"] == "irrelevance" for pred in preds)
+
+
+def test_timeouts_do_not_overlap_llm_calls(test_examples, mock_llm, test_output_dir):
+    """Test if the next example and retries wait for the llm call still running when a deadline expired"""
+    llm = ConcurrencyProbe(mock_llm, delay=0.3)
+    process(
+        egs=[dict(eg) for eg in test_examples],
+        llm=llm,
+        export_folder=test_output_dir,
+        chain_used="is",
+        model_used="mock",
+        chat=False,
+        wait_time=0,
+        workers=1,
+        timeout=0.1,
+    )
+    shutil.rmtree(test_output_dir)
+    assert llm.max_running == 1
+
+
+class HangingLLM:
+    """Wraps a guidance model and blocks every call until released, like a connection that never answers"""
+
+    def __init__(self, llm):
+        self.llm = llm
+        self.released = threading.Event()
+
+    def __add__(self, other):
+        self.released.wait()
+        return self.llm + other
+
+
+def test_timeouts_bound_llm_calls_that_never_return(test_examples, mock_llm, test_output_dir):
+    """Test if a run with one worker goes on past an llm call that never returns and times out the examples waiting for it"""
+    llm = HangingLLM(mock_llm)
+    outcome = {}
+
+    def run():
+        outcome["preds"] = process(
+            egs=[dict(eg) for eg in test_examples],
+            llm=llm,
+            export_folder=test_output_dir,
+            chain_used="is",
+            model_used="mock",
+            chat=False,
+            wait_time=0,
+            workers=1,
+            timeout=0.2,
+            retry_policies={},
+        )
+
+    runner = threading.Thread(target=run, daemon=True)
+    runner.start()
+    runner.join(timeout=30)
+    finished = not runner.is_alive()
+    llm.released.set()
+    shutil.rmtree(test_output_dir, ignore_errors=True)
+    assert finished, "The run blocked on an llm call that never returns"
+    assert len(outcome["preds"]) == len(test_examples)
+    assert all(pred["meta"]["error"]["type"] == "ClassificationTimeout" for pred in outcome["preds"])
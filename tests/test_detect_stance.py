@@ -1,4 +1,5 @@
 from stance_llm.base import StanceClassification, ALLOWED_STANCE_CATEGORIES
+from stance_llm.process import detect_stance
 
 # from dotenv import load_dotenv
 # load_dotenv(".env")
@@ -49,3 +50,29 @@ def test_detect_stance_masked_returns_correct_entity(
 ):
     """Test if masked stance detection runs return the correct entity string"""
     assert stance_detection_run_masked_openai.entity == test_examples[0]["ent_text"]
+
+
+def test_detect_stance_classification_only_skips_summary(test_examples, mock_llm):
+    """Test if classification-only runs stop after the stance selection and record the skipped rationale"""
+    run = detect_stance(
+        eg=test_examples[0],
+        llm=mock_llm,
+        chain_label="s2",
+        chat=False,
+        classification_only=True,
+    )
+    assert run.stance in ALLOWED_STANCE_CATEGORIES
+    assert run.meta["rationale_skipped"] is True
+    assert run.meta["llms"]["summary"].get("summary") is None
+
+
+def test_rationale_skipped_only_for_chains_with_summaries(test_examples, mock_llm):
+    """Test if a chain without a free-text summary does not record a skipped rationale in classification-only runs"""
+    run = detect_stance(
+        eg=test_examples[0],
+        llm=mock_llm,
+        chain_label="is",
+        chat=False,
+        classification_only=True,
+    )
+    assert run.meta["rationale_skipped"] is False
@@ -0,0 +1,112 @@
+import os
+import shutil
+import threading
+import time
+
+import srsly
+
+from stance_llm.ensemble import Ensemble, EnsembleMember, vote
+from stance_llm.pool import ModelPool
+from stance_llm.process import detect_stance, find_run_folder, process
+from stance_llm.readers import read_classifications
+
+
+def test_vote():
+    """Test if weighted votes pick the heaviest stance and ties go to the earliest member"""
+    stance, distribution = vote(["support", "opposition", "opposition", None], [1.0, 0.4, 0.4, 1.0])
+    assert stance == "support"
+    assert abs(distribution["support"] - 1 / 1.8) < 1e-9
+    stance, _ = vote(["opposition", "support"], [1.0, 1.0])
+    assert stance == "opposition"
+
+
+def test_ensemble_detect_stance(test_examples, mock_llm):
+    """Test if an ensemble votes over its members, shares steps between them and records the vote"""
+    ensemble = Ensemble(
+        [
+            EnsembleMember("is"),
+            EnsembleMember("is2"),
+            EnsembleMember("is", entity_mask="Organisation X"),
+        ],
+        voting="probability",
+    )
+    classification = detect_stance(
+        test_examples[0], llm=mock_llm, chain_label="is", chat=False, ensemble=ensemble
+    )
+    vote_meta = classification.meta["ensemble"]
+    assert classification.stance in ["support", "opposition", "irrelevant"]
+    assert len(vote_meta["votes"]) == 3
+    assert abs(sum(vote_meta["distribution"].values()) - 1.0) < 1e-9
+    assert vote_meta["agreement"] == vote_meta["distribution"][classification.stance]
+    # the irrelevance step of "is" and "is2" has the same prompt and program
+    assert ensemble.step_cache.hits >= 1
+    assert any(step.startswith("2:is/run-llm/masked/") for step in classification.steps)
+
+
+def test_ensemble_process(test_examples, mock_llm, test_output_dir):
+    """Test if process stores the vote of an ensemble with every classification and the ensemble in meta.json"""
+    ensemble = Ensemble([EnsembleMember("is"), EnsembleMember("nise")])
+    process(
+        egs=test_examples,
+        llm=mock_llm,
+        export_folder=test_output_dir,
+        model_used="mock",
+        chain_used="ensemble",
+        chat=False,
+        wait_time=0,
+        run_alias="ensemble-run",
+        ensemble=ensemble,
+    )
+    run_folder = find_run_folder(test_output_dir, "mock", "ensemble", "ensemble-run")
+    rows = list(read_classifications(run_folder))
+    meta = srsly.read_json(os.path.join(run_folder, "meta.json"))
+    shutil.rmtree(test_output_dir)
+    assert len(rows) == len(test_examples)
+    assert all("ensemble" in row["meta"] for row in rows)
+    assert len(meta["ensemble"]["members"]) == 2
+
+
+class ConcurrencyProbe:
+    """Wraps a guidance model, delays every call and records the largest number of calls running at once"""
+
+    def __init__(self, llm, delay=0.01):
+        self.llm = llm
+        self.delay = delay
+        self.running = 0
+        self.max_running = 0
+        self._lock = threading.Lock()
+
+    def __add__(self, other):
+        with self._lock:
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+        try:
+            time.sleep(self.delay)
+            return self.llm + other
+        finally:
+            with self._lock:
+                self.running -= 1
+
+
+def test_ensemble_members_share_backend_locks_with_workers(test_examples, mock_llm, test_output_dir, monkeypatch):
+    """Test if a member with a backend of its own never calls it while a pipeline worker does"""
+    monkeypatch.setattr("stance_llm.pool.load_backend", lambda spec: ConcurrencyProbe(mock_llm))
+    pool = ModelPool()
+    specs = [{"type": "mock", "label": "first"}, {"type": "mock", "label": "second"}]
+    ensemble = Ensemble([EnsembleMember("is"), EnsembleMember("is2", llm=specs[0], model_used="first")])
+    process(
+        egs=[dict(eg) for eg in test_examples * 3],
+        llm=specs,
+        export_folder=test_output_dir,
+        model_used="mock",
+        chain_used="is",
+        chat=False,
+        wait_time=0,
+        workers=2,
+        run_alias="ensemble-locks",
+        show_progress=False,
+        ensemble=ensemble,
+        model_pool=pool,
+    )
+    shutil.rmtree(test_output_dir)
+    assert [pool.get(spec).llm.max_running for spec in specs] == [1, 1]
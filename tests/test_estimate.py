@@ -0,0 +1,98 @@
+import srsly
+import pathlib
+import shutil
+
+from stance_llm.process import process
+from stance_llm.estimate import estimate_run, render_chain_prompts, SUMMARY_PLACEHOLDER
+from stance_llm.base import REGISTERED_LLM_CHAINS
+
+
+def test_estimate_run_best_case_below_worst_case(test_examples, mock_llm):
+    """Test if dry run projections of all chains give fewer calls and tokens in the best than in the worst case"""
+    for chain in REGISTERED_LLM_CHAINS:
+        report, rendered_egs = estimate_run(
+            egs=test_examples, llm=mock_llm, chain_used=chain, chat=False
+        )
+        assert report["n_examples"] == len(test_examples)
+        assert len(rendered_egs) == len(test_examples)
+        for key in ["calls", "input_tokens", "output_tokens"]:
+            assert report["best_case"][key] <= report["worst_case"][key]
+
+
+def test_estimate_run_call_counts(test_examples, mock_llm):
+    """Test if dry run projections give the known numbers of calls per example"""
+    calls = {"sis": (2, 3), "s2": (1, 1), "is": (1, 2), "nise": (1, 5)}
+    for chain, (best, worst) in calls.items():
+        report, _ = estimate_run(
+            egs=test_examples, llm=mock_llm, chain_used=chain, chat=True
+        )
+        assert report["best_case"]["calls"] == best * len(test_examples)
+        assert report["worst_case"]["calls"] == worst * len(test_examples)
+
+
+def test_estimate_run_cost_and_time(test_examples, mock_llm):
+    """Test if cost and time projections follow token counts and rate limits"""
+    report, _ = estimate_run(
+        egs=test_examples,
+        llm=mock_llm,
+        chain_used="is",
+        input_cost_per_1k=1.0,
+        output_cost_per_1k=2.0,
+        requests_per_minute=1,
+    )
+    worst = report["worst_case"]
+    assert worst["cost"] == worst["input_tokens"] / 1000 + worst["output_tokens"] / 1000 * 2
+    assert worst["minutes"] == worst["calls"]
+
+
+def test_estimate_run_tokens_per_minute(test_examples, mock_llm):
+    """Test if run times under a token limit are projected from the prompt tokens the rate limiter counts"""
+    report, _ = estimate_run(
+        egs=test_examples, llm=mock_llm, chain_used="sis", chat=False, tokens_per_minute=100
+    )
+    for case in ["best_case", "worst_case"]:
+        counts = report[case]
+        assert counts["minutes"] == counts["rate_limited_tokens"] / 100
+
+
+def test_render_chain_prompts_masks_entity(test_examples):
+    """Test if rendered prompts use the entity mask and the summary placeholder"""
+    prompts = render_chain_prompts(
+        test_examples[0], chain_label="sis", entity_mask="Organisation X"
+    )
+    assert [prompt["step"] for prompt in prompts] == ["summary", "irrelevance", "stance"]
+    assert all(test_examples[0]["ent_text"] not in prompt["prompt_text"] for prompt in prompts)
+    assert SUMMARY_PLACEHOLDER in prompts[1]["prompt_text"]
+
+
+def test_process_dry_run_creates_folder_contents(test_examples, mock_llm, test_output_dir):
+    report = process(
+        egs=test_examples,
+        llm=mock_llm,
+        export_folder=test_output_dir,
+        chain_used="nise",
+        model_used="mock",
+        dry_run=True,
+    )
+    out = pathlib.Path(test_output_dir)
+    file_list = [str(item.name) for item in list(out.rglob("*")) if item.is_file()]
+    dry_run_file = list(out.rglob("dry_run.json"))[0]
+    saved_report = srsly.read_json(dry_run_file)
+    shutil.rmtree(test_output_dir)
+    assert "dry_run.json" in file_list
+    assert "dry_run_prompts.jsonl" in file_list
+    assert "classifications.jsonl" not in file_list
+    assert saved_report["worst_case"] == report["worst_case"]
+
+
+def test_estimate_run_classification_only_saves_output_tokens(test_examples, mock_llm):
+    """Test if classification-only projections need fewer output tokens"""
+    for chain in ["s2", "sis", "nis2e"]:
+        full, _ = estimate_run(egs=test_examples, llm=mock_llm, chain_used=chain)
+        classification_only, _ = estimate_run(
+            egs=test_examples, llm=mock_llm, chain_used=chain, classification_only=True
+        )
+        assert (
+            classification_only["worst_case"]["output_tokens"]
+            < full["worst_case"]["output_tokens"]
+        )
@@ -0,0 +1,112 @@
+import pathlib
+import shutil
+
+import srsly
+
+from stance_llm.base import construct_irrelevance_prompt
+from stance_llm.history import BlobStore, rebuild_prompts
+from stance_llm.process import process
+
+
+def test_prompt_keeps_template_and_params():
+    """Test if constructed prompts are plain strings that remember their template and parameters"""
+    prompt = construct_irrelevance_prompt(
+        input_text="Ein Text.", entity="FDP", statement="Eine Aussage."
+    )
+    assert isinstance(prompt, str)
+    assert prompt.startswith("Analysiere den folgenden Text: Ein Text.")
+    assert prompt.template == "irrelevance"
+    assert prompt.params["entity"] == "FDP"
+
+
+def test_structured_prompt_history_is_deduplicated_and_rebuilt(
+    test_examples, mock_llm, test_output_dir
+):
+    """Test if long prompt parameters are stored once in the blob store and full prompts can be rebuilt"""
+    process(
+        egs=[dict(eg) for eg in test_examples],
+        llm=mock_llm,
+        export_folder=test_output_dir,
+        chain_used="nise",
+        model_used="mock",
+        chat=False,
+        wait_time=0,
+        prompt_history="structured",
+    )
+    out = pathlib.Path(test_output_dir)
+    run_folder = list(out.rglob("meta.json"))[0].parent
+    classifications = list(srsly.read_jsonl(run_folder / "classifications.jsonl"))
+    meta = srsly.read_json(run_folder / "meta.json")
+    blob_store = BlobStore.from_run_folder(str(run_folder))
+    n_blobs = len(blob_store)
+    histories = [c["meta"]["prompt_history"] for c in classifications]
+    rebuilt = [rebuild_prompts(history, blob_store=blob_store) for history in histories]
+    blob_store.close()
+    shutil.rmtree(test_output_dir)
+    assert meta["prompt_history"] == "structured"
+    first = histories[0]["irrelevance_general"]
+    assert first["template"] == "general_stance"
+    assert "blob" in first["params"]["input_text"]
+    # two examples share their text, so two distinct input texts are stored
+    assert n_blobs <= 2 + 2 * len(test_examples)
+    texts = {c["text"] for c in classifications}
+    prompt_text = rebuilt[0]["irrelevance_general"]["prompt_text"]
+    assert any(text in prompt_text for text in texts)
+    assert "answer_general" in rebuilt[0]["irrelevance_general"]["outputs"]
+
+
+def test_blobs_are_committed_before_rows_are_written(test_examples, mock_llm, test_output_dir):
+    """Test if the blobs referenced by a written classification can be read by another connection, as after a crash"""
+    missing = []
+
+    def check_blobs(eg):
+        path = list(pathlib.Path(test_output_dir).rglob(BlobStore.filename))[0]
+        reader = BlobStore(str(path))
+        for step in eg["meta"]["prompt_history"].values():
+            for value in step["params"].values():
+                if isinstance(value, dict) and "blob" in value:
+                    try:
+                        reader.get(value["blob"])
+                    except KeyError:
+                        missing.append(value["blob"])
+        reader.close()
+
+    process(
+        egs=[dict(eg) for eg in test_examples],
+        llm=mock_llm,
+        export_folder=test_output_dir,
+        chain_used="is",
+        model_used="mock",
+        chat=False,
+        wait_time=0,
+        prompt_history="structured",
+        on_classified=check_blobs,
+    )
+    shutil.rmtree(test_output_dir)
+    assert missing == []
+
+
+def test_full_prompt_history_is_the_default(test_examples, mock_llm, test_output_dir):
+    """Test if runs store the full prompt texts without a blob store unless a structured history is asked for"""
+    process(
+        egs=[dict(eg) for eg in test_examples],
+        llm=mock_llm,
+        export_folder=test_output_dir,
+        chain_used="is",
+        model_used="mock",
+        chat=False,
+        wait_time=0,
+    )
+    out = pathlib.Path(test_output_dir)
+    run_folder = list(out.rglob("meta.json"))[0].parent
+    classifications = list(srsly.read_jsonl(run_folder / "classifications.jsonl"))
+    meta = srsly.read_json(run_folder / "meta.json")
+    has_blob_store = (run_folder / BlobStore.filename).exists()
+    shutil.rmtree(test_output_dir)
+    assert meta["prompt_history"] == "full"
+    assert not has_blob_store
+    texts = {c["text"] for c in classifications}
+    assert all(
+        any(text in c["meta"]["prompt_history"]["irrelevance"]["prompt_text"] for text in texts)
+        for c in classifications
+    )
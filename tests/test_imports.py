@@ -0,0 +1,47 @@
+import os
+import shutil
+import subprocess
+import sys
+
+from stance_llm.process import make_new_run_alias, make_run_alias
+
+# modules that must not be loaded by importing stance_llm.process
+DEFERRED_MODULES = ["guidance", "sklearn", "scipy", "numpy", "polars", "srsly", "tqdm", "wonderwords"]
+
+# generous bound on the import time in seconds, to catch heavy dependencies loaded eagerly again
+MAX_IMPORT_SECONDS = 1.0
+
+
+def test_process_import_defers_heavy_dependencies():
+    """Test if importing stance_llm.process loads none of the heavy dependencies and stays fast"""
+    code = (
+        "import sys, time\n"
+        "start = time.perf_counter()\n"
+        "import stance_llm.process\n"
+        "print(time.perf_counter() - start)\n"
+        f"print(','.join(m for m in {DEFERRED_MODULES!r} if m in sys.modules))\n"
+    )
+    # the fastest of a few fresh interpreters, so that a busy machine does not fail the test
+    runs = [
+        subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True).stdout.split("\n")
+        for _ in range(3)
+    ]
+    assert all(run[1] == "" for run in runs), f"Loaded on import: {runs[0][1]}"
+    assert min(float(run[0]) for run in runs) < MAX_IMPORT_SECONDS
+
+
+def test_make_run_alias():
+    """Test if run aliases are two words with a hash suffix, equal for equal seeds and unique without a seed"""
+    assert make_run_alias(seed=42) == make_run_alias(seed=42)
+    assert len(make_run_alias().split("-")) == 3
+    assert len({make_run_alias() for _ in range(20000)}) == 20000
+
+
+def test_make_new_run_alias_skips_taken_aliases(test_output_dir, monkeypatch):
+    """Test if a new run alias is drawn again while a run folder with the drawn alias exists"""
+    taken = "happy-parrot-00000000"
+    os.makedirs(os.path.join(test_output_dir, "is", "mock", "2020-01-01", taken))
+    aliases = iter([taken, "quiet-otter-00000001"])
+    monkeypatch.setattr("stance_llm.process.make_run_alias", lambda: next(aliases))
+    assert make_new_run_alias(test_output_dir, "mock", ["is"]) == "quiet-otter-00000001"
+    shutil.rmtree(test_output_dir)
@@ -0,0 +1,47 @@
+import pytest
+
+from stance_llm.backends import (
+    LLAMACPP_CPU_DEFAULTS,
+    get_backend_chat,
+    get_backend_label,
+    get_llamacpp_settings,
+    load_backend,
+)
+from stance_llm.base import ALLOWED_STANCE_CATEGORIES, REGISTERED_LLM_CHAINS
+from stance_llm.benchmark import measure_throughput
+from stance_llm.process import detect_stance
+
+
+def test_llamacpp_backend_spec():
+    """Test if llama.cpp backend specs are labeled and tuned with the CPU profile"""
+    spec = {"type": "llamacpp", "model": "/models/disco-7b.Q4_K_M.gguf", "n_threads": 16}
+    assert get_backend_label(spec) == "llamacpp-disco-7b.Q4_K_M.gguf"
+    assert not get_backend_chat(spec)
+    settings = get_llamacpp_settings(n_threads=16)
+    assert settings["n_threads"] == 16
+    assert settings["n_ctx"] == LLAMACPP_CPU_DEFAULTS["n_ctx"]
+    assert settings["n_gpu_layers"] == 0
+
+
+@pytest.fixture(scope="module", params=[False, True], ids=["completion", "chat"])
+def llamacpp_llm(request, llamacpp_gguf):
+    llm = load_backend({"type": "llamacpp", "model": llamacpp_gguf, "chat": request.param, "n_ctx": 2048})
+    return llm, request.param
+
+
+@pytest.mark.parametrize("chain", list(REGISTERED_LLM_CHAINS))
+def test_llamacpp_chains(test_examples, llamacpp_llm, chain):
+    """Test if every registered chain runs with the llama.cpp backend in chat and non-chat mode"""
+    llm, chat = llamacpp_llm
+    classification = detect_stance(test_examples[0], llm=llm, chain_label=chain, chat=chat)
+    assert classification.stance in ALLOWED_STANCE_CATEGORIES
+
+
+def test_measure_throughput(test_examples, mock_llm):
+    """Test if the throughput of backends is measured relative to a baseline"""
+    table = measure_throughput(
+        test_examples[:1], llms={"a": mock_llm, "b": mock_llm}, chains=["is"], baseline="a"
+    )
+    assert table.height == 2
+    assert table.filter(table["model"] == "a")["speedup"][0] == 1.0
+    assert (table["egs_per_second"] > 0).all()
@@ -0,0 +1,82 @@
+import pathlib
+import shutil
+
+import pytest
+import srsly
+
+from stance_llm.process import find_run_folder, process, process_evaluate
+from stance_llm.readers import read_classifications
+
+
+def test_process_multiple_chains(test_examples, mock_llm, test_output_dir):
+    """Test if several chains run in one pass, share their first step and write one run folder each"""
+    chains = ["is", "is2", "nise", "nis2e"]
+    preds = process(
+        egs=[dict(eg, id=i) for i, eg in enumerate(test_examples)],
+        llm=mock_llm,
+        export_folder=test_output_dir,
+        model_used="mock",
+        chain_used=chains,
+        chat=False,
+        id_key="id",
+        wait_time=0,
+        workers=2,
+        run_alias="together",
+        show_progress=False,
+        prompt_history="structured",
+    )
+    written = {
+        chain: list(read_classifications(find_run_folder(test_output_dir, "mock", chain, "together")))
+        for chain in chains
+    }
+    shutil.rmtree(test_output_dir)
+    assert list(preds) == chains
+    for chain in chains:
+        assert sorted(eg["id"] for eg in preds[chain]) == [0, 1, 2]
+        assert sorted(row["id"] for row in written[chain]) == [0, 1, 2]
+        assert all(row["chain_used"] == chain for row in written[chain])
+    for i in range(len(test_examples)):
+        irrelevance = {
+            chain: next(eg for eg in preds[chain] if eg["id"] == i)["meta"]["prompt_history"]["irrelevance"]
+            for chain in ["is", "is2"]
+        }
+        assert not irrelevance["is"]["cached"]
+        assert irrelevance["is2"]["cached"]
+        assert irrelevance["is2"]["outputs"] == irrelevance["is"]["outputs"]
+
+
+def test_process_multiple_chains_rejects_unknown_chain(test_examples, mock_llm, test_output_dir):
+    with pytest.raises(NameError):
+        process(
+            egs=test_examples,
+            llm=mock_llm,
+            export_folder=test_output_dir,
+            model_used="mock",
+            chain_used=["is", "xyz"],
+        )
+
+
+@pytest.mark.parametrize("collect", [True, False])
+def test_process_evaluate_multiple_chains(test_examples, mock_llm, test_output_dir, collect):
+    """Test if evaluating several chains run together saves metrics to the run folder of each chain"""
+    chains = ["is", "nise"]
+    preds = process_evaluate(
+        egs=[dict(eg) for eg in test_examples],
+        llm=mock_llm,
+        export_folder=test_output_dir,
+        model_used="mock",
+        chain_used=chains,
+        chat=False,
+        wait_time=0,
+        collect=collect,
+    )
+    metrics = {
+        chain: srsly.read_json(list(pathlib.Path(test_output_dir, chain).rglob("metrics.json"))[0])
+        for chain in chains
+    }
+    shutil.rmtree(test_output_dir)
+    if collect:
+        assert list(preds) == chains
+    for chain in chains:
+        assert metrics[chain]["metrics"]["error_count"] == 0
+        assert "accuracy" in metrics[chain]["metrics"]
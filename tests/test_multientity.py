@@ -0,0 +1,84 @@
+import shutil
+
+from stance_llm.base import (
+    ALLOWED_STANCE_CATEGORIES,
+    MULTI_ENTITY_STANCE_ANSWERS,
+    construct_multi_entity_prompt,
+)
+from stance_llm.benchmark import compare_multi_entity
+from stance_llm.cache import StepCache
+from stance_llm.process import detect_stance, process
+from stance_llm.programs import build_multi_entity_program
+from stance_llm.schedule import group_entities
+
+
+def test_group_entities(test_examples):
+    """Test if examples are given the entities of all examples with the same text and statement"""
+    grouped = list(group_entities([dict(eg) for eg in test_examples]))
+    assert grouped[0]["ent_texts"] == ["Stadt Bern", "FDP"]
+    assert grouped[1]["ent_texts"] == ["Stadt Bern", "FDP"]
+    assert grouped[2]["ent_texts"] == ["Emily"]
+
+
+def test_multi_entity_chain_shares_joint_step(test_examples, mock_llm):
+    """Test if the entities of a text are classified from one joint generation"""
+    step_cache = StepCache()
+    grouped = list(group_entities([dict(eg) for eg in test_examples[:2]]))
+    runs = [
+        detect_stance(eg, llm=mock_llm, chain_label="me", chat=False, step_cache=step_cache)
+        for eg in grouped
+    ]
+    assert all(run.stance in ALLOWED_STANCE_CATEGORIES for run in runs)
+    assert [run.steps["multi_entity"]["cached"] for run in runs] == [False, True]
+    assert runs[0].meta["multi_entity"] == {"entities": 2, "fallback_chain": None}
+    assert len(runs[0].meta["llms"]["multi_entity"]["stances"]) == 2
+
+
+def test_multi_entity_chain_falls_back(test_examples, mock_llm):
+    """Test if an entity missing from the joint generation is classified with the single-entity chain"""
+    step_cache = StepCache()
+    eg = test_examples[1] | {"ent_texts": ["Stadt Bern", "FDP"]}
+    key = step_cache.make_key(
+        mock_llm,
+        False,
+        construct_multi_entity_prompt(eg["text"], ["Stadt Bern", "FDP"], eg["statement"]),
+        build_multi_entity_program(["Stadt Bern", "FDP"]),
+    )
+    # a generation cut off after the first entity
+    stances = [MULTI_ENTITY_STANCE_ANSWERS["support"]]
+    step_cache.put(key, {"outputs": {"stances": stances}, "text": "", "seconds": 0.0})
+    run = detect_stance(eg, llm=mock_llm, chain_label="me", chat=False, step_cache=step_cache)
+    assert run.stance in ALLOWED_STANCE_CATEGORIES
+    assert run.meta["multi_entity"]["fallback_chain"] == "is"
+    assert "irrelevance" in run.steps
+
+
+def test_process_multi_entity(test_examples, mock_llm, test_output_dir):
+    """Test if a run of the multi-entity chain sends each text once"""
+    step_cache = StepCache()
+    preds = process(
+        egs=[dict(eg) for eg in test_examples],
+        llm=mock_llm,
+        export_folder=test_output_dir,
+        model_used="mock",
+        chain_used="me",
+        chat=False,
+        wait_time=0,
+        workers=2,
+        show_progress=False,
+        step_cache=step_cache,
+    )
+    shutil.rmtree(test_output_dir)
+    assert len(preds) == len(test_examples)
+    assert step_cache.misses == 2
+
+
+def test_compare_multi_entity(test_examples, mock_llm, tmp_path):
+    """Test if the comparison reports tokens saved by the multi-entity chain"""
+    table = compare_multi_entity(test_examples, llm=mock_llm, chat=False, export_folder=tmp_path)
+    assert table["chain"].to_list() == ["is", "me"]
+    me = table.row(1, named=True)
+    assert me["llm_calls"] == 2
+    assert me["tokens_saved"] > 0
+    assert 0 <= me["accuracy"] <= 1
+    assert (tmp_path / "multi_entity.csv").exists()
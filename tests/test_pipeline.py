@@ -0,0 +1,63 @@
+import pathlib
+import shutil
+import threading
+import srsly
+
+from guidance import models
+
+from stance_llm.pipeline import ClassificationPipeline
+from stance_llm.process import process
+from stance_llm.retry import RetryQueue
+
+
+def test_pipeline_writes_all_items_once():
+    """Test if every item is classified and written exactly once, including deferred items"""
+    retry_queue = RetryQueue()
+    written = []
+    lock = threading.Lock()
+    failed_once = set()
+
+    def classify(item, attempt, worker_index):
+        with lock:
+            if item % 3 == 0 and item not in failed_once:
+                failed_once.add(item)
+                retry_queue.push(item, attempts=attempt, delay=0)
+                return False
+        return True
+
+    pipeline = ClassificationPipeline(
+        classify=classify,
+        write=written.append,
+        workers=3,
+        queue_size=2,
+        retry_queue=retry_queue,
+    )
+    pipeline.run(iter(range(20)))
+    assert sorted(written) == list(range(20))
+    stats = pipeline.get_stats()
+    assert stats["workers"] == 3
+    assert stats["input_queue"]["max_depth"] <= 2
+    assert stats["output_queue"]["puts"] == 20 + 1
+
+
+def test_process_with_workers(test_examples, test_output_dir):
+    """Test if process classifies all examples with several workers and llm backends and records the queue stats"""
+    preds = process(
+        egs=[dict(eg) for eg in test_examples],
+        llm=[models.Mock(), models.Mock()],
+        export_folder=test_output_dir,
+        chain_used="is",
+        model_used="mock",
+        chat=False,
+        wait_time=0,
+        workers=2,
+        queue_size=1,
+    )
+    out = pathlib.Path(test_output_dir)
+    classifications = list(srsly.read_jsonl(list(out.rglob("classifications.jsonl"))[0]))
+    meta = srsly.read_json(list(out.rglob("meta.json"))[0])
+    shutil.rmtree(test_output_dir)
+    assert len(preds) == len(test_examples)
+    assert len(classifications) == len(test_examples)
+    assert meta["pipeline"]["workers"] == 2
+    assert set(meta["pipeline"]) == {"workers", "seconds", "input_queue", "output_queue"}
@@ -0,0 +1,112 @@
+import shutil
+import threading
+
+import pytest
+
+from stance_llm.ensemble import Ensemble, EnsembleMember
+from stance_llm.pool import GB, ModelPool, get_model_pool
+from stance_llm.process import detect_stance, process
+
+
+def mock_spec(label: str, memory_gb=1) -> dict:
+    return {"type": "mock", "label": label, "memory_gb": memory_gb}
+
+
+def test_pool_loads_lazily():
+    """Test if a handle is shared by equal specs and loads its backend on first use only"""
+    pool = ModelPool()
+    handle = pool.get("mock")
+    assert pool.get({"type": "mock"}) is handle
+    assert handle.llm is None
+    with handle as llm:
+        assert llm is handle.llm
+    with handle as llm_again:
+        assert llm_again is llm
+    assert pool.get_stats()["loads"] == 1
+
+
+def test_pool_evicts_least_recently_used():
+    """Test if loading beyond the memory budget evicts the least recently used backend not in use"""
+    pool = ModelPool(memory_budget_gb=2)
+    first, second, third = [pool.get(mock_spec(label)) for label in ["a", "b", "c"]]
+    with first:
+        pass
+    with second:
+        pass
+    with first:
+        pass
+    with third:
+        pass
+    stats = pool.get_stats()
+    assert stats["loaded"] == ["a", "c"]
+    assert stats["evictions"] == 1
+    assert second.llm is None
+    assert pool.get_memory() == 2 * GB
+
+
+def test_pool_keeps_backends_in_use():
+    """Test if a backend in use is neither evicted for another nor evicted explicitly"""
+    pool = ModelPool(memory_budget_gb=1)
+    first, second = pool.get(mock_spec("a")), pool.get(mock_spec("b"))
+    with first:
+        with second:
+            assert first.llm is not None
+        with pytest.raises(RuntimeError):
+            pool.evict(mock_spec("a"))
+    assert pool.get_stats()["loaded"] == ["a", "b"]
+    pool.evict()
+    assert pool.get_stats()["loaded"] == []
+
+
+def test_specs_in_detect_stance_and_process(test_examples, test_output_dir):
+    """Test if backend specs are loaded from the pool once and stay warm across runs"""
+    pool = ModelPool()
+    classification = detect_stance(test_examples[0], llm="mock", chain_label="is", chat=False, model_pool=pool)
+    assert classification.stance is not None
+    for run_alias in ["first", "second"]:
+        preds = process(
+            egs=[dict(eg) for eg in test_examples],
+            llm=["mock", "mock"],
+            export_folder=test_output_dir,
+            model_used="mock",
+            chain_used="is",
+            chat=False,
+            wait_time=0,
+            workers=2,
+            run_alias=run_alias,
+            show_progress=False,
+            model_pool=pool,
+        )
+        assert len(preds) == len(test_examples)
+    shutil.rmtree(test_output_dir)
+    assert pool.get_stats()["loads"] == 1
+
+
+def test_ensemble_members_share_a_pooled_backend(test_examples, test_output_dir):
+    """Test if ensemble members running in their own threads can use the backend a pipeline worker has checked out"""
+    pool = get_model_pool()
+    ensemble = Ensemble([EnsembleMember("is", llm="mock", model_used="mock"), EnsembleMember("is2")])
+    outcome = {}
+
+    def run():
+        outcome["preds"] = process(
+            egs=[dict(eg) for eg in test_examples],
+            llm="mock",
+            export_folder=test_output_dir,
+            model_used="mock",
+            chain_used="is",
+            chat=False,
+            wait_time=0,
+            run_alias="ensemble-pooled",
+            show_progress=False,
+            ensemble=ensemble,
+            model_pool=pool,
+        )
+
+    runner = threading.Thread(target=run, daemon=True)
+    runner.start()
+    runner.join(timeout=60)
+    shutil.rmtree(test_output_dir, ignore_errors=True)
+    assert not runner.is_alive(), "Ensemble members deadlocked on the pooled backend"
+    assert len(outcome["preds"]) == len(test_examples)
+    assert all(pred["stance_pred"] != "error" for pred in outcome["preds"])
@@ -1,8 +1,11 @@
+import os
 import shutil
 import pathlib
+
+import pytest
 import srsly
 
-from stance_llm.process import process, process_evaluate
+from stance_llm.process import process, process_evaluate, repair_run
 from stance_llm.base import ALLOWED_STANCE_CATEGORIES
 
 
@@ -66,3 +69,59 @@ def test_process_evaluate_creates_folder_contents(
     assert "classifications.jsonl" in file_list
     assert "meta.json" in file_list
     assert "metrics.json" in file_list
+
+
+def test_repair_run_reclassifies_errors(test_examples, mock_llm, test_output_dir):
+    """Test if repairing a run replaces error classifications in place and recomputes metrics"""
+    process_evaluate(
+        egs=[dict(eg) for eg in test_examples],
+        llm=None,
+        export_folder=test_output_dir,
+        chain_used="is",
+        model_used="mock",
+        chat=False,
+        wait_time=0,
+    )
+    out = pathlib.Path(test_output_dir)
+    run_folder = list(out.rglob("meta.json"))[0].parent
+    metrics_before = srsly.read_json(run_folder / "metrics.json")
+    repair_run(run_folder=str(run_folder), llm=mock_llm, wait_time=0)
+    egs_with_classifications = list(srsly.read_jsonl(run_folder / "classifications.jsonl"))
+    metrics_after = srsly.read_json(run_folder / "metrics.json")
+    run_meta = srsly.read_json(run_folder / "meta.json")
+    shutil.rmtree(test_output_dir)
+    assert metrics_before["metrics"]["error_count"] == len(test_examples)
+    assert metrics_after["metrics"]["error_count"] == 0
+    assert len(egs_with_classifications) == len(test_examples)
+    assert all(eg["stance_pred"] != "error" for eg in egs_with_classifications)
+    assert all("repaired" in eg["meta"] for eg in egs_with_classifications)
+    assert run_meta["repairs"][0]["error_count_after"] == 0
+
+
+def test_process_does_not_overwrite_earlier_runs(test_examples, mock_llm, test_output_dir):
+    """Test if a new run refuses an alias of an earlier run unless resuming it, and resumes it in its own folder"""
+    earlier_folder = os.path.join(test_output_dir, "is", "mock", "2020-01-01", "taken")
+    kwargs = dict(
+        llm=mock_llm,
+        export_folder=test_output_dir,
+        chain_used="is",
+        model_used="mock",
+        chat=False,
+        wait_time=0,
+        run_alias="taken",
+        show_progress=False,
+    )
+    process(egs=[dict(eg) for eg in test_examples[:1]], **kwargs)
+    run_folders = list(pathlib.Path(test_output_dir).rglob("meta.json"))
+    os.makedirs(os.path.dirname(earlier_folder))
+    os.rename(run_folders[0].parent, earlier_folder)
+    with pytest.raises(FileExistsError):
+        process(egs=[dict(eg) for eg in test_examples], **kwargs)
+    n_rows = len(list(srsly.read_jsonl(os.path.join(earlier_folder, "classifications.jsonl"))))
+    process(egs=[dict(eg) for eg in test_examples], resume=True, **kwargs)
+    resumed_rows = list(srsly.read_jsonl(os.path.join(earlier_folder, "classifications.jsonl")))
+    run_folders = list(pathlib.Path(test_output_dir).rglob("meta.json"))
+    shutil.rmtree(test_output_dir)
+    assert n_rows == 1
+    assert len(resumed_rows) == len(test_examples)
+    assert run_folders == [pathlib.Path(earlier_folder) / "meta.json"]
@@ -0,0 +1,58 @@
+import gzip
+import os
+import shutil
+
+import srsly
+
+from stance_llm.process import prepare_prodigy_egs, read_prodigy_egs
+
+
+def make_prodigy_eg(par_id, org_text, stance, flagged=None, task_hash=None):
+    prodigy_eg = {
+        "par_id": par_id,
+        "text": f"Text {par_id}",
+        "meta": {"org_text": org_text},
+        "statement_de": "Das Fahrrad als Mobilitätsform soll gefördert werden.",
+        "accept": [stance],
+    }
+    if flagged is not None:
+        prodigy_eg["flagged"] = flagged
+    if task_hash is not None:
+        prodigy_eg["_task_hash"] = task_hash
+    return prodigy_eg
+
+
+def test_prepare_prodigy_egs():
+    """Test if flagged examples are removed only if asked to"""
+    prodigy_egs = [
+        make_prodigy_eg(1, "FDP", "support"),
+        make_prodigy_eg(2, "SP", "opposition", flagged=True),
+        make_prodigy_eg(3, "SVP", "irrelevant", flagged=False),
+    ]
+    assert [eg["id"] for eg in prepare_prodigy_egs(prodigy_egs)] == [1, 3]
+    assert len(prepare_prodigy_egs(prodigy_egs, remove_flagged=False)) == 3
+
+
+def test_read_prodigy_egs(test_output_dir):
+    """Test if a compressed export is converted lazily, without flagged and repeated annotations"""
+    os.makedirs(test_output_dir, exist_ok=True)
+    path = os.path.join(test_output_dir, "export.jsonl.gz")
+    prodigy_egs = [
+        make_prodigy_eg(1, "FDP", "support", task_hash=11),
+        make_prodigy_eg(1, "FDP", "opposition", task_hash=11),
+        make_prodigy_eg(1, "SP", "opposition", task_hash=12),
+        make_prodigy_eg(2, "SVP", "irrelevant", flagged=True, task_hash=13),
+        make_prodigy_eg(3, "GLP", "support"),
+        make_prodigy_eg(3, "GLP", "irrelevant"),
+    ]
+    with gzip.open(path, "wt", encoding="utf8") as f:
+        f.write("".join(srsly.json_dumps(eg) + "\n" for eg in prodigy_egs))
+    egs = read_prodigy_egs(path)
+    assert not isinstance(egs, list)
+    egs = list(egs)
+    shutil.rmtree(test_output_dir)
+    assert [(eg["id"], eg["ent_text"], eg["stance_true"]) for eg in egs] == [
+        (1, "FDP", "support"),
+        (1, "SP", "opposition"),
+        (3, "GLP", "support"),
+    ]
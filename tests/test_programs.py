@@ -0,0 +1,34 @@
+from guidance import models
+
+from stance_llm.benchmark import measure_program_overhead
+from stance_llm.cache import StepCache, get_program_key
+from stance_llm.process import detect_stance
+from stance_llm.programs import build_step_program, get_step_program
+
+
+def test_step_programs_are_reused():
+    """Test if a step program is built once and keyed like the grammar it wraps"""
+    program = get_step_program("summary", max_tokens=80)
+    assert get_step_program("summary", max_tokens=80) is program
+    assert get_step_program("summary", max_tokens=40, stop="\n") is not program
+    assert program.key == get_program_key(build_step_program("summary", max_tokens=80))
+    prefixed = get_step_program("summary_v2_stance").with_prefix("Die Organisation X ")
+    assert prefixed.key != get_step_program("summary_v2_stance").key
+
+
+def test_chains_with_step_programs(test_examples, mock_llm):
+    """Test if chains run with precompiled programs in chat and non-chat mode and their steps are cached"""
+    step_cache = StepCache()
+    for llm, chat in [(mock_llm, False), (models.MockChat(), True)]:
+        first = detect_stance(test_examples[0], llm=llm, chain_label="s2", chat=chat, step_cache=step_cache)
+        again = detect_stance(test_examples[0], llm=llm, chain_label="s2", chat=chat, step_cache=step_cache)
+        assert again.stance == first.stance
+        assert all(step["cached"] for step in again.steps.values())
+
+
+def test_measure_program_overhead(test_examples, mock_llm):
+    """Test if the micro-benchmark reports the overhead of rebuilding and reusing programs"""
+    result = measure_program_overhead(llm=mock_llm, egs=test_examples[:1], n_calls=20)
+    assert result["rebuild_keyed"] > result["reuse_keyed"]
+    assert result["step"] > 0
+    assert 0 <= result["saved_share"] < 1
@@ -0,0 +1,70 @@
+import gzip
+import pathlib
+import shutil
+
+import polars as pl
+import pytest
+import srsly
+
+from stance_llm.process import process_evaluate
+from stance_llm.readers import count_egs, read_egs, read_jsonl
+
+
+@pytest.fixture
+def example_files(test_examples, tmp_path):
+    jsonl_path = str(tmp_path / "egs.jsonl")
+    srsly.write_jsonl(jsonl_path, test_examples)
+    gz_path = str(tmp_path / "egs.jsonl.gz")
+    with gzip.open(gz_path, "wt", encoding="utf8") as f:
+        for eg in test_examples:
+            f.write(srsly.json_dumps(eg) + "\n")
+    parquet_path = str(tmp_path / "egs.parquet")
+    pl.DataFrame(test_examples).write_parquet(parquet_path, row_group_size=1)
+    return {"jsonl": jsonl_path, "jsonl.gz": gz_path, "parquet": parquet_path}
+
+
+@pytest.mark.parametrize("source_format", ["jsonl", "jsonl.gz", "parquet"])
+def test_read_egs_yields_all_examples(example_files, test_examples, source_format):
+    """Test if examples are read lazily and unchanged from all supported file formats"""
+    egs = read_egs(example_files[source_format], batch_size=2)
+    assert not isinstance(egs, list)
+    assert list(egs) == test_examples
+
+
+def test_count_egs(example_files, test_examples):
+    """Test if the number of examples is known for Parquet files only"""
+    assert count_egs(example_files["parquet"]) == len(test_examples)
+    assert count_egs(example_files["jsonl"]) is None
+
+
+def test_process_evaluate_streams_from_file(example_files, test_examples, test_output_dir):
+    """Test if a run reads examples from a file and evaluates without collecting the classifications"""
+    preds = process_evaluate(
+        egs=example_files["parquet"],
+        llm=None,
+        export_folder=test_output_dir,
+        chain_used="is",
+        model_used="none",
+        chat=False,
+        wait_time=0,
+        collect=False,
+    )
+    out = pathlib.Path(test_output_dir)
+    classifications = list(srsly.read_jsonl(list(out.rglob("classifications.jsonl"))[0]))
+    metrics = srsly.read_json(list(out.rglob("metrics.json"))[0])
+    shutil.rmtree(test_output_dir)
+    assert preds is None
+    assert len(classifications) == len(test_examples)
+    assert metrics["metrics"]["error_count"] == len(test_examples)
+
+
+@pytest.mark.parametrize("source_format", ["jsonl", "jsonl.gz"])
+def test_read_jsonl_skips_corrupt_lines(test_examples, tmp_path, source_format):
+    """Test if a corrupt complete line is skipped and the records after it are still read"""
+    path = str(tmp_path / f"egs.{source_format}")
+    lines = [srsly.json_dumps(eg) + "\n" for eg in test_examples]
+    lines.insert(1, '{"text": "cut off\n')
+    opener = gzip.open if source_format == "jsonl.gz" else open
+    with opener(path, "wt", encoding="utf8") as f:
+        f.writelines(lines)
+    assert list(read_jsonl(path)) == test_examples
@@ -0,0 +1,95 @@
+import pathlib
+import shutil
+import srsly
+
+from stance_llm.process import process
+from stance_llm.retry import (
+    RetryPolicy,
+    RetryQueue,
+    get_retry_policy,
+    iter_with_retries,
+)
+
+
+class RateLimitError(Exception):
+    pass
+
+
+class FlakyLLM:
+    """Wraps a guidance model and raises a RateLimitError for the first calls"""
+
+    def __init__(self, llm, failures):
+        self.llm = llm
+        self.failures = failures
+
+    def __add__(self, other):
+        if self.failures > 0:
+            self.failures -= 1
+            raise RateLimitError("Too many requests")
+        return self.llm + other
+
+
+def test_retry_policy_backoff_is_exponential_and_capped():
+    """Test if retry delays double per attempt up to the maximum delay"""
+    policy = RetryPolicy(max_attempts=5, base_delay=1.0, max_delay=4.0, jitter=0.0)
+    assert [policy.get_delay(attempts) for attempts in [1, 2, 3, 4]] == [1.0, 2.0, 4.0, 4.0]
+    assert policy.should_retry(4)
+    assert not policy.should_retry(5)
+
+
+def test_get_retry_policy_matches_error_class_names():
+    """Test if retry policies are matched by error class name and base classes"""
+    assert get_retry_policy(RateLimitError()) is not None
+    assert get_retry_policy(ConnectionResetError()) is not None
+    assert get_retry_policy(KeyError()) is None
+    assert get_retry_policy(RateLimitError(), retry_policies={}) is None
+
+
+def test_iter_with_retries_drains_queue():
+    """Test if deferred items are yielded after all other items"""
+    retry_queue = RetryQueue()
+    seen = []
+    for item, attempts in iter_with_retries(["a", "b"], retry_queue=retry_queue):
+        seen.append((item, attempts))
+        if item == "a" and attempts < 2:
+            retry_queue.push(item, attempts=attempts + 1, delay=0)
+    assert seen == [("a", 0), ("b", 0), ("a", 1), ("a", 2)]
+
+
+def test_process_retries_transient_errors(test_examples, mock_llm, test_output_dir):
+    """Test if examples failing with a transient error are retried and classified"""
+    preds = process(
+        egs=[dict(eg) for eg in test_examples],
+        llm=FlakyLLM(mock_llm, failures=2),
+        export_folder=test_output_dir,
+        chain_used="is",
+        model_used="mock",
+        chat=False,
+        wait_time=0,
+        retry_policies={"RateLimitError": RetryPolicy(max_attempts=3, base_delay=0)},
+    )
+    shutil.rmtree(test_output_dir)
+    assert len(preds) == len(test_examples)
+    assert all(pred["stance_pred"] != "error" for pred in preds)
+    assert sorted(pred["meta"]["attempts"] for pred in preds) == [1, 2, 2]
+
+
+def test_process_writes_structured_errors(test_examples, test_output_dir):
+    """Test if failed examples are serialized with their error type, message and attempt count"""
+    process(
+        egs=[dict(eg) for eg in test_examples],
+        llm=None,
+        export_folder=test_output_dir,
+        chain_used="is",
+        model_used="none",
+        chat=False,
+        wait_time=0,
+    )
+    out = pathlib.Path(test_output_dir)
+    classifications_file = list(out.rglob("classifications.jsonl"))[0]
+    egs_with_classifications = list(srsly.read_jsonl(classifications_file))
+    shutil.rmtree(test_output_dir)
+    assert len(egs_with_classifications) == len(test_examples)
+    assert all(eg["stance_pred"] == "error" for eg in egs_with_classifications)
+    assert all(eg["meta"]["error"]["type"] == "TypeError" for eg in egs_with_classifications)
+    assert all(eg["meta"]["error"]["attempts"] == 1 for eg in egs_with_classifications)
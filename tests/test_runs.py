@@ -0,0 +1,34 @@
+import os
+import shutil
+
+from stance_llm.process import process_evaluate
+from stance_llm.runs import RUN_INDEX_FILENAME, RunIndex
+
+
+def test_run_index_is_updated_and_queried(test_examples, mock_llm, test_output_dir):
+    """Test if runs are indexed when saved and can be filtered by chain and model"""
+    for chain_used, llm in [("is", mock_llm), ("sis", mock_llm), ("is", None)]:
+        process_evaluate(
+            egs=[dict(eg) for eg in test_examples],
+            llm=llm,
+            export_folder=test_output_dir,
+            chain_used=chain_used,
+            model_used="mock" if llm is not None else "none",
+            chat=False,
+            wait_time=0,
+        )
+    run_index = RunIndex(test_output_dir)
+    all_runs = run_index.query()
+    is_runs = run_index.query(chain_used="is")
+    failed_runs = run_index.query(model_used="none")
+    os.remove(os.path.join(test_output_dir, RUN_INDEX_FILENAME))
+    n_rebuilt = RunIndex(test_output_dir).rebuild()
+    shutil.rmtree(test_output_dir)
+    assert len(all_runs) == 3
+    assert len(is_runs) == 2
+    assert failed_runs[0]["n_classifications"] == len(test_examples)
+    assert failed_runs[0]["error_count"] == len(test_examples)
+    assert failed_runs[0]["metrics"]["error_count"] == len(test_examples)
+    assert failed_runs[0]["meta"]["chain_used"] == "is"
+    assert all(run["seconds"] is not None for run in all_runs)
+    assert n_rebuilt == 3
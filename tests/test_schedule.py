@@ -0,0 +1,80 @@
+import shutil
+
+import srsly
+
+from stance_llm.process import find_run_folder, process
+from stance_llm.schedule import ExampleScheduler, count_text_switches
+
+
+def make_egs(test_examples):
+    # paragraphs alternating in the input, each with several entities and statements
+    egs = []
+    for i in range(4):
+        for eg in test_examples:
+            egs.append(eg | {"id": len(egs), "statement": f"{eg['statement']} ({i})"})
+    return egs
+
+
+def test_scheduler_groups_texts_and_entities(test_examples):
+    """Test if examples are grouped by text and entity within a window, keeping the order of statements"""
+    egs = make_egs(test_examples)
+    scheduler = ExampleScheduler(window=None)
+    ordered = list(scheduler.order(egs))
+    assert sorted(eg["id"] for eg in ordered) == [eg["id"] for eg in egs]
+    assert count_text_switches(ordered) == 1
+    assert count_text_switches(ordered) < count_text_switches(egs)
+    fdp_ids = [eg["id"] for eg in ordered if eg["ent_text"] == "FDP"]
+    assert fdp_ids == sorted(fdp_ids)
+    stats = scheduler.get_stats()
+    assert stats["egs"] == len(egs)
+    assert stats["text_switches_after"] == 1
+
+
+def test_scheduler_restores_input_order(test_examples, mock_llm, test_output_dir):
+    """Test if a scheduled run writes and returns the classifications in input order"""
+    egs = make_egs(test_examples)
+    preds = process(
+        egs=[dict(eg) for eg in egs],
+        llm=mock_llm,
+        export_folder=test_output_dir,
+        model_used="mock",
+        chain_used="is",
+        chat=False,
+        id_key="id",
+        wait_time=0,
+        workers=2,
+        run_alias="scheduled",
+        show_progress=False,
+        scheduler=ExampleScheduler(window=5),
+    )
+    run_folder = find_run_folder(test_output_dir, "mock", "is", "scheduled")
+    written = list(srsly.read_jsonl(f"{run_folder}/classifications.jsonl"))
+    meta = srsly.read_json(f"{run_folder}/meta.json")
+    shutil.rmtree(test_output_dir)
+    assert [eg["id"] for eg in preds] == [eg["id"] for eg in egs]
+    assert [row["id"] for row in written] == [eg["id"] for eg in egs]
+    assert meta["schedule"]["windows"] == 3
+
+
+def test_scheduler_writes_deferred_examples_at_the_end(test_examples):
+    """Test if an example deferred for a retry does not hold back the examples after it and is written once retried"""
+    egs = make_egs(test_examples)
+    scheduler = ExampleScheduler(window=None)
+    ordered = list(scheduler.order(egs))
+    deferred_eg = egs[0]
+
+    def classify(eg, attempt, worker_index):
+        return eg is not deferred_eg or attempt > 1
+
+    classify = scheduler.skip_deferred(classify)
+    written = []
+    write = scheduler.restore_order(written.append)
+    for eg in ordered:
+        if classify(eg, 1, 0):
+            write(eg)
+    assert [eg["id"] for eg in written] == [eg["id"] for eg in egs[1:]]
+    assert classify(deferred_eg, 2, 0)
+    write(deferred_eg)
+    assert [eg["id"] for eg in written] == [eg["id"] for eg in egs[1:]] + [deferred_eg["id"]]
+    assert scheduler.get_stats()["deferred"] == 1
+    assert scheduler.get_stats()["max_held"] < len(egs)
@@ -0,0 +1,97 @@
+import shutil
+from types import SimpleNamespace
+
+from stance_llm.sequential import SequentialEvaluator, stratified_order, sequential_evaluate
+
+
+def test_stratified_order_interleaves_classes(test_examples):
+    """Test if every prefix of the order contains all classes in about equal proportions"""
+    egs = [dict(eg, n=i) for i in range(10) for eg in test_examples]
+    ordered = stratified_order(egs, seed=0)
+    assert sorted(eg["n"] for eg in ordered) == sorted(eg["n"] for eg in egs)
+    for n in [6, 15, 30]:
+        counts = {}
+        for eg in ordered[:n]:
+            counts[eg["stance_true"]] = counts.get(eg["stance_true"], 0) + 1
+        assert max(counts.values()) - min(counts.values()) <= 2
+
+
+def test_sequential_evaluate_stops_below_reference(test_examples, mock_llm, test_output_dir):
+    """Test if a run that cannot beat the reference is stopped early and reports the llm calls saved"""
+    egs = [dict(eg) for _ in range(20) for eg in test_examples]
+    eval_metrics = sequential_evaluate(
+        egs=egs,
+        llm=mock_llm,
+        model_used="mock",
+        chain_used="is",
+        reference=0.99,
+        metric="accuracy",
+        min_examples=10,
+        check_every=5,
+        export_folder=test_output_dir,
+        seed=0,
+        chat=False,
+        wait_time=0,
+    )
+    report = eval_metrics["sequential"]
+    assert report["stopped_early"]
+    assert report["n_classified"] < len(egs)
+    assert report["llm_calls_saved_estimate"] >= report["n_skipped"]
+    not_stopped = sequential_evaluate(
+        egs=egs,
+        llm=mock_llm,
+        model_used="mock",
+        chain_used="is",
+        reference=0.0,
+        metric="macro_f1",
+        min_examples=10,
+        check_every=20,
+        export_folder=test_output_dir,
+        seed=0,
+        chat=False,
+        wait_time=0,
+    )
+    shutil.rmtree(test_output_dir)
+    assert not not_stopped["sequential"]["stopped_early"]
+    assert not_stopped["sequential"]["n_classified"] == len(egs)
+    assert not_stopped["sequential"]["llm_calls_saved_estimate"] == 0
+
+
+def test_sequential_evaluate_without_collecting(test_examples, mock_llm, test_output_dir):
+    """Test if a sequential evaluation not keeping classifications in memory evaluates what it classified"""
+    egs = [dict(eg) for _ in range(20) for eg in test_examples]
+    eval_metrics = sequential_evaluate(
+        egs=egs,
+        llm=mock_llm,
+        model_used="mock",
+        chain_used="is",
+        reference=0.99,
+        metric="accuracy",
+        min_examples=10,
+        check_every=5,
+        export_folder=test_output_dir,
+        seed=0,
+        chat=False,
+        wait_time=0,
+        collect=False,
+    )
+    shutil.rmtree(test_output_dir)
+    report = eval_metrics["sequential"]
+    assert report["stopped_early"]
+    assert eval_metrics["accuracy"] == report["value"]
+    assert eval_metrics["macro avg"]["support"] + eval_metrics["error_count"] == report["n_classified"]
+
+
+def test_sequential_evaluator_counts_llm_calls_without_cache_hits():
+    """Test if steps answered from the step cache are not counted as llm calls and failed examples do not lower the calls per example"""
+    evaluator = SequentialEvaluator(n_total=10, reference=0.0, min_examples=100)
+    steps = {"irrelevance": {"cached": True}, "stance": {"cached": False}, "summary": {"cached": False}}
+    evaluator.update(
+        {"stance_true": "support", "stance_pred": "support", "stance_classification": SimpleNamespace(steps=steps)}
+    )
+    evaluator.update(
+        {"stance_true": "support", "stance_pred": "error", "meta": {"error": {"type": "ClassificationTimeout"}}}
+    )
+    report = evaluator.get_report()
+    assert report["llm_calls"] == 2
+    assert report["llm_calls_saved_estimate"] == 8 * 2
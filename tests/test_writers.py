@@ -0,0 +1,80 @@
+import os
+import pathlib
+import shutil
+
+import polars as pl
+import pytest
+import srsly
+
+from stance_llm.process import process_evaluate
+from stance_llm.readers import read_classifications, read_jsonl
+from stance_llm.writers import JsonlClassificationWriter, write_json_atomic
+
+
+@pytest.mark.parametrize("output_format", ["parquet", "arrow"])
+def test_columnar_output(test_examples, mock_llm, test_output_dir, output_format):
+    """Test if classifications are written in row groups with categorical columns and read back unchanged"""
+    preds = process_evaluate(
+        egs=[dict(eg) for eg in test_examples],
+        llm=mock_llm,
+        export_folder=test_output_dir,
+        chain_used="is",
+        model_used="mock",
+        chat=False,
+        wait_time=0,
+        output_format=output_format,
+        row_group_size=2,
+    )
+    out = pathlib.Path(test_output_dir)
+    run_folder = list(out.rglob("meta.json"))[0].parent
+    folder_path = run_folder / f"classifications.{output_format}"
+    parts = sorted(os.listdir(folder_path))
+    if output_format == "parquet":
+        df = pl.read_parquet(folder_path / parts[0])
+    else:
+        df = pl.read_ipc(folder_path / parts[0], memory_map=True)
+    classifications = list(read_classifications(run_folder))
+    metrics_exist = (run_folder / "metrics.json").exists()
+    shutil.rmtree(test_output_dir)
+    assert len(parts) == 2
+    assert df.schema["run_alias"] == pl.Categorical
+    assert df.schema["stance_pred"] == pl.Categorical
+    assert df.schema["text"] == pl.Utf8
+    assert metrics_exist
+    assert len(classifications) == len(test_examples)
+    assert sorted(c["stance_pred"] for c in classifications) == sorted(
+        p["stance_pred"] for p in preds
+    )
+    assert all(isinstance(c["meta"], dict) for c in classifications)
+
+
+@pytest.mark.parametrize("compression", [None, "gzip", "zstd"])
+def test_compressed_jsonl_recovers_after_crash(tmp_path, compression):
+    """Test if all complete records are read back from a classifications file truncated by a crash"""
+    writer = JsonlClassificationWriter(
+        folder_path=str(tmp_path),
+        model_used="mock",
+        chain_used="is",
+        run_alias="test-run",
+        compression=compression,
+        frame_size=2,
+    )
+    rows = [{"text": f"Text {i}", "stance_pred": "support", "meta": {}} for i in range(5)]
+    for row in rows:
+        writer.write_row(row)
+    writer.close()
+    assert list(read_jsonl(writer.filepath)) == rows
+    # simulate a crash while writing the last line or frame
+    with open(writer.filepath, "rb") as f:
+        data = f.read()
+    with open(writer.filepath, "wb") as f:
+        f.write(data[:-20])
+    assert list(read_jsonl(writer.filepath)) == rows[:4]
+
+
+def test_write_json_atomic_leaves_no_temporary_file(tmp_path):
+    """Test if JSON files are written completely and the temporary file is renamed"""
+    path = str(tmp_path / "meta.json")
+    write_json_atomic(path, {"run_alias": "test-run"})
+    assert srsly.read_json(path) == {"run_alias": "test-run"}
+    assert os.listdir(tmp_path) == ["meta.json"]